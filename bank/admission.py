@@ -0,0 +1,185 @@
+import os
+import math
+import time
+import logging
+import threading
+from collections import deque
+from functools import wraps
+import metrics
+
+# Управление допуском к подписи: не более ADMISSION_CONCURRENCY подписей одновременно
+# в процессе, остальные запросы ждут в ограниченной очереди (FIFO). При переполнении
+# очереди - 429, при истечении ожидания или срока запроса - 503; в обоих случаях
+# с Retry-After. Запрос, срок которого уже истёк, отбрасывается до подписи
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '1') != '0'
+ADMISSION_CONCURRENCY = int(os.environ.get('ADMISSION_CONCURRENCY', 4))
+ADMISSION_QUEUE_DEPTH = int(os.environ.get('ADMISSION_QUEUE_DEPTH', 64))
+# Максимальное ожидание в очереди, секунды
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2))
+# Заголовок, в котором клиент передаёт, сколько секунд он готов ждать ответ
+DEADLINE_HEADER = 'X-Request-Timeout'
+# Сглаживание оценки времени обработки для Retry-After
+SERVICE_TIME_ALPHA = 0.1
+
+
+class Rejected(Exception):
+    """Запрос не допущен: код ответа, сообщение и рекомендуемая пауза"""
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('event', 'granted')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+
+admission_requests = metrics.registry.counter('admission_requests_total', 'Решения о допуске к подписи',
+                                              ('result',))
+admission_wait = metrics.registry.histogram('admission_wait_seconds', 'Ожидание допуска к подписи')
+
+
+class AdmissionController:
+    """Ограничение числа одновременных подписей с очередью ожидания"""
+    def __init__(self, concurrency=ADMISSION_CONCURRENCY, queue_depth=ADMISSION_QUEUE_DEPTH,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.concurrency = max(1, concurrency)
+        self.queue_depth = max(0, queue_depth)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._queue = deque()
+        self._lock = threading.Lock()
+        # Оценка времени обработки одного запроса, секунды
+        self.service_time = 0.01
+
+    def retry_after(self):
+        """Пауза перед повтором: время на разбор текущей очереди, не меньше секунды"""
+        with self._lock:
+            backlog = len(self._queue) + self.active
+        return max(1, math.ceil(backlog * self.service_time / self.concurrency))
+
+    def acquire(self, deadline=None):
+        """Ожидание допуска до deadline (time.monotonic); Rejected, если допуск невозможен"""
+        now = time.monotonic()
+        if deadline is not None and deadline <= now:
+            admission_requests.inc('expired')
+            raise Rejected(503, "Срок запроса истёк", self.retry_after())
+
+        with self._lock:
+            if self.active < self.concurrency and not self._queue:
+                self.active += 1
+                admission_requests.inc('admitted')
+                admission_wait.observe(0.0)
+                return
+            if len(self._queue) >= self.queue_depth:
+                admission_requests.inc('rejected')
+                queued = True
+            else:
+                waiter = _Waiter()
+                self._queue.append(waiter)
+                queued = False
+        if queued:
+            raise Rejected(429, "Очередь подписи заполнена", self.retry_after())
+
+        timeout = self.queue_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - now)
+        waiter.event.wait(max(0.0, timeout))
+        with self._lock:
+            if not waiter.granted:
+                self._queue.remove(waiter)
+        if not waiter.granted:
+            expired = deadline is not None and deadline <= time.monotonic()
+            admission_requests.inc('expired' if expired else 'timeout')
+            message = "Срок запроса истёк в очереди" if expired else "Превышено время ожидания в очереди подписи"
+            raise Rejected(503, message, self.retry_after())
+        if deadline is not None and deadline <= time.monotonic():
+            # Клиент уже не ждёт ответ: место передаётся следующему без подписи
+            self.release()
+            admission_requests.inc('expired')
+            raise Rejected(503, "Срок запроса истёк в очереди", self.retry_after())
+        admission_requests.inc('admitted')
+        admission_wait.observe(time.monotonic() - now)
+
+    def release(self, elapsed=None):
+        """Освобождение места; оно передаётся первому ожидающему"""
+        with self._lock:
+            if elapsed is not None:
+                self.service_time += SERVICE_TIME_ALPHA * (elapsed - self.service_time)
+            if self._queue:
+                waiter = self._queue.popleft()
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self.active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self.active,
+                "queued": len(self._queue),
+                "concurrency": self.concurrency,
+                "queue_depth": self.queue_depth,
+                "service_time": round(self.service_time, 6),
+            }
+
+
+# Общий контроллер допуска к подписи
+admission = AdmissionController()
+
+metrics.registry.collected('admission_active', 'Подписи в работе', 'gauge',
+                           lambda: [((), admission.stats()['active'])])
+metrics.registry.collected('admission_queued', 'Запросы в очереди подписи', 'gauge',
+                           lambda: [((), admission.stats()['queued'])])
+
+
+def request_deadline(headers, arrived):
+    """Срок запроса (time.monotonic) по заголовку X-Request-Timeout или None"""
+    value = headers.get(DEADLINE_HEADER)
+    if value is None:
+        return None
+    try:
+        timeout = float(value)
+    except ValueError:
+        return None
+    return arrived + timeout if timeout > 0 and math.isfinite(timeout) else None
+
+
+def admitted(func):
+    """Декоратор маршрута Flask: подпись выполняется только после допуска"""
+    from flask import g, request
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ADMISSION_ENABLED:
+            return func(*args, **kwargs)
+        arrived = g.get('arrived', time.monotonic())
+        try:
+            admission.acquire(request_deadline(request.headers, arrived))
+        except Rejected as e:
+            return {"status": "error", "message": e.message}, e.status, {'Retry-After': str(e.retry_after)}
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            admission.release(time.monotonic() - start)
+    return wrapper
+
+
+def install(app):
+    """Время поступления запроса - начало отсчёта его срока"""
+    from flask import g
+
+    @app.before_request
+    def _mark_arrival():
+        g.arrived = time.monotonic()
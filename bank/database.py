@@ -0,0 +1,194 @@
+import os
+import time
+import atexit
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+DB_PATH = os.environ.get('DB_PATH', 'bank.db')
+# Пакетная фиксация: не более DB_COMMIT_BATCH операций или DB_COMMIT_INTERVAL секунд на один COMMIT
+DB_COMMIT_BATCH = int(os.environ.get('DB_COMMIT_BATCH', 64))
+DB_COMMIT_INTERVAL = float(os.environ.get('DB_COMMIT_INTERVAL', 0.01))
+# Подтверждение после записи на диск (по умолчанию): операция завершается, когда её пакет
+# зафиксирован с fsync журнала WAL (один fsync на пакет, а не на запрос). DB_DURABLE=0 -
+# ответ до фиксации: быстрее, но погашение или зачисление, подтверждённое перед сбоем, может быть потеряно
+DB_DURABLE = os.environ.get('DB_DURABLE', '1') != '0'
+# Контрольная точка WAL раз в столько страниц: ограничивает журнал, который SQLite
+# дочитывает при запуске после сбоя
+DB_WAL_AUTOCHECKPOINT = int(os.environ.get('DB_WAL_AUTOCHECKPOINT', 1000))
+
+
+class Database:
+    """Общее подключение к SQLite (режим WAL) для хранилищ банка.
+
+    Операции выполняются в точках сохранения внутри общей транзакции,
+    которая фиксируется пакетом: по числу операций или по времени.
+    В режиме durable операция ждёт фиксации своего пакета (групповая фиксация):
+    пакет фиксируется, как только не остаётся операций, ожидающих подключения,
+    поэтому одиночный запрос не ждёт интервала, а под нагрузкой пакет растёт.
+    """
+    def __init__(self, path=DB_PATH, commit_batch=DB_COMMIT_BATCH, commit_interval=DB_COMMIT_INTERVAL,
+                 durable=DB_DURABLE):
+        self.path = path
+        self.commit_batch = max(1, commit_batch)
+        self.commit_interval = commit_interval
+        self.durable = durable
+        self.lock = threading.RLock()
+        # Номер открытого пакета и последнего зафиксированного
+        self._batch_id = 1
+        self._committed = 0
+        self._commit_cond = threading.Condition()
+        # Число операций, ожидающих подключения
+        self._queued = 0
+        self._queue_lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._depth = 0
+        self._pending = 0
+        self._batch_started = 0.0
+        self._flusher = None
+        self._rollback_hooks = []
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Блокировка могла быть захвачена потоком, которого нет в дочернем процессе
+        self.lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self._depth = 0
+        self._pending = 0
+        self._flusher = None
+        self._commit_cond = threading.Condition()
+        self._queued = 0
+        self._queue_lock = threading.Lock()
+
+    def use_shared_mode(self):
+        """Несколько процессов: каждая операция фиксируется сразу, чтобы не удерживать запись"""
+        self.commit_batch = 1
+
+    def on_rollback(self, callback):
+        """Регистрация сброса кэша при откате операции"""
+        self._rollback_hooks.append(callback)
+
+    def connection(self):
+        """Подключение текущего процесса (после fork открывается заново)"""
+        with self.lock:
+            if self._conn is None or self._pid != os.getpid():
+                dirname = os.path.dirname(self.path)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(f"PRAGMA synchronous={'FULL' if self.durable else 'NORMAL'}")
+                conn.execute(f'PRAGMA wal_autocheckpoint={DB_WAL_AUTOCHECKPOINT}')
+                conn.execute('PRAGMA busy_timeout=5000')
+                self._conn = conn
+                self._pid = os.getpid()
+                self._depth = 0
+                self._pending = 0
+                self._flusher = None
+                logger.info(f"Открыта база данных: {self.path}")
+            return self._conn
+
+    @contextmanager
+    def transaction(self):
+        """Атомарная операция; вложенные вызовы входят во внешнюю операцию"""
+        ticket = None
+        with self._queue_lock:
+            self._queued += 1
+        with self.lock:
+            with self._queue_lock:
+                self._queued -= 1
+            conn = self.connection()
+            if self._depth == 0:
+                if not conn.in_transaction:
+                    conn.execute('BEGIN IMMEDIATE')
+                    self._batch_started = time.monotonic()
+                conn.execute('SAVEPOINT operation')
+            self._depth += 1
+            try:
+                yield conn
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    conn.execute('ROLLBACK TO operation')
+                    conn.execute('RELEASE operation')
+                    for callback in self._rollback_hooks:
+                        callback()
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                conn.execute('RELEASE operation')
+                self._pending += 1
+                ticket = self._batch_id
+                # Последняя операция очереди фиксирует пакет сразу: ждать больше некого
+                if (self._pending >= self.commit_batch
+                        or (self.durable and not self._queued)
+                        or time.monotonic() - self._batch_started >= self.commit_interval):
+                    self._commit()
+                else:
+                    self._start_flusher()
+        if self.durable and ticket is not None:
+            self._wait_committed(ticket)
+
+    def _commit(self):
+        if self._conn is not None and self._conn.in_transaction:
+            self._conn.execute('COMMIT')
+        self._pending = 0
+        with self._commit_cond:
+            self._committed = self._batch_id
+            self._batch_id += 1
+            self._commit_cond.notify_all()
+
+    def _wait_committed(self, ticket):
+        """Ожидание фиксации пакета, в который вошла операция"""
+        while True:
+            with self._commit_cond:
+                if self._commit_cond.wait_for(lambda: self._committed >= ticket, self.commit_interval * 2):
+                    return
+            # Фоновая фиксация не успела (например, поток ещё не запущен): фиксируем сами
+            self.flush()
+
+    def _start_flusher(self):
+        # Фоновый поток фиксирует неполный пакет по истечении интервала
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='db-flusher', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.commit_interval)
+            with self.lock:
+                if self._pid != pid or self._conn is None:
+                    break
+                if self._depth == 0 and self._pending:
+                    self._commit()
+
+    def flush(self):
+        """Немедленная фиксация накопленных операций"""
+        with self.lock:
+            if self._depth == 0 and self._conn is not None and self._pid == os.getpid():
+                self._commit()
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.connection().execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._commit()
+                self._conn.close()
+            self._conn = None
+
+
+# Общая база данных банка
+database = Database()
+atexit.register(database.close)
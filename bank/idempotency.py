@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+import metrics
+from database import database
+
+# Идемпотентность запросов подписи: ответ на запрос с заголовком Idempotency-Key
+# сохраняется, повтор с тем же ключом получает сохранённый ответ без повторной
+# подписи. Одновременные запросы с одним ключом ждут первый. Ответы хранятся
+# в памяти процесса (LRU с TTL) и, при включённом постоянном уровне, в базе -
+# он нужен, когда повтор может попасть в другой рабочий процесс или после перезапуска
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 3600))
+IDEMPOTENCY_PERSISTENT = os.environ.get('IDEMPOTENCY_PERSISTENT', '0') != '0'
+# Сколько ждать завершения запроса с тем же ключом; незавершённая запись в базе
+# старше этого срока считается оставленной упавшим процессом
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 30))
+IDEMPOTENCY_POLL_INTERVAL = 0.01
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# Просроченные записи удаляются из базы раз в столько сохранений
+PURGE_EVERY = 1000
+
+
+class IdempotencyConflict(Exception):
+    """Ключ уже использован с другим телом запроса"""
+
+
+class IdempotencyInProgress(Exception):
+    """Запрос с тем же ключом ещё выполняется"""
+
+
+class _Entry:
+    __slots__ = ('fingerprint', 'status', 'payload', 'expires')
+
+    def __init__(self, fingerprint, status, payload, expires):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.payload = payload
+        self.expires = expires
+
+
+def fingerprint(data):
+    """Отпечаток тела запроса (не зависит от формата JSON/msgpack и порядка полей)"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).digest()
+
+
+class IdempotencyCache:
+    """Сохранённые ответы по ключам идемпотентности"""
+    def __init__(self, db=database, size=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL,
+                 persistent=IDEMPOTENCY_PERSISTENT, wait=IDEMPOTENCY_WAIT):
+        self.db = db
+        self.size = size
+        self.ttl = ttl
+        self.persistent = persistent
+        self.wait = wait
+        self._entries = OrderedDict()
+        self._inflight = {}  # ключ -> (отпечаток, событие завершения)
+        self._lock = threading.Lock()
+        self._stores = 0
+        self.replayed = 0
+        self.executed = 0
+        self.coalesced = 0
+        self.conflicts = 0
+
+    def initialize(self):
+        """Создание таблицы постоянного уровня"""
+        if not self.persistent:
+            return
+        with self.db.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS idempotency_keys (
+                    key TEXT PRIMARY KEY,
+                    fingerprint BLOB NOT NULL,
+                    status INTEGER,
+                    body TEXT,
+                    created REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+
+    def execute(self, key, request_fingerprint, compute):
+        """Ответ для ключа: сохранённый или вычисленный compute() -> (код, тело).
+
+        Возвращает (код, тело, повтор ли). Сохраняются только успешные ответы,
+        после ошибки повтор с тем же ключом выполняется заново.
+        """
+        deadline = time.monotonic() + self.wait
+        while True:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    self._check(entry.fingerprint, request_fingerprint)
+                    self.replayed += 1
+                    return entry.status, entry.payload, True
+                inflight = self._inflight.get(key)
+                if inflight is None:
+                    event = threading.Event()
+                    self._inflight[key] = (request_fingerprint, event)
+                    break
+                self._check(inflight[0], request_fingerprint)
+                self.coalesced += 1
+            # Такой же запрос уже выполняется в этом процессе - ждём его ответ
+            if not inflight[1].wait(max(0.0, deadline - time.monotonic())):
+                raise IdempotencyInProgress()
+
+        claimed = False
+        try:
+            if self.persistent:
+                stored = self._claim(key, request_fingerprint, deadline)
+                if stored is not None:
+                    status, payload = stored
+                    with self._lock:
+                        self._remember(key, request_fingerprint, status, payload)
+                        self.replayed += 1
+                    return status, payload, True
+                claimed = True
+
+            status, payload = compute()
+            with self._lock:
+                self.executed += 1
+                if status == 200:
+                    self._remember(key, request_fingerprint, status, payload)
+            if claimed:
+                if status == 200:
+                    self._complete(key, status, payload)
+                else:
+                    self._release(key)
+                claimed = False
+            return status, payload, False
+        finally:
+            if claimed:
+                self._release(key)
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def _check(self, stored_fingerprint, request_fingerprint):
+        if stored_fingerprint != request_fingerprint:
+            self.conflicts += 1
+            raise IdempotencyConflict()
+
+    # Уровень в памяти (вызывается под self._lock)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remember(self, key, request_fingerprint, status, payload):
+        self._entries[key] = _Entry(request_fingerprint, status, payload, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    # Постоянный уровень
+
+    def _claim(self, key, request_fingerprint, deadline):
+        """Захват ключа в базе; None - захвачен, иначе сохранённый (код, тело)"""
+        while True:
+            now = time.time()
+            with self.db.transaction() as conn:
+                # Просроченный ответ и брошенный упавшим процессом захват освобождают ключ
+                conn.execute('DELETE FROM idempotency_keys WHERE key = ? '
+                             'AND (created < ? OR (body IS NULL AND created < ?))',
+                             (key, now - self.ttl, now - self.wait))
+                cursor = conn.execute('INSERT OR IGNORE INTO idempotency_keys (key, fingerprint, created) '
+                                      'VALUES (?, ?, ?)', (key, request_fingerprint, now))
+                if cursor.rowcount == 1:
+                    return None
+                row = conn.execute('SELECT fingerprint, status, body FROM idempotency_keys WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is not None:
+                stored_fingerprint, status, body = row
+                with self._lock:
+                    self._check(bytes(stored_fingerprint), request_fingerprint)
+                if body is not None:
+                    return status, json.loads(body)
+            # Запрос с тем же ключом выполняет другой процесс
+            if time.monotonic() >= deadline:
+                raise IdempotencyInProgress()
+            time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+    def _complete(self, key, status, payload):
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.execute('UPDATE idempotency_keys SET status = ?, body = ?, created = ? WHERE key = ?',
+                         (status, json.dumps(payload), now, key))
+            self._stores += 1
+            if self._stores % PURGE_EVERY == 0:
+                conn.execute('DELETE FROM idempotency_keys WHERE created < ?', (now - self.ttl,))
+
+    def _release(self, key):
+        try:
+            with self.db.transaction() as conn:
+                conn.execute('DELETE FROM idempotency_keys WHERE key = ? AND body IS NULL', (key,))
+        except Exception as e:
+            logger.error(f"Не удалось освободить ключ идемпотентности: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "replayed": self.replayed,
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "conflicts": self.conflicts,
+                "size": len(self._entries),
+                "persistent": self.persistent,
+            }
+
+
+# Общий кэш ответов
+idempotency_cache = IdempotencyCache()
+
+
+def _stats():
+    stats = idempotency_cache.stats()
+    return [((name,), stats[name]) for name in ('replayed', 'executed', 'coalesced', 'conflicts')]
+
+
+metrics.registry.collected('idempotent_requests_total', 'Запросы с ключом идемпотентности',
+                           'counter', _stats, ('result',))
+
+
+def idempotent(scope):
+    """Декоратор маршрута Flask: успешный ответ на запрос с Idempotency-Key сохраняется.
+
+    Маршрут возвращает тело ответа (dict), (тело, код) или (тело, код, заголовки).
+    """
+    from flask import request
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_HEADER)
+            if key is None:
+                return func(*args, **kwargs)
+            if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                return {"status": "error",
+                        "message": f"Некорректный {IDEMPOTENCY_HEADER}: от 1 до {IDEMPOTENCY_KEY_MAX_LENGTH} символов"}, 400
+
+            extra_headers = {}
+
+            def compute():
+                result = func(*args, **kwargs)
+                if not isinstance(result, tuple):
+                    result = (result, 200)
+                if len(result) > 2:
+                    extra_headers.update(result[2])
+                return result[1], result[0]
+
+            try:
+                status, payload, replayed = idempotency_cache.execute(
+                    f"{scope}:{key}", fingerprint(request.get_json(silent=True)), compute)
+            except IdempotencyConflict:
+                return {"status": "error",
+                        "message": f"{IDEMPOTENCY_HEADER} уже использован с другим запросом"}, 422
+            except IdempotencyInProgress:
+                # 503, а не 409: для погашения 409 означает «банкнота уже потрачена»
+                return {"status": "error",
+                        "message": f"Запрос с этим {IDEMPOTENCY_HEADER} ещё выполняется"}, 503, {'Retry-After': '1'}
+            headers = {'Idempotent-Replayed': 'true'} if replayed else extra_headers
+            return payload, status, headers
+        return wrapper
+    return decorator
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from math import gcd
+import paymentMath as pm
+
+# Хранилище ключей подписи банка. Ключи лежат в JSON-файле вместе с производными
+# значениями (phi, q^-1 mod p, обратная к h экспонента и её вычеты для CRT),
+# поэтому при запуске они не пересчитываются. Каждый ключ имеет идентификатор,
+# который передаётся в запросах и ответах подписи.
+#
+# Ротация без остановки: новый ключ добавляется в файл и становится основным,
+# прежние остаются действующими, пока клиенты не перейдут на новый. Серверы
+# перечитывают файл при его изменении (проверка не чаще KEY_STORE_RELOAD_INTERVAL).
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+KEY_STORE_PATH = os.environ.get('KEY_STORE_PATH', 'keys.json')
+KEY_STORE_RELOAD_INTERVAL = float(os.environ.get('KEY_STORE_RELOAD_INTERVAL', 5))
+# Длина модуля новых ключей, бит
+KEY_BITS = int(os.environ.get('KEY_BITS', 512))
+
+FORMAT_VERSION = 1
+
+# Действующий ключ подписывает новые банкноты; выведенный только хранится:
+# его открытые параметры нужны для проверки банкнот, выпущенных ранее
+ACTIVE = 'active'
+RETIRED = 'retired'
+
+
+def key_id(n, e):
+    """Идентификатор ключа: отпечаток открытых параметров (клиент проверяет его сам)"""
+    return hashlib.sha256(f"{n}:{e}".encode()).hexdigest()[:16]
+
+
+class StoredKey:
+    """Ключ хранилища: идентификатор, состояние и ключ подписи"""
+    __slots__ = ('kid', 'status', 'created', 'signing')
+
+    def __init__(self, signing, status=ACTIVE, created=None):
+        self.kid = key_id(signing.n, signing.e)
+        self.status = status
+        self.created = int(time.time()) if created is None else created
+        self.signing = signing
+
+    @property
+    def n(self):
+        return self.signing.n
+
+    def public(self):
+        """Открытые параметры ключа"""
+        return {
+            "kid": self.kid,
+            "n": self.signing.n,
+            "e": self.signing.e,
+            "divisors": pm.divisors,
+            "status": self.status,
+        }
+
+    def to_record(self):
+        key = self.signing
+        d, dp, dq = key.e_params
+        return {
+            "kid": self.kid,
+            "status": self.status,
+            "created": self.created,
+            "p": key.p,
+            "q": key.q,
+            "e": key.e,
+            "n": key.n,
+            "phi": key.phi,
+            "q_inv": key.q_inv,
+            "d": d,
+            "dp": dp,
+            "dq": dq,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        signing = pm.SigningKey(record['p'], record['q'], record['e'], q_inv=record['q_inv'],
+                                e_params=(record['d'], record['dp'], record['dq']))
+        key = cls(signing, record.get('status', ACTIVE), record.get('created'))
+        if key.kid != record['kid'] or signing.n != record['n'] or signing.phi != record['phi']:
+            raise ValueError(f"Ключ {record['kid']}: параметры не соответствуют идентификатору")
+        # Быстрая проверка сохранённых производных значений: подпись по CRT и её проверка
+        if pow(signing.sign(2), signing.e, signing.n) != 2:
+            raise ValueError(f"Ключ {key.kid}: сохранённые параметры подписи повреждены")
+        return key
+
+
+def generate_key(bits=KEY_BITS, e=pm.h):
+    """Новый ключ подписи с p - 1 и q - 1, взаимно простыми с e"""
+    from Crypto.Util.number import getPrime
+
+    def prime(size):
+        while True:
+            candidate = getPrime(size)
+            if gcd(candidate - 1, e) == 1:
+                return candidate
+
+    while True:
+        p = prime(bits // 2)
+        q = prime(bits - bits // 2)
+        # Произведение двух простых может оказаться на бит короче
+        if p != q and (p * q).bit_length() == bits:
+            return pm.SigningKey(p, q, e)
+
+
+class KeyStore:
+    """Ключи подписи банка по идентификаторам с перечитыванием файла при изменении"""
+    def __init__(self, path=KEY_STORE_PATH, reload_interval=KEY_STORE_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.keys = {}
+        self.primary = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    # Загрузка и сохранение
+
+    def load(self):
+        """Загрузка ключей из файла; при первом запуске файл создаётся с исходным ключом банка"""
+        with self._lock:
+            if not os.path.exists(self.path):
+                logger.info(f"Файл ключей {self.path} не найден, создание из исходного ключа банка")
+                key = StoredKey(pm.SigningKey(pm.p, pm.q, pm.h))
+                self._write({key.kid: key}, key.kid)
+            self._read()
+        return self
+
+    def _read(self):
+        start = time.perf_counter()
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия файла ключей: {data.get('version')}")
+
+        keys = {}
+        for record in data['keys']:
+            current = self.keys.get(record['kid'])
+            if current is not None and current.signing.n == record['n']:
+                # Ключ уже загружен: сохраняем его кэш экспонент сдачи
+                key = StoredKey(current.signing, record.get('status', ACTIVE), record.get('created'))
+            else:
+                key = StoredKey.from_record(record)
+            keys[key.kid] = key
+        primary = data['primary']
+        if keys.get(primary) is None or keys[primary].status != ACTIVE:
+            raise ValueError(f"Основной ключ {primary} отсутствует или не действует")
+
+        self.keys, self.primary = keys, primary
+        self._mtime = mtime
+        self._checked = time.monotonic()
+        logger.info(f"Загружено ключей: {len(keys)}, основной {primary} "
+                    f"({(time.perf_counter() - start) * 1000:.1f} мс)")
+
+    def _write(self, keys, primary):
+        """Атомарная запись файла ключей (только для владельца)"""
+        data = {
+            "version": FORMAT_VERSION,
+            "primary": primary,
+            "keys": [key.to_record() for key in keys.values()],
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def maybe_reload(self, force=False):
+        """Перечитывание файла, если он изменился (проверка не чаще reload_interval)"""
+        now = time.monotonic()
+        if not force and now - self._checked < self.reload_interval:
+            return
+        with self._lock:
+            self._checked = now
+            try:
+                if os.stat(self.path).st_mtime_ns != self._mtime:
+                    self._read()
+            except (OSError, ValueError, KeyError) as e:
+                # Испорченный файл не должен останавливать подпись: работаем с загруженными ключами
+                logger.error(f"Не удалось перечитать файл ключей {self.path}: {str(e)}")
+
+    def _ensure_loaded(self):
+        if self.primary is None:
+            self.load()
+
+    # Доступ к ключам
+
+    def get(self, kid=None):
+        """Ключ по идентификатору (по умолчанию - основной) или None"""
+        self._ensure_loaded()
+        self.maybe_reload()
+        if kid is None:
+            return self.keys[self.primary]
+        key = self.keys.get(kid)
+        if key is None:
+            # Ключ мог быть добавлен только что другим процессом
+            self.maybe_reload(force=True)
+            key = self.keys.get(kid)
+        return key
+
+    def signing_key(self, kid=None):
+        """Действующий ключ для подписи; ValueError для неизвестного или выведенного ключа"""
+        key = self.get(kid)
+        if key is None:
+            raise ValueError(f"Неизвестный ключ: {kid}")
+        if key.status != ACTIVE:
+            raise ValueError(f"Ключ {kid} выведен из обращения")
+        return key
+
+    def public_keys(self):
+        self._ensure_loaded()
+        self.maybe_reload()
+        return [key.public() for key in self.keys.values()]
+
+    def max_modulus(self):
+        """Наибольший модуль среди ключей (граница серийных номеров)"""
+        self._ensure_loaded()
+        self.maybe_reload()
+        return max(key.n for key in self.keys.values())
+
+    def stats(self):
+        """Суммарная статистика кэшей экспонент сдачи по всем ключам"""
+        self._ensure_loaded()
+        total = {"hits": 0, "misses": 0, "size": 0, "capacity": 0, "faults": 0}
+        for key in list(self.keys.values()):
+            for name, value in key.signing.stats().items():
+                total[name] += value
+        total["keys"] = {kid: key.status for kid, key in self.keys.items()}
+        total["primary"] = self.primary
+        return total
+
+    # Ротация (выполняется утилитой командной строки)
+
+    def rotate(self, bits=KEY_BITS):
+        """Новый основной ключ; прежние ключи остаются действующими"""
+        self.load()
+        key = StoredKey(generate_key(bits))
+        with self._lock:
+            keys = dict(self.keys)
+            keys[key.kid] = key
+            self._write(keys, key.kid)
+            self._read()
+        return key
+
+    def set_status(self, kid, status):
+        self.load()
+        with self._lock:
+            key = self.keys.get(kid)
+            if key is None:
+                raise ValueError(f"Неизвестный ключ: {kid}")
+            if kid == self.primary and status != ACTIVE:
+                raise ValueError("Нельзя вывести основной ключ, сначала выполните ротацию")
+            key.status = status
+            self._write(self.keys, self.primary)
+            self._read()
+        return key
+
+
+def sign_blinded(kid, blinded_msg):
+    """Подпись затенённой банкноты ключом kid (выполняется и в процессах подписи)"""
+    return key_store.signing_key(kid).signing.sign(blinded_msg)
+
+
+def sign_change(kid, blinded_change, change_exp):
+    """Подпись затенённой сдачи ключом kid"""
+    return key_store.signing_key(kid).signing.sign_with(blinded_change, change_exp)
+
+
+# Общее хранилище ключей (загружается при первом обращении)
+key_store = KeyStore()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Управление ключами подписи банка")
+    parser.add_argument('--path', default=KEY_STORE_PATH, help='Файл ключей')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='Список ключей')
+    rotate = commands.add_parser('rotate', help='Новый основной ключ, прежние остаются действующими')
+    rotate.add_argument('--bits', type=int, default=KEY_BITS, help='Длина модуля, бит')
+    retire = commands.add_parser('retire', help='Вывод ключа из обращения (подпись им прекращается)')
+    retire.add_argument('kid')
+    activate = commands.add_parser('activate', help='Возврат выведенного ключа в обращение')
+    activate.add_argument('kid')
+    args = parser.parse_args()
+
+    store = KeyStore(args.path)
+    try:
+        if args.command == 'rotate':
+            key = store.rotate(args.bits)
+            print(f"Новый основной ключ: {key.kid}")
+        elif args.command == 'retire':
+            store.set_status(args.kid, RETIRED)
+        elif args.command == 'activate':
+            store.set_status(args.kid, ACTIVE)
+        else:
+            store.load()
+    except ValueError as e:
+        print(f"Ошибка: {str(e)}")
+        sys.exit(1)
+
+    for kid, key in store.keys.items():
+        marker = '*' if kid == store.primary else ' '
+        print(f"{marker} {kid}  {key.status:8}  {key.n.bit_length()} бит  "
+              f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(key.created))}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import logging
+import metrics
+from database import database
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class InsufficientFundsError(Exception):
+    """Недостаточно средств на счёте"""
+
+
+class AccountNotFoundError(Exception):
+    """Счёт не найден"""
+
+
+class Account:
+    __slots__ = ('id', 'start_money', 'balance')
+
+    def __init__(self, id, start_money, balance):
+        self.id = id
+        self.start_money = start_money
+        self.balance = balance
+
+
+class AccountStore:
+    """Счета клиентов: индекс по id в SQLite и кэш в памяти со сквозным чтением"""
+    def __init__(self, db=database):
+        self.db = db
+        self._cache = {}
+        # Кэш отключается, если счета меняют несколько процессов
+        self.cache_enabled = True
+        # Кэш мог получить изменения откатываемой операции
+        db.on_rollback(self._cache.clear)
+
+    def initialize(self):
+        with self.db.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS accounts (
+                    id TEXT PRIMARY KEY,
+                    start_money INTEGER NOT NULL,
+                    balance INTEGER NOT NULL
+                )
+            ''')
+        count = self.db.query('SELECT COUNT(*) FROM accounts')[0][0]
+        logger.info(f"Счета клиентов загружены: {count} записей")
+
+    def get(self, account_id):
+        """Счёт по id или None"""
+        if self.cache_enabled:
+            account = self._cache.get(account_id)
+            metrics.cache_hit('accounts', account is not None)
+            if account is not None:
+                return account
+        with self.db.lock:
+            rows = self.db.query('SELECT id, start_money, balance FROM accounts WHERE id = ?', (account_id,))
+            if not rows:
+                return None
+            account = Account(*rows[0])
+            if self.cache_enabled:
+                self._cache[account_id] = account
+            return account
+
+    def create(self, account_id, start_money):
+        """Создание счёта; возвращает (счёт, создан ли новый)"""
+        with self.db.transaction() as conn:
+            existing = self.get(account_id)
+            if existing is not None:
+                return existing, False
+            conn.execute('INSERT INTO accounts (id, start_money, balance) VALUES (?, ?, ?)',
+                         (account_id, start_money, start_money))
+            account = Account(account_id, start_money, start_money)
+            if self.cache_enabled:
+                self._cache[account_id] = account
+            return account, True
+
+    def adjust_balance(self, account_id, delta):
+        """Атомарное изменение баланса на delta, возвращает новый баланс"""
+        with self.db.transaction() as conn:
+            account = self.get(account_id)
+            if account is None:
+                raise AccountNotFoundError(account_id)
+            balance = account.balance + delta
+            if balance < 0:
+                raise InsufficientFundsError(account_id)
+            conn.execute('UPDATE accounts SET balance = ? WHERE id = ?', (balance, account_id))
+            account.balance = balance
+            return balance
+
+
+# Общее хранилище счетов
+account_store = AccountStore()
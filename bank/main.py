@@ -6,27 +6,57 @@ import logging
 import signal
 from Crypto.PublicKey import RSA
 from service import bank_service
+from database import database
+from keyStore import key_store
+import prefork
+import metrics
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def run_server():
+# Число рабочих процессов: 1 - один процесс, 0 - по числу ядер
+BANK_WORKERS = int(os.environ.get('BANK_WORKERS', 1))
+
+def run_server(workers=BANK_WORKERS):
     """Запуск серверной части (API)"""
     import server
     logger.info("Запуск банковского сервера...")
-    
-    # Инициализация базы данных
-    # bank_service.initialize_database()
+    workers = prefork.resolve_workers(workers)
+    # Ключи с готовыми параметрами подписи загружаются до fork
+    key_store.load()
+
+    if workers == 1:
+        # Инициализация базы данных
+        bank_service.initialize_database()
+
+        # Запуск Flask приложения
+        server.app.run(host='0.0.0.0', port=server.BANK_PORT, debug=False, use_reloader=False)
+        return
+
+    # Ключи и приложение загружены до fork; счета и потраченные банкноты - только в базе
+    bank_service.use_shared_state()
+    bank_service.initialize_database()
+    database.close()
+    sock = prefork.listen('0.0.0.0', server.BANK_PORT)
+
+    def worker():
+        # Метрики рабочего процесса видны через любой процесс
+        metrics.registry.share(prefork.shared_dir)
+        try:
+            prefork.serve_wsgi(server.app, sock)
+        finally:
+            database.close()
 
-    # Запуск Flask приложения
-    server.app.run(host='0.0.0.0', port=8080, debug=False, use_reloader=False)
+    prefork.serve(worker, workers, name='bank')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Запуск банковского сервера")
     parser.add_argument('--debug', action='store_true', 
                         help='Запуск в режиме отладки')
+    parser.add_argument('--workers', '-w', type=int, default=BANK_WORKERS,
+                        help='Число рабочих процессов (0 - по числу ядер)')
     
     args = parser.parse_args()
     
@@ -39,7 +69,7 @@ if __name__ == "__main__":
 
 
     try:
-        run_server()
+        run_server(args.workers)
     except Exception as e:
         logger.error(f"Ошибка при запуске сервера: {str(e)}")
         sys.exit(1) 
\ No newline at end of file
@@ -1,18 +1,39 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
 from math import gcd
-from functools import reduce
+from functools import reduce, lru_cache
+from denominations import DenominationCodec
 
 # Массив делителей (доступен и клиенту, и серверу)
 divisors = [3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67,
             71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131, 137,
             139, 149, 151, 157, 163, 167, 173]
 
-# Параметры системы (секретные для сервера)
+# Исходный ключ банка (секретный). Рабочие ключи хранятся в keyStore,
+# этот ключ становится первым ключом при создании хранилища
 p = 91480584166578905373273495367858856924625303800544241237892516956359041631323
 q = 80239100220322239951066602079734678804545438199680465293877204586565106798709
 # открытый ключ
 n = p * q
 phi = (p - 1) * (q - 1)
 h = reduce(lambda x, y: x * y, divisors) # e - открытый ключ
+# Кодек номиналов: по экспоненте сдачи банк определяет её сумму
+codec = DenominationCodec(divisors)
+
+# Размер кэша обратных экспонент для сдачи
+SIGNING_CACHE_SIZE = int(os.environ.get('SIGNING_CACHE_SIZE', 1024))
+# Проверка подписи, вычисленной по CRT (защита от сбоев)
+SIGNING_CRT_CHECK = os.environ.get('SIGNING_CRT_CHECK', '1') != '0'
+
+# Серийный номер банкноты - хэш случайной строки nonce по модулю ключа (FDH).
+# Лишние байты хэша делают распределение по модулю равномерным
+FDH_EXTRA_BYTES = 16
+NONCE_MAX_LENGTH = 128
+
+logger = logging.getLogger(__name__)
 
 # Серверные функции
 def mod_inverse(a, m):
@@ -26,10 +47,123 @@ def mod_inverse(a, m):
     _, x, _ = extended_gcd(a, m)
     return (x % m + m) % m
 
-def bank_sign_blinded(blinded_msg):
-    h_inv = mod_inverse(h, phi)
-    return pow(blinded_msg, h_inv, n)
 
-def bank_sign_change(blinded_change, change_exp):
-    change_exp_inv = mod_inverse(change_exp, phi)
-    return pow(blinded_change, change_exp_inv, n)
\ No newline at end of file
+def full_domain_hash(nonce, n):
+    """Серийный номер банкноты: хэш nonce, растянутый на всю область модуля n (FDH).
+
+    Корень из серийного номера нельзя получить без банка ни для какого nonce,
+    поэтому по nonce проверяется, что платёж сделан из банкноты, подписанной банком
+    """
+    size = (n.bit_length() + 7) // 8 + FDH_EXTRA_BYTES
+    digest = hashlib.shake_256(f"{n}:{nonce}".encode()).digest(size)
+    return int.from_bytes(digest, 'big') % n
+
+
+def check_nonce(nonce):
+    """Сообщение об ошибке в nonce банкноты или None"""
+    if not isinstance(nonce, str) or not 0 < len(nonce) <= NONCE_MAX_LENGTH:
+        return f"nonce должен быть непустой строкой длиной до {NONCE_MAX_LENGTH} символов"
+    return None
+
+
+@lru_cache(maxsize=1024)
+def payment_check_exponent(note_exp, payment_exp):
+    """Экспонента проверки платежа: note_exp // payment_exp (с кэшированием).
+
+    Платёж на все биты банкноты (payment_exp == note_exp) совпал бы с серийным номером
+    и ничего не доказывал бы, поэтому в этом случае платёж - сама подпись банкноты,
+    она проверяется экспонентой note_exp
+    """
+    check_exp = note_exp // payment_exp
+    return check_exp if check_exp > 1 else note_exp
+
+
+class SigningKey:
+    """Ключ подписи банка.
+
+    Обратная к h экспонента считается один раз при создании ключа,
+    обратные к экспонентам сдачи хранятся в ограниченном LRU-кэше.
+    Подпись выполняется по китайской теореме об остатках (CRT):
+    возведение в степень идёт отдельно по модулям p и q.
+    """
+    def __init__(self, p, q, e, cache_size=SIGNING_CACHE_SIZE, crt_check=SIGNING_CRT_CHECK,
+                 q_inv=None, e_params=None):
+        self.p = p
+        self.q = q
+        self.n = p * q
+        self.phi = (p - 1) * (q - 1)
+        # Готовые q^-1 mod p и (d, dp, dq) передаются при загрузке ключа из хранилища
+        self.q_inv = mod_inverse(q, p) if q_inv is None else q_inv
+        self.e = e
+        self.e_params = self._exponent_params(e) if e_params is None else tuple(e_params)
+        self.e_inv = self.e_params[0]
+        self.crt_check = crt_check
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.faults = 0
+
+    def _exponent_params(self, exp):
+        """(d, dp, dq) для экспоненты exp"""
+        d = mod_inverse(exp, self.phi)
+        return d, d % (self.p - 1), d % (self.q - 1)
+
+    def params(self, exp):
+        """Параметры подписи для экспоненты exp (с кэшированием)"""
+        if exp == self.e:
+            return self.e_params
+        with self._lock:
+            exp_params = self._cache.get(exp)
+            if exp_params is not None:
+                self._cache.move_to_end(exp)
+                self.hits += 1
+                return exp_params
+            self.misses += 1
+
+        exp_params = self._exponent_params(exp)
+        with self._lock:
+            self._cache[exp] = exp_params
+            self._cache.move_to_end(exp)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return exp_params
+
+    def inverse(self, exp):
+        """Обратная к exp экспонента по модулю phi (с кэшированием)"""
+        return self.params(exp)[0]
+
+    def _sign_crt(self, msg, exp, exp_params):
+        d, dp, dq = exp_params
+        p, q = self.p, self.q
+        m1 = pow(msg % p, dp, p)
+        m2 = pow(msg % q, dq, q)
+        signature = m2 + (self.q_inv * (m1 - m2) % p) * q
+
+        # Защита от сбоев при вычислении по CRT: проверяем подпись по обоим модулям
+        if self.crt_check and (pow(signature % p, exp, p) != msg % p
+                               or pow(signature % q, exp, q) != msg % q):
+            with self._lock:
+                self.faults += 1
+            logger.error("Подпись по CRT не прошла проверку, повторное вычисление без CRT")
+            signature = pow(msg, d, self.n)
+        return signature
+
+    def sign(self, msg):
+        """Подпись затенённой банкноты (экспонента h)"""
+        return self._sign_crt(msg, self.e, self.e_params)
+
+    def sign_with(self, msg, exp):
+        """Подпись затенённой сдачи с экспонентой exp"""
+        return self._sign_crt(msg, exp, self.params(exp))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._cache),
+                "capacity": self.cache_size,
+                "faults": self.faults,
+            }
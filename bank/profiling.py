@@ -0,0 +1 @@
+../common/profiling.py
\ No newline at end of file
@@ -1,7 +1,14 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import logging
 import os
+import uuid
 from service import *
+import wire
+import metrics
+import profiling
+from keyStore import key_store
+from idempotency import idempotent, idempotency_cache
+import admission
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, 
@@ -10,21 +17,40 @@ logger = logging.getLogger(__name__)
 
 # Создание экземпляра Flask
 app = Flask(__name__)
+wire.install(app)
+metrics.install(app)
+profiling.install(app)
+admission.install(app)
+
+# Конфигурация
+BANK_PORT = int(os.environ.get('BANK_PORT', 8080))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+DEPOSIT_MAX_ITEMS = int(os.environ.get('DEPOSIT_MAX_ITEMS', 1000))
 
 # Базовый маршрут для проверки доступности сервера
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({"status": "online", "message": "Банковский сервер работает"})
 
-# Пример маршрута для будущего использования
+# Разделы статуса складываются по всем рабочим процессам
+metrics.registry.status_section('signing_cache', key_store.stats)
+metrics.registry.status_section('idempotency', idempotency_cache.stats)
+metrics.registry.status_section('admission', admission.admission.stats)
+
+# Статус сервера с текущими показателями
 @app.route('/api/v1/status', methods=['GET'])
 def status():
     return jsonify({
         "status": "ok",
         "version": "1.0.0",
-        "connections": 0
+        **metrics.status(),
     })
 
+# Метрики в формате Prometheus
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/api/v1/create-client', methods=['POST'])
 def create_client():
     data = request.json
@@ -37,62 +63,273 @@ def create_client():
             "message": "start_money is required"
         }), 400
 
-    client =  bank_service.create_client(data['start_money'])
+    start_money = data['start_money']
+    if isinstance(start_money, bool) or not isinstance(start_money, int) or start_money < 0:
+        return jsonify({
+            "status": "error",
+            "message": "start_money должен быть неотрицательным целым"
+        }), 400
+
+    uid = str(data.get('client_id') or uuid.uuid4())
+    client, created = bank_service.create_client(start_money, uid)
+    key = key_store.get()
 
     return jsonify({
         "status": "ok",
-        "id": client['id'],
-        "n": pm.n,
+        "id": client.id,
+        "created": created,
+        "balance": client.balance,
+        "kid": key.kid,
+        "n": key.n,
+        "e": key.signing.e,
         "divisors": pm.divisors,
     })
 
+# Открытые параметры ключей подписи; новые банкноты подписываются основным ключом
+@app.route('/api/v1/keys', methods=['GET'])
+def list_keys():
+    return jsonify({"status": "ok", "primary": key_store.get().kid, "keys": key_store.public_keys()})
+
+@app.route('/api/v1/keys/<kid>', methods=['GET'])
+def get_key(kid):
+    key = key_store.get(kid)
+    if key is None:
+        return jsonify({"status": "error", "message": "Ключ не найден"}), 404
+    return jsonify({"status": "ok", **key.public()})
+
+# Баланс счёта клиента
+@app.route('/api/v1/accounts/<client_id>', methods=['GET'])
+def get_account(client_id):
+    client = bank_service.get_client(client_id)
+    if client is None:
+        return jsonify({"status": "error", "message": "Счёт не найден"}), 404
+
+    return jsonify({
+        "status": "ok",
+        "id": client.id,
+        "balance": client.balance,
+    })
+
 
-# Подпись новой затенённой банкноты
+def client_account_id(data):
+    """Идентификатор счёта, с которого списывается сумма выпуска, или None"""
+    client_id = data.get('client_id')
+    return client_id if client_id and isinstance(client_id, str) else None
+
+# Выпуск банкноты: сумма списывается со счёта клиента, затенённая банкнота подписывается
 @app.route('/api/v1/banknotes', methods=['POST'])
+@idempotent('banknotes')
+@admission.admitted
 def create_new_banknote():
     data = request.json
     if not data:
-        return jsonify({"status": "error", "message": "Не указаны данные для подписи банкноты"}), 400
+        return {"status": "error", "message": "Не указаны данные для подписи банкноты"}, 400
     
     # Проверка необходимых полей
     if 'banknote' not in data:
-        return jsonify({"status": "error", "message": "Нет банкноты"}), 400
+        return {"status": "error", "message": "Нет банкноты"}, 400
     
-    blinded_banknote = data['banknote']
+    client_id = client_account_id(data)
+    if client_id is None:
+        return {"status": "error", "message": "Не указан счёт клиента (client_id)"}, 400
+
+    try:
+        blinded_banknote = int(data['banknote'])
+        amount = bank_service.issue_amount(data.get('amount'))
+        kid = bank_service.signing_key_id(data.get('kid'))
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}, 400
 
     result_verify = bank_service.verify_blinded_banknote(blinded_banknote)
-    if result_verify:
-        signed_banknote = bank_service.sign_banknote(blinded_banknote)
-        return jsonify({"status": "ok", "signed_banknote": signed_banknote}), 200
-    else:
-        return jsonify({"status": "false", "signed_banknote": 0, "message": "Купюра не валидна"}), 200
+    if not result_verify:
+        return {"status": "false", "signed_banknote": 0, "message": "Купюра не валидна"}, 200
+    try:
+        signed_banknote, balance = bank_service.issue_banknote(client_id, blinded_banknote, amount, kid)
+    except AccountNotFoundError:
+        return {"status": "error", "message": "Счёт клиента не найден"}, 404
+    except InsufficientFundsError:
+        return {"status": "error", "message": "Недостаточно средств на счёте"}, 402
+    return {"status": "ok", "signed_banknote": signed_banknote, "amount": amount, "kid": kid,
+            "balance": balance}, 200
 
-# Подпись сдачи
+# Подпись сдачи вне погашения банкноты: сумма сдачи списывается со счёта клиента
 @app.route('/api/v1/sign-change', methods=['POST'])
+@idempotent('sign-change')
+@admission.admitted
 def sign_change():
     data = request.json
     if not data:
         print(f"Ошибка: не данных")
-        return jsonify({
+        return {
             "status": "error",
             "message": "Не указаны данные сдачи"
-        }), 400
+        }, 400
 
     # Проверка минимально необходимых полей
-    required_fields = ['blinded_change', 'change_exp']
+    required_fields = ['blinded_change', 'change_exp', 'client_id']
     missing_fields = [field for field in required_fields if field not in data]
     if missing_fields:
-        return jsonify({
+        return {
             "status": "error",
             "message": f"Отсутствуют обязательные поля: {', '.join(missing_fields)}"
-        }), 400
+        }, 400
 
+    try:
+        change_exp = data['change_exp']
+        blinded_change = int(data['blinded_change'])
+        change_amount = bank_service.change_amount(change_exp)
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": f"Некорректная экспонента сдачи: {str(e)}"}, 400
+    try:
+        kid = bank_service.signing_key_id(data.get('kid'))
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
 
-    signed_change_blinded = pm.bank_sign_change(data['blinded_change'], data['change_exp'])
-    return jsonify({
+    client_id = client_account_id(data)
+    if client_id is None:
+        return {"status": "error", "message": "Не указан счёт клиента (client_id)"}, 400
+
+    try:
+        signed_change_blinded, balance = bank_service.issue_change(client_id, blinded_change, change_exp, kid)
+    except AccountNotFoundError:
+        return {"status": "error", "message": "Счёт клиента не найден"}, 404
+    except InsufficientFundsError:
+        return {"status": "error", "message": "Недостаточно средств на счёте"}, 402
+    return {
+        "status": "ok",
+        "signed_change_blinded": signed_change_blinded,
+        "change_amount": change_amount,
+        "kid": kid,
+        "balance": balance,
+    }, 200
+
+def parse_serial(value):
+    """Серийный номер банкноты: целое в диапазоне 1..n-1 (n - наибольший модуль ключей) или None"""
+    try:
+        serial = int(value)
+    except (TypeError, ValueError):
+        return None
+    return serial if 0 < serial < key_store.max_modulus() else None
+
+# Погашение банкноты (проверка платежа и двойной траты) с подписью сдачи.
+# Серийный номер банк получает из платежа сам и сверяет с FDH(nonce)
+@app.route('/api/v1/banknotes/redeem', methods=['POST'])
+@idempotent('redeem')
+@admission.admitted
+def redeem_banknote():
+    data = request.json
+    if not data:
+        return {"status": "error", "message": "Не указаны данные платежа"}, 400
+
+    required_fields = ['payment', 'payment_exp', 'nonce']
+    missing_fields = [field for field in required_fields if field not in data]
+    if missing_fields:
+        return {
+            "status": "error",
+            "message": f"Отсутствуют обязательные поля: {', '.join(missing_fields)}"
+        }, 400
+
+    try:
+        serial, _ = bank_service.verify_payment(int(data['payment']), data['payment_exp'],
+                                                data.get('note_exp') or pm.h, data['nonce'],
+                                                data.get('kid'))
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": f"Платёж не принят: {str(e)}"}, 400
+
+    merchant_id = data.get('merchant_id')
+    if merchant_id is not None and not isinstance(merchant_id, str):
+        return {"status": "error", "message": "Идентификатор продавца должен быть строкой"}, 400
+
+    change = None
+    if 'blinded_change' in data or 'change_exp' in data:
+        try:
+            change_exp = data['change_exp']
+            blinded_change = int(data['blinded_change'])
+            change_amount = bank_service.change_amount(change_exp)
+        except (KeyError, TypeError, ValueError) as e:
+            return {"status": "error", "message": f"Некорректные данные сдачи: {str(e)}"}, 400
+        try:
+            kid = bank_service.signing_key_id(data.get('kid'))
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}, 400
+        change = (blinded_change, change_exp, kid)
+
+    redeemed, signed_change_blinded = bank_service.redeem_banknote(serial, merchant_id, change)
+    if not redeemed:
+        return {"status": "error", "message": "Банкнота уже потрачена"}, 409
+    if change is None:
+        return {"status": "ok"}, 200
+    return {
         "status": "ok",
         "signed_change_blinded": signed_change_blinded,
-    }), 200
+        "change_amount": change_amount,
+        "kid": kid,
+    }, 200
+
+# Зачисление пакета платежей на счёт продавца
+@app.route('/api/v1/deposits', methods=['POST'])
+@idempotent('deposits')
+def create_deposit():
+    data = request.json
+    if not data:
+        return {"status": "error", "message": "Не указаны данные зачисления"}, 400
+
+    merchant_id = data.get('merchant_id')
+    if not merchant_id or not isinstance(merchant_id, str):
+        return {"status": "error", "message": "Не указан идентификатор продавца"}, 400
+
+    items = data.get('payments')
+    if not isinstance(items, list):
+        return {"status": "error", "message": "Поле payments должно быть списком"}, 400
+
+    if len(items) > DEPOSIT_MAX_ITEMS:
+        return {
+            "status": "error",
+            "message": f"Слишком большой пакет: максимум {DEPOSIT_MAX_ITEMS} платежей"
+        }, 413
+
+    try:
+        results, credited, balance = bank_service.deposit(merchant_id, items)
+    except AccountNotFoundError:
+        return {"status": "error", "message": "Счёт продавца не найден"}, 404
+    return {"status": "ok", "results": results, "credited": credited, "balance": balance}, 200
+
+# Проверка, потрачена ли банкнота
+@app.route('/api/v1/banknotes/spent/<serial>', methods=['GET'])
+def banknote_spent(serial):
+    serial = parse_serial(serial)
+    if serial is None:
+        return jsonify({"status": "error", "message": "Некорректный серийный номер банкноты"}), 400
+    return jsonify({"status": "ok", "spent": bank_service.is_banknote_spent(serial)}), 200
+
+# Пакетная подпись банкнот и сдачи за счёт клиента
+@app.route('/api/v1/banknotes/batch', methods=['POST'])
+@idempotent('batch')
+@admission.admitted
+def create_banknotes_batch():
+    data = request.json
+    if not data:
+        return {"status": "error", "message": "Не указаны данные пакета"}, 400
+
+    items = data.get('items')
+    if not isinstance(items, list):
+        return {"status": "error", "message": "Поле items должно быть списком"}, 400
+
+    if len(items) > BATCH_MAX_ITEMS:
+        return {
+            "status": "error",
+            "message": f"Слишком большой пакет: максимум {BATCH_MAX_ITEMS} элементов"
+        }, 413
+
+    client_id = client_account_id(data)
+    if client_id is None:
+        return {"status": "error", "message": "Не указан счёт клиента (client_id)"}, 400
+
+    try:
+        results, balance = bank_service.sign_batch(client_id, items)
+    except AccountNotFoundError:
+        return {"status": "error", "message": "Счёт клиента не найден"}, 404
+    return {"status": "ok", "results": results, "balance": balance}, 200
 
 # Обработчик ошибок для 404
 @app.errorhandler(404)
@@ -110,9 +347,10 @@ def forbidden(e):
     return jsonify({"status": "error", "message": "Нет доступа"}), 403
 
 if __name__ == '__main__':
-    # Инициализация базы данных
+    # Загрузка ключей и инициализация базы данных
+    key_store.load()
     bank_service.initialize_database()
     
     # Запуск сервера на всех интерфейсах (0.0.0.0) для доступа из локальной сети
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    app.run(host='0.0.0.0', port=BANK_PORT, debug=True)
     # В производственной среде рекомендуется отключить debug=True
@@ -3,26 +3,42 @@ import os
 from Crypto.PublicKey import RSA
 from Crypto.PublicKey.RSA import RsaKey
 import paymentMath as pm
+import metrics
+from signer import signing_executor
+from spentNotes import spent_registry
+from ledger import account_store, AccountNotFoundError, InsufficientFundsError
+from database import database
+from keyStore import key_store
+from idempotency import idempotency_cache
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
-class Client:
-    def __init__(self, id, start_money):
-        self.id = id
-        self.start_money = start_money
-
 class BankService:
-    list_clients = []
     def __init__(self):
         """Инициализация банковского сервиса"""
-        # self.db_path = os.environ.get('DB_PATH', 'bank.db')
-        # logger.info(f"Инициализация банковского сервиса. База данных: {self.db_path}")
+        logger.info(f"Инициализация банковского сервиса. База данных: {account_store.db.path}")
+
+    def initialize_database(self):
+        """Создание таблиц и загрузка индексов"""
+        account_store.initialize()
+        spent_registry.initialize()
+        idempotency_cache.initialize()
 
+    def use_shared_state(self):
+        """Режим нескольких рабочих процессов: состояние читается из базы, а не из памяти процесса"""
+        account_store.cache_enabled = False
+        spent_registry.shared = True
+        # Повтор запроса может попасть в другой процесс: ответы по ключам идемпотентности хранятся в базе
+        idempotency_cache.persistent = True
+        account_store.db.use_shared_mode()
+
+    # Создаёт счёт клиента; возвращает (счёт, создан ли новый)
     def create_client(self, start_money, uid):
-        client = Client(uid, start_money)
-        self.list_clients.append(client)
-        return client
+        return account_store.create(uid, start_money)
+
+    def get_client(self, uid):
+        return account_store.get(uid)
 
     # Методы для работы с банкнотами
 
@@ -30,11 +46,229 @@ class BankService:
     def verify_blinded_banknote(self, banknote):
         return True
 
-    # Подписывает затенённую банкноту
-    def sign_banknote(self, blinded_banknote):
-        return pm.bank_sign_blinded(blinded_banknote)
+    # Проверяет, потрачена ли банкнота
+    def is_banknote_spent(self, serial):
+        return spent_registry.is_spent(serial)
+
+    # Сумма выпускаемой банкноты; ValueError, если это не целое в диапазоне 1..max_amount
+    def issue_amount(self, amount):
+        if type(amount) is not int or not 0 < amount <= pm.codec.max_amount:
+            raise ValueError(f"Сумма банкноты должна быть целым числом в диапазоне 1..{pm.codec.max_amount}")
+        return amount
+
+    # Проверка платежа открытым ключом kid: (серийный номер, сумма платежа); ValueError, если платёж не сходится.
+    # Серийный номер банкноты - FDH(nonce), поэтому без подписи банка платёж не подделать.
+    # Экспоненты принимаются только целыми: int() молча превратил бы 3.7 в 3, а True в 1
+    def verify_payment(self, payment, payment_exp, note_exp, nonce, kid):
+        error = pm.check_nonce(nonce)
+        if error:
+            raise ValueError(error)
+        amount = pm.codec.decode(payment_exp)
+        if not amount:
+            raise ValueError("Сумма платежа должна быть положительной")
+        pm.codec.decode(note_exp)
+        if note_exp % payment_exp != 0:
+            raise ValueError("Экспонента платежа не делит экспоненту банкноты")
+        # Выведенные ключи тоже подходят, банкноты ими уже выпущены
+        key = key_store.get(kid)
+        if key is None:
+            raise ValueError(f"Неизвестный ключ: {kid}")
+        if not 0 < payment < key.n:
+            raise ValueError("Платёж вне диапазона 1..n-1")
+        serial = pow(payment, pm.payment_check_exponent(note_exp, payment_exp), key.n)
+        if serial != pm.full_domain_hash(nonce, key.n):
+            raise ValueError("Платёж не прошёл проверку подписи банкноты")
+        return serial, amount
+
+    # Погашение банкноты: (погашена ли, подписанная сдача или None); False - банкнота уже была потрачена.
+    # Банкноту, погашенную продавцом merchant_id, может зачислить только он.
+    # change = (затенённая сдача, экспонента, kid) подписывается до погашения: если подпись
+    # не удалась или запрос отклонён, банкнота остаётся непотраченной и платёж можно повторить
+    def redeem_banknote(self, serial, merchant_id=None, change=None):
+        signed_change = None
+        if change is not None:
+            if spent_registry.is_spent(serial):
+                return False, None
+            signed_change = self.sign_change(*change)
+        if not spent_registry.check_and_mark(serial, merchant_id):
+            return False, None
+        return True, signed_change
+
+    def _check_deposit_item(self, item):
+        """Проверка платежа из пакета зачисления: (серийный номер, сумма) или ответ с ошибкой"""
+        if not isinstance(item, dict):
+            return {"status": "error", "message": "Элемент пакета должен быть объектом"}
+        try:
+            payment = int(item['payment'])
+            payment_exp = item['payment_exp']
+            note_exp = item.get('note_exp') or pm.h
+            nonce = item['nonce']
+        except (KeyError, TypeError, ValueError):
+            return {"status": "error", "message": "Некорректные данные платежа"}
+        try:
+            return self.verify_payment(payment, payment_exp, note_exp, nonce, item.get('kid'))
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+
+    # Зачисление пакета платежей на счёт продавца одной транзакцией.
+    # Возвращает (результаты по платежам, зачисленная сумма, новый баланс)
+    def deposit(self, merchant_id, items):
+        with metrics.timed('verify-deposit'):
+            checked = [self._check_deposit_item(item) for item in items]
+
+        with database.transaction():
+            if account_store.get(merchant_id) is None:
+                raise AccountNotFoundError(merchant_id)
+            results = []
+            total = 0
+            for entry in checked:
+                if isinstance(entry, dict):
+                    results.append(entry)
+                    continue
+                serial, amount = entry
+                if spent_registry.mark_deposited(serial, merchant_id):
+                    total += amount
+                    results.append({"status": "ok", "serial": serial, "amount": amount})
+                else:
+                    results.append({"status": "error", "serial": serial,
+                                    "message": "Банкнота уже зачислена или погашена другим продавцом"})
+            balance = account_store.adjust_balance(merchant_id, total)
+        return results, total, balance
+
+    # Идентификатор ключа подписи (по умолчанию - основной); ValueError для неизвестного или выведенного ключа
+    def signing_key_id(self, kid=None):
+        return key_store.signing_key(kid).kid
+
+    # Подписывает затенённую банкноту ключом kid
+    def sign_banknote(self, blinded_banknote, kid):
+        with metrics.timed('sign'):
+            return signing_executor.sign_blinded(kid, blinded_banknote).result()
+
+    # Подпись за счёт клиента: amount списывается до подписи и возвращается, если подпись не удалась.
+    # Возвращает (подпись, новый баланс)
+    def _issue(self, client_id, amount, sign):
+        balance = account_store.adjust_balance(client_id, -amount)
+        try:
+            return sign(), balance
+        except Exception:
+            account_store.adjust_balance(client_id, amount)
+            raise
+
+    # Выпуск банкноты на сумму amount со счёта клиента: (подпись, новый баланс)
+    def issue_banknote(self, client_id, blinded_banknote, amount, kid):
+        return self._issue(client_id, self.issue_amount(amount),
+                           lambda: self.sign_banknote(blinded_banknote, kid))
+
+    # Сумма сдачи по экспоненте; ValueError, если экспонента не кодирует сумму
+    # Сумма сдачи по экспоненте; ValueError, если экспонента не целое число или кодирует нулевую сумму
+    def change_amount(self, change_exp):
+        amount = pm.codec.decode(change_exp)
+        if not amount:
+            raise ValueError("Сумма сдачи должна быть положительной")
+        return amount
+
+    # Подписывает затенённую сдачу ключом kid
+    def sign_change(self, blinded_change, change_exp, kid):
+        with metrics.timed('sign-change'):
+            return signing_executor.sign_change(kid, blinded_change, change_exp).result()
+
+    # Подпись сдачи вне погашения банкноты - выпуск на сумму сдачи со счёта клиента: (подпись, новый баланс)
+    def issue_change(self, client_id, blinded_change, change_exp, kid):
+        return self._issue(client_id, self.change_amount(change_exp),
+                           lambda: self.sign_change(blinded_change, change_exp, kid))
+
+    def _check_batch_item(self, item):
+        """Проверка элемента пакета: (поле результата, сумма, ключ, затенённое сообщение, экспонента сдачи)
+        или ответ с ошибкой"""
+        if not isinstance(item, dict):
+            return {"status": "error", "message": "Элемент пакета должен быть объектом"}
+
+        try:
+            if 'banknote' in item or 'blinded_change' in item:
+                kid = self.signing_key_id(item.get('kid'))
+
+            if 'banknote' in item:
+                blinded_banknote = int(item['banknote'])
+                amount = self.issue_amount(item.get('amount'))
+                if not self.verify_blinded_banknote(blinded_banknote):
+                    return {"status": "false", "signed_banknote": 0, "message": "Купюра не валидна"}
+                return 'signed_banknote', amount, kid, blinded_banknote, None
+
+            if 'blinded_change' in item and 'change_exp' in item:
+                change_exp = item['change_exp']
+                amount = self.change_amount(change_exp)
+                return 'signed_change_blinded', amount, kid, int(item['blinded_change']), change_exp
+        except (TypeError, ValueError) as e:
+            return {"status": "error", "message": f"Некорректные данные: {str(e)}"}
+
+        return {"status": "error", "message": "Нужна banknote и amount или blinded_change и change_exp"}
+
+    def _submit_batch_item(self, entry):
+        """Запуск подписи проверенного элемента пакета: (поле результата, сумма, ключ, Future)"""
+        field, amount, kid, blinded, change_exp = entry
+        if change_exp is None:
+            return field, amount, kid, signing_executor.sign_blinded(kid, blinded)
+        return field, amount, kid, signing_executor.sign_change(kid, blinded, change_exp)
+
+    # Подписывает пакет банкнот и сдач за счёт клиента: сумма пакета списывается одной операцией,
+    # суммы неподписанных элементов возвращаются. Элементы, на которые не хватило средств, получают
+    # ошибку, остальные подписываются. Возвращает (результаты в том же порядке, новый баланс)
+    def sign_batch(self, client_id, items):
+        with metrics.timed('sign-batch'):
+            checked = [self._check_batch_item(item) for item in items]
+            with database.transaction():
+                account = account_store.get(client_id)
+                if account is None:
+                    raise AccountNotFoundError(client_id)
+                total = 0
+                for i, entry in enumerate(checked):
+                    if isinstance(entry, dict):
+                        continue
+                    if total + entry[1] > account.balance:
+                        checked[i] = {"status": "error", "message": "Недостаточно средств на счёте"}
+                        continue
+                    total += entry[1]
+                balance = account_store.adjust_balance(client_id, -total)
+            # Сначала отправляем все элементы исполнителю, затем собираем результаты
+            pending = [entry if isinstance(entry, dict) else self._submit_batch_item(entry) for entry in checked]
+            results, refund = self._collect_batch(pending)
+        if refund:
+            balance = account_store.adjust_balance(client_id, refund)
+        return results, balance
+
+    def _collect_batch(self, pending):
+        results = []
+        refund = 0
+        for entry in pending:
+            if isinstance(entry, dict):
+                results.append(entry)
+                continue
+            field, amount, kid, future = entry
+            try:
+                results.append({"status": "ok", field: future.result(), "amount": amount, "kid": kid})
+            except Exception as e:
+                logger.error(f"Ошибка подписи элемента пакета: {str(e)}")
+                results.append({"status": "error", "message": "Ошибка подписи"})
+                refund += amount
+        return results, refund
+
+
+def _check_exponent_cache_stats():
+    info = pm.payment_check_exponent.cache_info()
+    return [(('hit',), info.hits), (('miss',), info.misses)]
+
+
+def _signing_cache_stats():
+    stats = key_store.stats()
+    return [(('hit',), stats['hits']), (('miss',), stats['misses'])]
 
 
+# Кэш экспонент подписи сдачи (при SIGNING_EXECUTOR=process ведётся в рабочих процессах)
+metrics.registry.collected('signing_exponent_cache_total', 'Обращения к кэшу экспонент подписи сдачи',
+                           'counter', _signing_cache_stats, ('result',))
+# Кэш экспонент проверки платежей при погашении и зачислении
+metrics.registry.collected('check_exponent_cache_total', 'Обращения к кэшу экспонент проверки платежа',
+                           'counter', _check_exponent_cache_stats, ('result',))
 
 # Создаем экземпляр сервиса
 bank_service = BankService()
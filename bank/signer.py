@@ -0,0 +1,85 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import keyStore
+from keyStore import key_store
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация: inline - подпись в потоке запроса, thread - пул потоков, process - пул процессов
+SIGNING_EXECUTOR = os.environ.get('SIGNING_EXECUTOR', 'inline')
+SIGNING_WORKERS = int(os.environ.get('SIGNING_WORKERS', os.cpu_count() or 1))
+
+EXECUTOR_KINDS = ('inline', 'thread', 'process')
+
+
+def _init_worker():
+    """Инициализация рабочего процесса: ключи подписи загружаются один раз"""
+    key_store.load()
+    logger.info(f"Рабочий процесс подписи {os.getpid()} готов, ключей: {len(key_store.keys)}")
+
+
+class SigningExecutor:
+    """Исполнитель операций подписи (inline, пул потоков или пул процессов)"""
+    def __init__(self, kind=SIGNING_EXECUTOR, workers=SIGNING_WORKERS):
+        if kind not in EXECUTOR_KINDS:
+            raise ValueError(f"Неизвестный тип исполнителя подписи: {kind}")
+        self.kind = kind
+        self.workers = max(1, workers)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Пул создаётся лениво и пересоздаётся в дочернем процессе после fork
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                if self.kind == 'thread':
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix='signer')
+                else:
+                    # fork небезопасен в многопоточном сервере, поэтому spawn
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=multiprocessing.get_context('spawn'),
+                                                         initializer=_init_worker)
+                self._pid = os.getpid()
+                logger.info(f"Исполнитель подписи: {self.kind}, воркеров: {self.workers}")
+            return self._executor
+
+    def submit(self, fn, *args):
+        """Запуск операции подписи, возвращает Future"""
+        if self.kind == 'inline':
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        try:
+            return self._get_executor().submit(fn, *args)
+        except BrokenProcessPool:
+            # Рабочий процесс упал - пересоздаём пул и повторяем
+            logger.error("Пул процессов подписи повреждён, пересоздание")
+            with self._lock:
+                self._executor = None
+            return self._get_executor().submit(fn, *args)
+
+    def sign_blinded(self, kid, blinded_msg):
+        return self.submit(keyStore.sign_blinded, kid, blinded_msg)
+
+    def sign_change(self, kid, blinded_change, change_exp):
+        return self.submit(keyStore.sign_change, kid, blinded_change, change_exp)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+# Общий исполнитель подписи
+signing_executor = SigningExecutor()
@@ -0,0 +1,224 @@
+import os
+import math
+import time
+import uuid
+import atexit
+import struct
+import hashlib
+import logging
+import threading
+import paymentMath as pm
+import metrics
+from database import database
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация фильтра Блума
+SPENT_BLOOM_CAPACITY = int(os.environ.get('SPENT_BLOOM_CAPACITY', 10_000_000))
+SPENT_BLOOM_ERROR_RATE = float(os.environ.get('SPENT_BLOOM_ERROR_RATE', 0.01))
+
+# Снимок фильтра Блума: при запуске фильтр читается из снимка, а из базы
+# дочитываются только банкноты, потраченные после него. Время запуска
+# ограничено периодом снимков, а не всей историей (0 - без снимков)
+SPENT_SNAPSHOT_INTERVAL = float(os.environ.get('SPENT_SNAPSHOT_INTERVAL', 300))
+# По умолчанию снимок лежит рядом с базой
+SPENT_SNAPSHOT_PATH = os.environ.get('SPENT_SNAPSHOT_PATH', '')
+SNAPSHOT_MAGIC = b'SPB1'
+SNAPSHOT_HEADER = struct.Struct('>4sQId32s')
+# Запас при дочитывании: время погашения берётся до записи в базу, а часы могут сдвинуться
+SNAPSHOT_MARGIN = 60.0
+
+# Серийный номер хранится как целое фиксированной длины (big-endian); номера
+# под ключами длиннее исходного занимают больше байт
+SERIAL_BYTES = (pm.n.bit_length() + 7) // 8
+
+
+class BloomFilter:
+    """Фильтр Блума: быстрый отрицательный ответ без обращения к базе"""
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def matches(self, size, hashes):
+        """Снимок с такими параметрами подходит этому фильтру"""
+        return size == self.size and hashes == self.hashes
+
+
+class SpentNoteRegistry:
+    """Реестр потраченных банкнот: фильтр Блума в памяти и точный индекс в SQLite"""
+    def __init__(self, db=database, capacity=SPENT_BLOOM_CAPACITY, error_rate=SPENT_BLOOM_ERROR_RATE):
+        self.db = db
+        self.bloom = BloomFilter(capacity, error_rate)
+        # Фильтр заполняется только своим процессом: если банкноты гасят несколько
+        # процессов, его отрицательный ответ недостоверен и проверка идёт по базе
+        self.shared = False
+        self.snapshot_interval = SPENT_SNAPSHOT_INTERVAL
+        self._snapshots = None
+
+    @property
+    def snapshot_path(self):
+        return SPENT_SNAPSHOT_PATH or f"{self.db.path}.bloom"
+
+    @staticmethod
+    def _key(serial):
+        serial = int(serial)
+        return serial.to_bytes(max(SERIAL_BYTES, (serial.bit_length() + 7) // 8), 'big')
+
+    def initialize(self):
+        """Создание таблицы и загрузка фильтра Блума из базы"""
+        with self.db.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS spent_notes (
+                    serial BLOB PRIMARY KEY,
+                    spent_at REAL NOT NULL,
+                    merchant TEXT,
+                    deposited REAL
+                ) WITHOUT ROWID
+            ''')
+            # Таблица, созданная до появления зачислений: продавец, погасивший банкноту, и время зачисления
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(spent_notes)')}
+            for column, column_type in (('merchant', 'TEXT'), ('deposited', 'REAL')):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE spent_notes ADD COLUMN {column} {column_type}')
+            # Дочитывание после снимка - по времени погашения
+            conn.execute('CREATE INDEX IF NOT EXISTS spent_notes_by_time ON spent_notes (spent_at)')
+            # Метка последнего снимка: снимок от другой (или восстановленной) базы не подойдёт
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    name TEXT PRIMARY KEY,
+                    token TEXT NOT NULL,
+                    created REAL NOT NULL
+                )
+            ''')
+        if self.shared:
+            return
+        start = time.perf_counter()
+        since = self._load_snapshot() if self.snapshot_interval > 0 else None
+        count = 0
+        with self.db.lock:
+            if since is None:
+                rows = self.db.connection().execute('SELECT serial FROM spent_notes')
+            else:
+                rows = self.db.connection().execute('SELECT serial FROM spent_notes WHERE spent_at >= ?', (since,))
+            for (key,) in rows:
+                self.bloom.add(key)
+                count += 1
+        source = "из базы" if since is None else "из снимка и базы"
+        logger.info(f"Реестр потраченных банкнот загружен {source}: {count} записей дочитано "
+                    f"за {(time.perf_counter() - start) * 1000:.1f} мс")
+        self._start_snapshots()
+
+    # Снимки фильтра Блума
+
+    def _load_snapshot(self):
+        """Загрузка фильтра из снимка; возвращает время, с которого нужно дочитать базу, или None"""
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                magic, size, hashes, since, token = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+                bits = f.read()
+        except (OSError, struct.error):
+            return None
+        rows = self.db.query("SELECT token FROM snapshots WHERE name = 'spent_bloom'")
+        if (magic != SNAPSHOT_MAGIC or not self.bloom.matches(size, hashes) or len(bits) != len(self.bloom.bits)
+                or not rows or rows[0][0] != token.decode()):
+            logger.warning(f"Снимок {self.snapshot_path} не подходит к базе, фильтр строится заново")
+            return None
+        self.bloom.bits[:] = bits
+        return since
+
+    def save_snapshot(self):
+        """Запись снимка фильтра Блума (атомарно, с fsync)"""
+        token = uuid.uuid4().hex
+        with self.db.lock:
+            # Все погашения до этого момента уже добавлены в фильтр
+            since = time.time() - SNAPSHOT_MARGIN
+            bits = bytes(self.bloom.bits)
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.bloom.size, self.bloom.hashes, since,
+                                         token.encode()))
+            f.write(bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # Метка в базе записывается после файла: при сбое между ними снимок не подойдёт
+        with self.db.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO snapshots (name, token, created) VALUES ('spent_bloom', ?, ?)",
+                         (token, time.time()))
+        self.db.flush()
+
+    def _start_snapshots(self):
+        if self.snapshot_interval <= 0 or self._snapshots is not None:
+            return
+        self._snapshots = threading.Thread(target=self._snapshot_loop, name='spent-snapshots', daemon=True)
+        self._snapshots.start()
+        atexit.register(self._try_snapshot)
+
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            self._try_snapshot()
+
+    def _try_snapshot(self):
+        try:
+            self.save_snapshot()
+        except Exception as e:
+            logger.error(f"Не удалось записать снимок реестра потраченных банкнот: {str(e)}")
+
+    def is_spent(self, serial):
+        key = self._key(serial)
+        # Попадание - ответ дан фильтром Блума без обращения к базе
+        if not self.shared:
+            negative = key not in self.bloom
+            metrics.cache_hit('spent_bloom', negative)
+            if negative:
+                return False
+        return bool(self.db.query('SELECT 1 FROM spent_notes WHERE serial = ?', (key,)))
+
+    def check_and_mark(self, serial, merchant=None):
+        """Атомарно отмечает банкноту потраченной; False, если она уже была потрачена.
+
+        merchant - продавец, которому банкнота может быть зачислена (по умолчанию любой)
+        """
+        key = self._key(serial)
+        with self.db.transaction() as conn:
+            cursor = conn.execute('INSERT OR IGNORE INTO spent_notes (serial, spent_at, merchant) VALUES (?, ?, ?)',
+                                  (key, time.time(), merchant))
+            marked = cursor.rowcount == 1
+            self.bloom.add(key)
+        return marked
+
+    def mark_deposited(self, serial, merchant):
+        """Отметка о зачислении банкноты продавцу; непогашенная банкнота погашается.
+
+        False, если банкнота уже зачислена или погашена другим продавцом.
+        """
+        key = self._key(serial)
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO spent_notes (serial, spent_at, merchant) VALUES (?, ?, ?)',
+                         (key, now, merchant))
+            cursor = conn.execute('UPDATE spent_notes SET deposited = ?, merchant = ? WHERE serial = ? '
+                                  'AND deposited IS NULL AND (merchant IS NULL OR merchant = ?)',
+                                  (now, merchant, key, merchant))
+            self.bloom.add(key)
+        return cursor.rowcount == 1
+
+
+# Общий реестр потраченных банкнот
+spent_registry = SpentNoteRegistry()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""Нагрузочный тест полного сценария оплаты.
+
+Каждый имитируемый клиент выполняет снятие банкноты в банке, оплату
+продавцу (погашение и подпись сдачи) и проверку полученной сдачи.
+Режимы: замкнутый (--clients потоков без пауз) и открытый (--rate
+поступлений в секунду, пуассоновский поток). Результат - JSON с
+пропускной способностью, перцентилями задержек и числом ошибок.
+
+Пример:
+    python bench/loadgen.py --clients 8 --duration 30
+    python bench/loadgen.py --rate 50 --duration 60 --server-mode async
+    python bench/loadgen.py --bank-url http://localhost:8080 --client-url http://localhost:5001
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import logging
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'client'))
+
+import paymentMath as pm
+from httpClient import HttpClient, read_payload
+from keyCache import PublicKey
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('loadgen')
+
+STARTUP_TIMEOUT = 30
+START_MONEY = 10 ** 9
+
+
+def percentile(values, q):
+    """Перцентиль q (0..100) отсортированного списка, метод ближайшего ранга"""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+
+class LoadStats:
+    """Потокобезопасный сбор задержек и ошибок по этапам сценария"""
+    def __init__(self):
+        self._latencies = defaultdict(list)
+        self._errors = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, error=None):
+        with self._lock:
+            if error is None:
+                self._latencies[endpoint].append(seconds)
+            else:
+                self._errors[endpoint][error] += 1
+
+    def summary(self):
+        with self._lock:
+            result = {}
+            for endpoint in sorted(set(self._latencies) | set(self._errors)):
+                values = sorted(self._latencies[endpoint])
+                errors = self._errors[endpoint]
+                result[endpoint] = {
+                    "count": len(values),
+                    "errors": sum(errors.values()),
+                    "error_kinds": dict(errors),
+                    "mean_ms": _ms(sum(values) / len(values)) if values else None,
+                    "p50_ms": _ms(percentile(values, 50)),
+                    "p95_ms": _ms(percentile(values, 95)),
+                    "p99_ms": _ms(percentile(values, 99)),
+                    "max_ms": _ms(values[-1]) if values else None,
+                }
+            return result
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class StepError(Exception):
+    """Ошибка этапа сценария; kind попадает в счётчик ошибок"""
+    def __init__(self, kind):
+        super().__init__(kind)
+        self.kind = kind
+
+
+class DenominationMix:
+    """Случайный выбор номинала банкноты и суммы платежа"""
+    def __init__(self, amounts=None, max_amount=1000, change_share=0.5):
+        self.amounts = amounts
+        self.max_amount = max_amount
+        self.change_share = change_share
+
+    def choose(self, rng):
+        amount = rng.choice(self.amounts) if self.amounts else rng.randint(1, self.max_amount)
+        if amount > 1 and rng.random() < self.change_share:
+            return amount, rng.randint(1, amount - 1)
+        return amount, amount
+
+
+class PaymentScenario:
+    """Сценарий снятие -> оплата -> сдача -> проверка для одного клиента"""
+    def __init__(self, bank_url, client_url, http, stats, mix):
+        self.bank_url = bank_url
+        self.client_url = client_url
+        self.http = http
+        self.stats = stats
+        self.mix = mix
+        # Основной ключ банка из ответа create-client
+        self.key = None
+
+    def _call(self, endpoint, method, url, payload=None):
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, url, json=payload)
+            data = read_payload(response)
+        except Exception as e:
+            self.stats.record(endpoint, 0, type(e).__name__)
+            raise StepError(type(e).__name__)
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            kind = f"HTTP {response.status_code}"
+        elif not isinstance(data, dict) or data.get("status") != "ok":
+            kind = "status"
+        else:
+            self.stats.record(endpoint, elapsed)
+            return data
+        self.stats.record(endpoint, elapsed, kind)
+        raise StepError(kind)
+
+    def create_client(self, client_id):
+        data = self._call('create-client', 'POST', f"{self.bank_url}/api/v1/create-client",
+                          {"start_money": START_MONEY, "client_id": client_id})
+        self.key = PublicKey.from_params(data)
+
+    def run(self, rng, client_id):
+        # rng задаёт только номиналы; nonce банкнот случайны, чтобы повторный
+        # запуск с тем же --seed не тратил уже погашенные банкноты
+        amount, payment_amount = self.mix.choose(rng)
+        key = self.key
+        n = key.n
+
+        # Снятие: банк списывает сумму со счёта клиента и подписывает затенённую банкноту
+        nonce, s1 = pm.new_note_serial(n)
+        r1 = pm.generate_blinding_factor(n)
+        blinded = pm.create_blinded_message(s1, r1, key.h, n)
+        data = self._call('withdraw', 'POST', f"{self.bank_url}/api/v1/banknotes",
+                          {"banknote": blinded, "amount": amount, "client_id": client_id, "kid": key.kid})
+        signed_bill = pm.unblind_signed(data['signed_banknote'], r1, n)
+
+        # Оплата продавцу; сдача возвращается в ответе
+        payment_exp = pm.select_amount_exponent(payment_amount, key.divisors)
+        request = {
+            "payment": pm.create_payment_message(signed_bill, payment_exp, n, key.h),
+            "s1": s1,
+            "nonce": nonce,
+            "payment_exp": payment_exp,
+            "payment_amount": payment_amount,
+            "amount": amount,
+            "kid": key.kid,
+        }
+        change = None
+        if payment_amount < amount:
+            _, t = pm.new_note_serial(n)
+            ra = pm.generate_blinding_factor(n)
+            change_exp = pm.select_amount_exponent(amount - payment_amount, key.divisors)
+            request["blinded_change"] = pm.create_change_request(t, ra, change_exp, n)
+            request["change_exp"] = change_exp
+            change = (t, ra, change_exp)
+        data = self._call('payment', 'POST', f"{self.client_url}/api/v1/payment", request)
+
+        # Проверка сдачи плательщиком
+        if change is not None:
+            t, ra, change_exp = change
+            start = time.perf_counter()
+            change_bill = pm.unblind_change(data.get('signed_change_blinded', 0), ra, n)
+            valid = pow(change_bill, change_exp, n) == t
+            self.stats.record('verify-change', time.perf_counter() - start, None if valid else 'invalid')
+            if not valid:
+                raise StepError('invalid')
+
+
+class LocalServers:
+    """Локальный запуск банковского и клиентского серверов на свободных портах"""
+    def __init__(self, server_mode='flask', workdir=None, env=None, workers=1):
+        self.server_mode = server_mode
+        self.workers = workers
+        self.workdir = workdir or tempfile.mkdtemp(prefix='loadgen-')
+        self.env = dict(os.environ, **(env or {}))
+        self.processes = []
+        self.bank_url = None
+        self.client_url = None
+
+    def __enter__(self):
+        bank_port, client_port = _free_port(), _free_port()
+        self.bank_url = f"http://127.0.0.1:{bank_port}"
+        self.client_url = f"http://127.0.0.1:{client_port}"
+        workers = ['--workers', str(self.workers)]
+        self._spawn('bank', ['main.py'] + workers, {
+            'BANK_PORT': str(bank_port),
+            'DB_PATH': os.path.join(self.workdir, 'bank.db'),
+            'KEY_STORE_PATH': os.path.join(self.workdir, 'keys.json'),
+        })
+        self._spawn('client', ['main.py', '--mode', 'server', '--server-mode', self.server_mode] + workers, {
+            'CLIENT_PORT': str(client_port),
+            'BANK_SERVER_URL': self.bank_url,
+        })
+        try:
+            _wait_ready(self.bank_url)
+            _wait_ready(self.client_url)
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        logger.info(f"Серверы запущены: банк {self.bank_url}, клиент {self.client_url}, логи в {self.workdir}")
+        return self
+
+    def _spawn(self, name, args, env):
+        log = open(os.path.join(self.workdir, f"{name}.log"), 'wb')
+        process = subprocess.Popen([sys.executable] + args, cwd=os.path.join(ROOT, name),
+                                   env=dict(self.env, **env), stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        self.processes.append(process)
+
+    def __exit__(self, exc_type, exc, tb):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url, timeout=STARTUP_TIMEOUT):
+    http = HttpClient(retries=0, connect_timeout=1, read_timeout=2)
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            try:
+                if http.get(f"{url}/").status_code == 200:
+                    return
+            except Exception:
+                pass
+            time.sleep(0.2)
+    finally:
+        http.close()
+    raise RuntimeError(f"Сервер {url} не запустился за {timeout} с")
+
+
+def run_closed(scenario, client_ids, duration, total, stats, seed):
+    """Замкнутый режим: каждый клиент начинает новый платёж сразу после предыдущего"""
+    deadline = time.monotonic() + duration if duration else None
+    remaining = [total]
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        while deadline is None or time.monotonic() < deadline:
+            if total:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            _run_flow(scenario, stats, rng, time.perf_counter(), client_ids[index])
+
+    with ThreadPoolExecutor(max_workers=len(client_ids)) as executor:
+        for future in [executor.submit(worker, i) for i in range(len(client_ids))]:
+            future.result()
+
+
+def run_open(scenario, client_ids, rate, duration, total, stats, seed):
+    """Открытый режим: платежи поступают пуассоновским потоком с интенсивностью rate.
+
+    Задержка сценария считается от запланированного момента поступления,
+    поэтому ожидание свободного исполнителя входит в результат.
+    """
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    scheduled = start
+    submitted = 0
+    with ThreadPoolExecutor(max_workers=len(client_ids)) as executor:
+        while True:
+            scheduled += rng.expovariate(rate)
+            if duration and scheduled - start >= duration:
+                break
+            if total and submitted >= total:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(_run_flow, scenario, stats, random.Random(seed + submitted + 1), scheduled,
+                            client_ids[submitted % len(client_ids)])
+            submitted += 1
+
+
+def _run_flow(scenario, stats, rng, started, client_id):
+    try:
+        scenario.run(rng, client_id)
+    except StepError as e:
+        stats.record('flow', 0, e.kind)
+    except Exception as e:
+        logger.exception("Ошибка сценария")
+        stats.record('flow', 0, type(e).__name__)
+    else:
+        stats.record('flow', time.perf_counter() - started)
+
+
+def run(args, bank_url, client_url):
+    stats = LoadStats()
+    mix = DenominationMix(args.amounts, args.max_amount, args.change_share)
+    concurrency = args.clients
+    http = HttpClient(retries=0, pool_size=concurrency)
+    scenario = PaymentScenario(bank_url, client_url, http, stats, mix)
+
+    client_ids = [f"loadgen-{i}" for i in range(concurrency)]
+    for client_id in client_ids:
+        scenario.create_client(client_id)
+
+    if args.warmup:
+        run_closed(scenario, client_ids, 0, args.warmup, LoadStats(), args.seed)
+
+    started = time.perf_counter()
+    if args.rate:
+        run_open(scenario, client_ids, args.rate, args.duration, args.payments, stats, args.seed)
+    else:
+        run_closed(scenario, client_ids, args.duration, args.payments, stats, args.seed)
+    elapsed = time.perf_counter() - started
+    http.close()
+
+    endpoints = stats.summary()
+    flow = endpoints.get('flow', {"count": 0, "errors": 0})
+    return {
+        "config": {
+            "mode": "open" if args.rate else "closed",
+            "clients": concurrency,
+            "rate": args.rate,
+            "duration": args.duration,
+            "payments": args.payments,
+            "server_mode": args.server_mode,
+            "workers": args.workers,
+            "amounts": args.amounts,
+            "max_amount": args.max_amount,
+            "change_share": args.change_share,
+            "seed": args.seed,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "completed": flow["count"],
+        "failed": flow["errors"],
+        "throughput_per_s": round(flow["count"] / elapsed, 3) if elapsed else 0,
+        "endpoints": endpoints,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сценария оплаты")
+    parser.add_argument('--bank-url', help='Адрес запущенного банковского сервера')
+    parser.add_argument('--client-url', help='Адрес запущенного клиентского сервера')
+    parser.add_argument('--server-mode', choices=['flask', 'async'], default='flask',
+                        help='Режим локально запускаемого клиентского сервера')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Число рабочих процессов локально запускаемых серверов (0 - по числу ядер)')
+    parser.add_argument('--clients', '-c', type=int, default=4,
+                        help='Число одновременных клиентов (в открытом режиме - исполнителей)')
+    parser.add_argument('--rate', '-r', type=float, default=0,
+                        help='Платежей в секунду (открытый режим); 0 - замкнутый режим')
+    parser.add_argument('--duration', '-d', type=float, default=10, help='Длительность теста, с (0 - без ограничения)')
+    parser.add_argument('--payments', '-n', type=int, default=0, help='Число платежей (0 - без ограничения)')
+    parser.add_argument('--warmup', type=int, default=0, help='Число платежей для прогрева (не учитываются)')
+    parser.add_argument('--amounts', type=lambda value: [int(x) for x in value.split(',')],
+                        help='Номиналы банкнот через запятую (по умолчанию случайные 1..--max-amount)')
+    parser.add_argument('--max-amount', type=int, default=1000, help='Максимальный номинал банкноты')
+    parser.add_argument('--change-share', type=float, default=0.5, help='Доля платежей со сдачей')
+    parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора')
+    parser.add_argument('--output', '-o', help='Файл для результата в JSON (по умолчанию stdout)')
+    args = parser.parse_args(argv)
+    if not args.duration and not args.payments:
+        parser.error("нужно задать --duration или --payments")
+    if bool(args.bank_url) != bool(args.client_url):
+        parser.error("--bank-url и --client-url задаются вместе")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.bank_url:
+        result = run(args, args.bank_url.rstrip('/'), args.client_url.rstrip('/'))
+    else:
+        with LocalServers(args.server_mode, workers=args.workers) as servers:
+            result = run(args, servers.bank_url, servers.client_url)
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 1 if result["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
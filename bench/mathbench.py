@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Микробенчмарки математики платежей (bank/paymentMath.py и client/paymentMath.py).
+
+Каждая операция замеряется для набора номиналов и размеров ключа.
+Результаты можно сохранить как базовые (--save) и сравнить с ними
+(--compare): запуск завершается с кодом 1, если какая-либо операция
+стала медленнее базовой более чем на --threshold.
+
+Пример:
+    python bench/mathbench.py --save bench/baseline.json
+    python bench/mathbench.py --compare bench/baseline.json --threshold 0.2
+    python bench/mathbench.py --key-sizes 512,1024,2048 --filter sign
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import importlib.util
+from math import gcd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Общие модули (denominations) одинаковы в bank/ и client/
+sys.path.insert(0, os.path.join(ROOT, 'client'))
+
+DEFAULT_AMOUNTS = [1, 10, 1000, 10 ** 6, 2 ** 38 - 1]
+DEFAULT_KEY_SIZES = [512]
+
+
+def _load(name, path):
+    """Загрузка модуля по пути: в bank/ и client/ модули называются одинаково"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+bank_math = _load('bank_paymentMath', 'bank/paymentMath.py')
+client_math = _load('client_paymentMath', 'client/paymentMath.py')
+
+
+def generate_key(bits, e, rng):
+    """Ключ заданной длины с p - 1 и q - 1, взаимно простыми с e"""
+    from Crypto.Util.number import getPrime
+
+    def prime():
+        while True:
+            candidate = getPrime(bits // 2, randfunc=lambda size: rng.getrandbits(size * 8).to_bytes(size, 'big'))
+            if gcd(candidate - 1, e) == 1:
+                return candidate
+
+    p = prime()
+    q = prime()
+    while q == p:
+        q = prime()
+    return bank_math.SigningKey(p, q, e)
+
+
+def measure(func, min_time, repeat):
+    """Время одной операции в наносекундах: (минимум, медиана) по repeat замерам"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+    samples = [elapsed / loops]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        samples.append((time.perf_counter() - start) / loops)
+    samples.sort()
+    return samples[0] * 1e9, samples[len(samples) // 2] * 1e9, loops
+
+
+def cases(key_sizes, amounts, seed):
+    """Пары (имя, функция) для всех операций, номиналов и размеров ключа"""
+    rng = random.Random(seed)
+    # generate_blinding_factor использует общий генератор
+    random.seed(seed)
+    h = client_math.get_h()
+    divisors = client_math.divisors
+    for amount in amounts:
+        yield (f"select_amount_exponent/amount={amount}",
+               lambda amount=amount: client_math.select_amount_exponent(amount, divisors))
+
+    for bits in key_sizes:
+        # Ключ системной длины - исходный ключ банка, остальные генерируются
+        if bits == bank_math.n.bit_length():
+            key = bank_math.SigningKey(bank_math.p, bank_math.q, h)
+        else:
+            key = generate_key(bits, h, rng)
+        n = key.n
+        r = client_math.generate_blinding_factor(n)
+        s = rng.randint(2, n - 1)
+        blinded = client_math.create_blinded_message(s, r, h, n)
+        signed_blinded = key.sign(blinded)
+        signed_bill = client_math.unblind_signed(signed_blinded, r, n)
+        prefix = f"{bits}"
+
+        yield f"mod_inverse/{prefix}", lambda: client_math.mod_inverse(r, n)
+        yield f"create_blinded_message/{prefix}", lambda: client_math.create_blinded_message(s, r, h, n)
+        yield f"unblind_signed/{prefix}", lambda: client_math.unblind_signed(signed_blinded, r, n)
+        yield f"bank_sign_blinded/{prefix}", lambda: key.sign(blinded)
+        yield f"full_domain_hash/{prefix}", lambda: client_math.full_domain_hash("0" * 32, n)
+
+        for amount in amounts:
+            exp = client_math.select_amount_exponent(amount, divisors)
+            payment = client_math.create_payment_message(signed_bill, exp, n)
+            change = client_math.create_change_request(s, r, exp, n)
+            name = f"{prefix}/amount={amount}"
+            yield f"create_payment_message/{name}", lambda exp=exp: client_math.create_payment_message(signed_bill, exp, n)
+            yield f"verify_payment/{name}", lambda payment=payment, exp=exp: client_math.verify_payment(payment, h, exp, n)
+            yield f"bank_sign_change/{name}", lambda change=change, exp=exp: key.sign_with(change, exp)
+            # Без кэша: первая подпись сдачи с новой экспонентой
+            yield f"bank_sign_change_uncached/{name}", lambda change=change, exp=exp: key._sign_crt(
+                change, exp, key._exponent_params(exp))
+
+
+def run(args):
+    results = {}
+    for name, func in cases(args.key_sizes, args.amounts, args.seed):
+        if args.filter and args.filter not in name:
+            continue
+        best, median, loops = measure(func, args.min_time, args.repeat)
+        results[name] = {"ns_per_op": round(best, 1), "median_ns": round(median, 1), "loops": loops}
+        print(f"{name:60s} {best / 1000:12.2f} мкс", file=sys.stderr)
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {"key_sizes": args.key_sizes, "amounts": args.amounts, "seed": args.seed},
+        "results": results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """Список операций, ставших медленнее базовых более чем на threshold"""
+    regressions = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        ratio = result["ns_per_op"] / base["ns_per_op"]
+        mark = 'ЗАМЕДЛЕНИЕ' if ratio > 1 + threshold else ''
+        print(f"{name:60s} {ratio:8.3f}x {mark}", file=sys.stderr)
+        if ratio > 1 + threshold:
+            regressions.append({"name": name, "ratio": round(ratio, 3),
+                                "baseline_ns": base["ns_per_op"], "current_ns": result["ns_per_op"]})
+    return regressions
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Микробенчмарки paymentMath")
+    parser.add_argument('--key-sizes', type=_int_list, default=DEFAULT_KEY_SIZES,
+                        help='Размеры модуля n в битах через запятую (512 - ключ банка)')
+    parser.add_argument('--amounts', type=_int_list, default=DEFAULT_AMOUNTS, help='Номиналы через запятую')
+    parser.add_argument('--filter', help='Замерять только операции, в имени которых есть подстрока')
+    parser.add_argument('--min-time', type=float, default=0.05, help='Минимальная длительность одного замера, с')
+    parser.add_argument('--repeat', type=int, default=5, help='Число замеров каждой операции')
+    parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора')
+    parser.add_argument('--save', help='Сохранить результат как базовый в файл')
+    parser.add_argument('--compare', help='Сравнить с базовым результатом из файла')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Допустимое замедление относительно базового (0.25 = 25%%)')
+    parser.add_argument('--output', '-o', help='Файл для результата в JSON (по умолчанию stdout)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run(args)
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        result["threshold"] = args.threshold
+        result["regressions"] = compare(result, baseline, args.threshold)
+        if result["regressions"]:
+            print(f"Замедление более чем на {args.threshold:.0%}: "
+                  f"{', '.join(item['name'] for item in result['regressions'])}", file=sys.stderr)
+            status = 1
+
+    output = json.dumps(result, indent=2)
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write(output + '\n')
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    elif not args.save:
+        print(output)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,378 @@
+import asyncio
+import logging
+from functools import wraps
+import aiohttp
+from aiohttp import web
+import payments
+from clientSide import CLIENT_API_URL
+from httpClient import (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_POOL_SIZE, HTTP_RETRIES, DEADLINE_HEADER,
+                        IDEMPOTENCY_HEADER, IDEMPOTENT_METHODS, retry_delay, retryable_status, parse_retry_after)
+from server import BANK_SERVER_URL, CLIENT_ID, VERIFY_BATCH_MAX_ITEMS
+from verifier import payment_verifier
+from keyCache import key_cache
+from deposits import deposit_accumulator
+import wire
+import metrics
+import profiling
+
+# Асинхронный режим клиентского сервера: обработчики платежа не занимают поток
+# на время запросов к банку и плательщику, математика выполняется в пуле
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+routes = web.RouteTableDef()
+
+
+async def run_math(func, *args):
+    """Выполнение тяжёлой модульной арифметики вне цикла событий"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(payment_verifier.executor(), func, *args)
+
+
+async def read_json(request):
+    """Тело запроса (JSON или msgpack)"""
+    body = await request.read()
+    if not body:
+        return None
+    try:
+        with profiling.span('parse'):
+            return wire.decode_body(body, request.headers.get('Content-Type'))
+    except ValueError:
+        return None
+
+
+def respond(request, payload, status=200):
+    """Ответ в msgpack, если клиент его принимает, иначе JSON"""
+    with profiling.span('serialize'):
+        if wire.wants_msgpack(request.headers.get('Accept')):
+            return web.Response(body=wire.encode(payload), status=status,
+                                content_type=wire.MSGPACK_CONTENT_TYPE)
+        return web.json_response(payload, status=status)
+
+
+async def call(http, method, url, payload=None, headers=None, retries=HTTP_RETRIES):
+    """Исходящий запрос, возвращает (код ответа, тело ответа).
+
+    Повторы - как в httpClient: идемпотентный запрос (GET или запрос с ключом идемпотентности,
+    который сохраняется во всех попытках) повторяется при сбое соединения и ответах 502-504,
+    любой запрос - при 429 и если соединение не было установлено; пауза учитывает Retry-After
+    """
+    method = method.upper()
+    headers = dict(headers or {})
+    idempotent = method in IDEMPOTENT_METHODS or IDEMPOTENCY_HEADER in headers
+    headers.setdefault(DEADLINE_HEADER, str(HTTP_READ_TIMEOUT))
+    kwargs = {}
+    if wire.msgpack_enabled():
+        headers['Accept'] = f"{wire.MSGPACK_CONTENT_TYPE}, {wire.JSON_CONTENT_TYPE};q=0.9"
+    if payload is not None:
+        content_type = wire.request_content_type()
+        headers['Content-Type'] = content_type
+        kwargs['data'] = wire.encode(payload, content_type)
+
+    attempts = 1 + max(0, retries)
+    for attempt in range(attempts):
+        last_attempt = attempt == attempts - 1
+        retry_after = None
+        try:
+            with profiling.span('http'):
+                async with http.request(method, url, headers=headers, **kwargs) as response:
+                    body = await response.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            # Соединение не установлено - запрос не отправлен, повтор безопасен для любого метода
+            if last_attempt or not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+                raise
+        else:
+            if last_attempt or not retryable_status(response.status, idempotent):
+                try:
+                    data = wire.decode_body(body, response.headers.get('Content-Type')) if body else {}
+                except ValueError:
+                    data = {}
+                return response.status, data
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        logger.warning(f"Повтор запроса {method} {url} (попытка {attempt + 2} из {attempts})")
+        await asyncio.sleep(retry_delay(attempt, retry_after=retry_after))
+
+
+async def resolve_key(http, kid):
+    """Ключ банка по идентификатору (при промахе кэша - запрос к банку); None для неизвестного ключа"""
+    key = key_cache.get(kid)
+    if key is not None or not kid:
+        return key
+    status_code, params = await call(http, 'GET', key_cache.url(kid))
+    if status_code == 404:
+        return None
+    if status_code != 200:
+        raise aiohttp.ClientError(f"Код ответа банковского сервера: {status_code}")
+    return key_cache.put(params, kid)
+
+
+def handle_bank_request(func):
+    @wraps(func)
+    async def wrapper(request):
+        try:
+            return await func(request)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при обращении к банковскому серверу: {str(e)}")
+            return respond(request, {
+                "status": "error",
+                "message": "Не удалось связаться с банковским сервером"
+            }, status=503)
+    return wrapper
+
+
+@routes.get('/')
+async def home(request):
+    return respond(request, {
+        "status": "online",
+        "message": "Клиентский сервер работает",
+        "bank_server": BANK_SERVER_URL,
+        "client_id": CLIENT_ID
+    })
+
+
+# Проверка соединения с банковским сервером
+@routes.get('/api/v1/check-bank')
+@handle_bank_request
+async def check_bank_connection(request):
+    status_code, bank_status = await call(request.app['http'], 'GET', f"{BANK_SERVER_URL}/api/v1/status")
+    if status_code == 200:
+        return respond(request, {"status": "ok", "bank_status": bank_status})
+    return respond(request, {
+        "status": "error",
+        "message": f"Код ответа банковского сервера: {status_code}"
+    }, status=400)
+
+
+# Приём платежа продавцом
+@routes.post('/api/v1/payment')
+@handle_bank_request
+async def get_payment(request):
+    data = await read_json(request)
+    error = payments.check_payment_request(data)
+    if error:
+        return respond(request, {"status": "error", "message": error}, status=400)
+
+    http = request.app['http']
+    key = await resolve_key(http, data.get('kid'))
+    if key is None:
+        return respond(request, {"status": "error", "message": payments.UNKNOWN_KEY}, status=400)
+
+    with metrics.timed('verify'):
+        verified_payment = await run_math(payments.verify_payment, data['payment'], data['payment_exp'], key,
+                                          data.get('note_exp'))
+    if not payments.serial_matches(verified_payment, data['nonce'], key):
+        return respond(request, {"status": "error", "message": payments.INVALID_PAYMENT}, status=400)
+
+    # Погашение банкноты в банке (защита от двойной траты) вместе с подписью сдачи:
+    # при отказе банка банкнота остаётся непотраченной
+    status_code, redeem_data = await call(http, 'POST', f"{BANK_SERVER_URL}/api/v1/banknotes/redeem",
+                                          payments.redeem_request(data, CLIENT_ID),
+                                          payments.redeem_headers(request.headers))
+    error = payments.redeem_error(status_code)
+    if error:
+        body, status_code = error
+        return respond(request, body, status=status_code)
+
+    # Платёж зачисляется на счёт продавца пакетом вместе с другими
+    deposit_accumulator.add(payments.deposit_entry(data))
+
+    if not payments.needs_change(data):
+        return respond(request, payments.payment_response(data))
+
+    signed_change_blinded = redeem_data['signed_change_blinded']
+
+    # Отправка сдачи плательщику
+    if payments.notify_payer(data):
+        status_code, _ = await call(http, 'POST', f"{CLIENT_API_URL}/api/v1/verify-change",
+                                    payments.change_notification(signed_change_blinded, data))
+        if status_code != 200:
+            logger.warning(f"Плательщик не принял сдачу: код ответа {status_code}")
+
+    return respond(request, payments.payment_response(data, signed_change_blinded))
+
+
+@routes.post('/api/v1/verify-change')
+async def verify_change(request):
+    data = await read_json(request)
+    error = payments.check_change_request(data)
+    if error:
+        return respond(request, {"status": "error", "message": error}, status=400)
+
+    transaction = payments.find_change_transaction(data)
+    if transaction is None:
+        return respond(request, {"status": "error", "message": "Транзакция для сдачи не найдена"}, status=404)
+
+    with metrics.timed('unblind'):
+        change_bill, valid = await run_math(payments.unblind_change, data['signed_change_blinded'],
+                                            data['change_exp'], transaction)
+    # Сдачу сохраняет плательщик из ответа на платёж; уведомление только подтверждает её
+    if valid:
+        payments.complete_transaction(data)
+    return respond(request, {"status": "ok" if valid else "error", "change_bill": change_bill})
+
+
+# Пакетная проверка платежей продавцом
+@routes.post('/api/v1/payments/verify-batch')
+@handle_bank_request
+async def verify_payments_batch(request):
+    data = await read_json(request)
+    if not data or not isinstance(data.get('payments'), list):
+        return respond(request, {"status": "error", "message": "Поле payments должно быть списком"}, status=400)
+    if len(data['payments']) > VERIFY_BATCH_MAX_ITEMS:
+        return respond(request, {
+            "status": "error",
+            "message": f"Слишком большой пакет: максимум {VERIFY_BATCH_MAX_ITEMS} платежей"
+        }, status=413)
+
+    keys = {}
+    for kid in payments.batch_kids(data['payments']):
+        keys[kid] = await resolve_key(request.app['http'], kid)
+    loop = asyncio.get_running_loop()
+    with metrics.timed('verify-batch'):
+        verified = await loop.run_in_executor(None, payments.verify_batch, data['payments'], keys)
+    results = [{"status": "ok", "serial": value} if ok else {"status": "error", "message": value}
+               for ok, value in verified]
+    return respond(request, {"status": "ok", "results": results})
+
+
+# Метрики в формате Prometheus
+@routes.get('/metrics')
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.registry.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start = metrics.request_started()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        metrics.request_finished(start, route, request.method, status)
+
+
+@web.middleware
+async def profiling_middleware(request, handler):
+    state = profiling.begin_request(profile=False)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        profiling.end_request(state, route, request.method, status)
+
+
+def admin(func):
+    @wraps(func)
+    async def wrapper(request):
+        if not profiling.authorized(request.headers):
+            return respond(request, {"status": "error", "message": "Нет доступа"}, status=403)
+        return await func(request)
+    return wrapper
+
+
+@admin
+async def profile_status(request):
+    return respond(request, {"status": "ok", "profiler": profiling.profiler.status(),
+                             "spans": profiling.span_store.summary()})
+
+
+@admin
+async def profile_start(request):
+    try:
+        seconds, rate, memory = profiling.parse_start(await read_json(request))
+        status = profiling.profiler.start(seconds, rate, memory)
+    except ValueError as e:
+        return respond(request, {"status": "error", "message": str(e)}, status=400)
+    if rate > 0:
+        # Запросы выполняются в одном потоке, поэтому cProfile охватывает весь цикл событий
+        profiling.profiler.start_thread_profile()
+        asyncio.get_running_loop().call_later(seconds, profiling.profiler.stop_thread_profile)
+    return respond(request, {"status": "ok", "profiler": status})
+
+
+@admin
+async def profile_pstats(request):
+    data = profiling.profiler.pstats_bytes()
+    if data is None:
+        return respond(request, {"status": "error", "message": "Нет данных cProfile"}, status=404)
+    return web.Response(body=data, content_type='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename=profile.pstats'})
+
+
+@admin
+async def profile_collapsed(request):
+    return web.Response(text=profiling.profiler.collapsed(), content_type='text/plain',
+                        headers={'Content-Disposition': 'attachment; filename=profile.collapsed'})
+
+
+@admin
+async def profile_memory(request):
+    memory = profiling.profiler.memory()
+    if memory is None:
+        return respond(request, {"status": "error", "message": "Нет данных tracemalloc"}, status=404)
+    return respond(request, {"status": "ok", "top": memory})
+
+
+@web.middleware
+async def error_middleware(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPNotFound:
+        return respond(request, {"status": "error", "message": "Ресурс не найден"}, status=404)
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Внутренняя ошибка клиентского сервера: {str(e)}")
+        return respond(request, {"status": "error", "message": "Внутренняя ошибка сервера"}, status=500)
+
+
+async def _start_http(app):
+    # Неблокирующий HTTP-клиент с пулом keep-alive соединений
+    app['http'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=HTTP_POOL_SIZE),
+        timeout=aiohttp.ClientTimeout(connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+    )
+
+
+async def _stop_http(app):
+    await app['http'].close()
+
+
+def create_app():
+    middlewares = [metrics_middleware, error_middleware]
+    if profiling.PROFILING_ENABLED:
+        middlewares.insert(1, profiling_middleware)
+    app = web.Application(middlewares=middlewares)
+    app.add_routes(routes)
+    if profiling.PROFILING_ENABLED:
+        # Этапы запросов и /admin/profile подключаются только при PROFILING_ENABLED=1
+        app.router.add_get('/admin/profile', profile_status)
+        app.router.add_post('/admin/profile/start', profile_start)
+        app.router.add_get('/admin/profile/pstats', profile_pstats)
+        app.router.add_get('/admin/profile/collapsed', profile_collapsed)
+        app.router.add_get('/admin/profile/memory', profile_memory)
+        profiling.start_on_boot()
+    app.on_startup.append(_start_http)
+    app.on_cleanup.append(_stop_http)
+    return app
+
+
+def run(host=None, port=None, sock=None, handle_signals=False):
+    """Запуск сервера на host:port или на готовом сокете sock (рабочий процесс)"""
+    logger.info(f"Клиентский сервер (asyncio) запускается на порту {port or sock.getsockname()[1]}")
+    # Свой цикл событий: сервер может работать не в главном потоке (режим both)
+    loop = asyncio.new_event_loop()
+    web.run_app(create_app(), host=host, port=port, sock=sock, print=None,
+                handle_signals=handle_signals, loop=loop)
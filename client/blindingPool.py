@@ -0,0 +1,118 @@
+import os
+import logging
+import threading
+from collections import deque, namedtuple
+import paymentMath as pm
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация: пул пополняется, когда в нём меньше LOW множителей, до HIGH штук
+BLINDING_POOL_LOW = int(os.environ.get('BLINDING_POOL_LOW', 4))
+BLINDING_POOL_HIGH = int(os.environ.get('BLINDING_POOL_HIGH', 16))
+# Суммы сдачи, для которых множители готовятся заранее (через запятую)
+BLINDING_POOL_AMOUNTS = os.environ.get('BLINDING_POOL_AMOUNTS', '')
+# Сколько экспонент сдачи пул запоминает по промахам
+BLINDING_POOL_MAX_EXPONENTS = int(os.environ.get('BLINDING_POOL_MAX_EXPONENTS', 16))
+
+# Затеняющий множитель: r, r^exp mod n и r^-1 mod n
+BlindingFactor = namedtuple('BlindingFactor', ['r', 'r_exp', 'r_inv'])
+
+
+def make_blinding_factor(exp, n):
+    r = pm.generate_blinding_factor(n)
+    return BlindingFactor(r, pow(r, exp, n), pm.mod_inverse(r, n))
+
+
+class BlindingPool:
+    """Пул заранее вычисленных затеняющих множителей, пополняемый фоновым потоком"""
+    def __init__(self, n, exponents=(), low=BLINDING_POOL_LOW, high=BLINDING_POOL_HIGH,
+                 max_exponents=BLINDING_POOL_MAX_EXPONENTS):
+        self.n = n
+        self.low = low
+        self.high = max(low, high)
+        self.max_exponents = max_exponents
+        self._pools = {exp: deque() for exp in exponents}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refill_loop, name='blinding-pool', daemon=True)
+                self._thread.start()
+                logger.info(f"Пул затеняющих множителей запущен, экспонент: {len(self._pools)}")
+
+    def add_exponent(self, exp):
+        """Добавление экспоненты в пополняемый набор"""
+        with self._cond:
+            if exp not in self._pools and len(self._pools) < self.max_exponents:
+                self._pools[exp] = deque()
+                self._cond.notify()
+
+    def set_modulus(self, n):
+        """Смена ключа банка: множители для прежнего модуля сбрасываются"""
+        with self._cond:
+            if n != self.n:
+                self.n = n
+                for pool in self._pools.values():
+                    pool.clear()
+                self._cond.notify()
+
+    def take(self, exp):
+        """Готовый множитель для экспоненты exp (при пустом пуле - вычисляется сразу)"""
+        with self._cond:
+            pool = self._pools.get(exp)
+            if pool:
+                factor = pool.popleft()
+                self.hits += 1
+                if len(pool) < self.low:
+                    self._cond.notify()
+                return factor
+            self.misses += 1
+        self.add_exponent(exp)
+        return make_blinding_factor(exp, self.n)
+
+    def _next_exponent(self):
+        for exp, pool in self._pools.items():
+            if len(pool) < self.low:
+                return exp
+        return None
+
+    def _refill_loop(self):
+        while True:
+            with self._cond:
+                exp = self._next_exponent()
+                while exp is None:
+                    self._cond.wait()
+                    exp = self._next_exponent()
+                missing = self.high - len(self._pools[exp])
+                n = self.n
+            for _ in range(missing):
+                factor = make_blinding_factor(exp, n)
+                with self._cond:
+                    if self.n != n:
+                        break
+                    self._pools[exp].append(factor)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "sizes": {exp: len(pool) for exp, pool in self._pools.items()},
+            }
+
+
+def _configured_exponents():
+    exponents = [pm.get_h()]
+    for amount in BLINDING_POOL_AMOUNTS.split(','):
+        if amount.strip():
+            exponents.append(pm.select_amount_exponent(int(amount), pm.divisors))
+    return exponents
+
+
+# Общий пул затеняющих множителей
+blinding_pool = BlindingPool(pm.n, _configured_exponents())
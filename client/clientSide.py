@@ -6,6 +6,12 @@ import uuid
 import sys
 from service import *
 import paymentMath as pm
+from blindingPool import blinding_pool, make_blinding_factor
+from keyCache import key_cache
+from wallet import wallet
+import payments
+from prefetcher import prefetcher, account_balance
+from httpClient import http_client, read_payload, idempotency_headers
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, 
@@ -20,9 +26,7 @@ CLIENT_API_URL = f"http://localhost:{CLIENT_PORT}"
 
 
 def console_menu(local_account=None):
-    getting_n = 0
-    getting_divisors = []
-    money = 0
+    key = None  # ключ банка, которым подписываются купюры
     transactionNumber = 0
 
     """Консольное меню для взаимодействия с банковской системой"""
@@ -30,6 +34,13 @@ def console_menu(local_account=None):
     print(f"ID клиента: {CLIENT_ID}")
     print(f"Банковский сервер: {BANK_SERVER_URL}")
     print(f"Клиентский API: {CLIENT_API_URL}")
+
+    # Затеняющие множители готовятся в фоне
+    blinding_pool.start()
+    # Банкноты частых номиналов выпускаются про запас в пределах доли баланса
+    prefetcher.start(client_id=CLIENT_ID)
+    # Платежи, ответ на которые не был получен до завершения клиента
+    resume_payments()
     
     while True:
         print("\n==== Клиентское меню ====")
@@ -47,127 +58,73 @@ def console_menu(local_account=None):
               start_money = int(input("Введите стартовое количество денег: "))
               print(start_money)
 
-              response = requests.post(
+              # Повторное создание возвращает существующий счёт, поэтому запрос идемпотентен
+              response = http_client.post(
                   f"{BANK_SERVER_URL}/api/v1/create-client",
                   json={
                       "start_money": start_money,
                       "client_id": CLIENT_ID,
-                  }
+                  },
+                  idempotent=True
               )
-              print(response.json())
+              result = read_payload(response)
+              print(result)
 
-              result = response.json()
-              getting_divisors = result["divisors"]
-              getting_n = result["n"]
-              money = start_money
+              # Банк сообщает свой основной ключ; параметры ключа кэшируются по идентификатору
+              key = key_cache.put(result)
+              blinding_pool.set_modulus(key.n)
           except Exception as e:
               print(e)
 
         elif choice == "2":
-            print(f"на вашем счету {money} у.е.")
+            try:
+                # Баланс ведёт банк: номиналы выпущенных банкнот уже списаны
+                money = account_balance(CLIENT_ID)
+                if money is None:
+                    print("Счёт в банке ещё не создан")
+                else:
+                    print(f"на вашем счету {money} у.е.")
+            except Exception as e:
+                print(f"Не удалось получить баланс счёта: {str(e)}")
+            balance, count = wallet.balance()
+            print(f"в кошельке {balance} у.е. ({count} банкнот)")
 
         elif choice == '3':
             try:
-                max_amount = 2 ** (len(pm.divisors) - 1)
-                h = pm.get_h()
-
-                print(f"Максимально возможная сумма: {max_amount}")
-                amount = int(input(f"Введите сумму купюры (0..{max_amount}): "))
-                if amount > max_amount or amount < 0:
-                    print(f"Ошибка: Недопустимый номинал.")
+                resume_payments()
+                if key is None:
+                    key = key_cache.primary()
+                    blinding_pool.set_modulus(key.n)
+                max_amount = 2 ** (len(key.divisors) - 1)
+
+                payment_amount = int(input(f"Введите сумму платежа (0..{max_amount}): "))
+                if payment_amount > max_amount or payment_amount < 0:
+                    print("Сумма платежа вне допустимого диапазона!")
                     continue
 
-                if amount > money:
-                    print(f"Ошибка: на балансе нет такого количества денег")
-                    continue
+                # Оплата банкнотой из кошелька; банк нужен, только если подходящей нет
+                prefetcher.record(payment_amount)
+                note = wallet.reserve(payment_amount)
+                if note is not None:
+                    print(f"Оплата банкнотой из кошелька номиналом {note.amount}")
+                else:
+                    print("В кошельке нет подходящей банкноты, выпуск новой")
+                    amount = int(input(f"Введите сумму купюры ({payment_amount}..{max_amount}): "))
+                    if amount > max_amount or amount < payment_amount:
+                        print(f"Ошибка: Недопустимый номинал.")
+                        continue
+
+                    # Банк сам проверяет баланс при выпуске (402 при недостатке средств)
+                    note = issue_banknote(key, amount)
+                    if note is None:
+                        continue
 
                 transaction = Transaction(transactionNumber)
                 transactionNumber += 1
-
-                # Инициализация купюры
-                s1 = random.randint(2, pm.n - 1)
-                r1 = pm.generate_blinding_factor(pm.n)
-                transaction.amount = amount
-                transaction.s1 = s1
-                transaction.r1 = r1
-                # создаём затенённую купюру
-                blinded_msg = pm.create_blinded_message(s1, r1, h, pm.n)
-
-                # отправляем на подпись
-                response = requests.post(
-                    f"{BANK_SERVER_URL}/api/v1/banknotes",
-                    json={"banknote": blinded_msg}
-                )
-                if response.status_code != 200:
-                    print(f"Ошибка: Код ответа {response.status_code}")
-                    continue
-
-                banknote_data = response.json()
-                if banknote_data.get("status") != "ok":
-                    print(f"Ошибка: {banknote_data.get('message', 'Неизвестная ошибка')}")
-                    continue
-
-                print(f"Банкнота успешно подписана: {banknote_data['signed_banknote']}!")
-
-                # Снятие затемнения
-                signed_bill = pm.unblind_signed(banknote_data['signed_banknote'], r1, pm.n)
-                print(f"Подписанная купюра: {signed_bill}")
-
-                # Платеж
-                payment_amount = int(input(f"Введите сумму платежа (0..{amount}): "))
-                while payment_amount > amount or payment_amount < 0:
-                    print("Сумма платежа вне допустимого диапазона!")
-                    payment_amount = int(input(f"Введите сумму платежа (0..{amount}): "))
-
-                transaction.payment_amount = payment_amount
-
-                payment_exp = pm.select_amount_exponent(payment_amount, pm.divisors)
-                print(f"Экспонента для платежа {payment_amount}: {payment_exp}")
-
-                payment_msg = pm.create_payment_message(signed_bill, payment_exp, pm.n)
-
-
-                """print(f"Платеж абоненту B: {payment_msg}")"""
-                req = {
-                    "payment": payment_msg,
-                    "s1": s1,  # ТОЛЬКО ДЛЯ ПРОВЕРКИ
-                    "payment_exp": payment_exp,
-                    "payment_amount": payment_amount,
-                    "amount": amount,
-                }
-                if payment_amount < amount:
-                    change_amount = amount - payment_amount
-                    t = random.randint(2, pm.n - 1)
-                    ra = pm.generate_blinding_factor(pm.n)
-                    change_exp = pm.select_amount_exponent(change_amount, pm.divisors)
-                    print(f"\nСдача: {change_amount}, экспонента: {change_exp}")
-
-                    blinded_change = pm.create_change_request(t, ra, change_exp, pm.n)
-
-                    req["t"] = t
-                    req["ra"] = ra
-                    req["blinded_change"] = blinded_change
-                    req["change_exp"] = change_exp
-
-                List_transaction.append(transaction)
-
-                response = requests.post(
-                    f"{CLIENT_API_URL}/api/v1/payment",
-                    json=req
-                )
-
-                if response.status_code != 200:
-                    print(f"Произошла ошибка оплаты: {response.status_code}")
-
-                post_payment_data = response.json()
-                if post_payment_data.get("status") != "ok":
-                    print("Оплата завершилась неудачно")
-
-                # local_account += post_payment_data.get("change_bill")
+                settle(note, pay(note, payment_amount, transaction))
 
             except Exception as e:
-                print(f"Ошибка при создании банкноты: {str(e)}")
-
+                print(f"Ошибка при оплате: {str(e)}")
 
         elif choice == '0':
             print("Выход из меню")
@@ -178,10 +135,199 @@ def console_menu(local_account=None):
         
         time.sleep(1)
 
+def issue_banknote(key, amount):
+    """Выпуск банкноты за счёт клиента: подпись затенённой купюры банком, банкнота сохраняется в кошельке занятой"""
+    n = key.n
+    nonce, s1 = pm.new_note_serial(n)
+    factor = blinding_pool.take(key.h)
+    # создаём затенённую купюру
+    blinded_msg = pm.create_blinded_message_precomputed(s1, factor.r_exp, n)
+
+    # отправляем на подпись
+    response = http_client.post(
+        f"{BANK_SERVER_URL}/api/v1/banknotes",
+        json={"banknote": blinded_msg, "amount": amount, "client_id": CLIENT_ID, "kid": key.kid},
+        headers=idempotency_headers(),
+        idempotent=True
+    )
+    if response.status_code == 402:
+        print("Ошибка: Недостаточно средств на счёте")
+        return None
+    if response.status_code != 200:
+        print(f"Ошибка: Код ответа {response.status_code}")
+        return None
+
+    banknote_data = read_payload(response)
+    if banknote_data.get("status") != "ok":
+        print(f"Ошибка: {banknote_data.get('message', 'Неизвестная ошибка')}")
+        return None
+
+    print(f"Банкнота успешно подписана: {banknote_data['signed_banknote']}!")
+
+    # Снятие затемнения
+    signed_bill = pm.unblind_with_inverse(banknote_data['signed_banknote'], factor.r_inv, n)
+    print(f"Подписанная купюра: {signed_bill}")
+    if pow(signed_bill, key.h, n) != s1:
+        print("Ошибка: Подпись банкноты не прошла проверку")
+        return None
+    return wallet.add_banknote(s1, nonce, signed_bill, amount, key, reserved=True)
+
+
+def pay(note, payment_amount, transaction):
+    """Оплата банкнотой кошелька; остаток возвращается сдачей в кошелёк.
+
+    Сдача приходит в ответе продавца и сохраняется в кошельке до того, как банкнота
+    будет удалена. Результат - как у send_payment.
+    """
+    # Номиналы кодируются делителями ключа, которым подписана банкнота, а не текущими по умолчанию
+    try:
+        key = key_cache.resolve(note.kid)
+    except Exception as e:
+        print(f"Ошибка при получении ключа банкноты: {str(e)}")
+        return False
+    if key is None:
+        print(f"Ошибка: Ключ банкноты {note.kid} неизвестен банку")
+        return False
+
+    n = note.n
+    transaction.kid = note.kid
+    transaction.n = n
+    transaction.amount = note.amount
+    transaction.s1 = note.serial
+    transaction.payment_amount = payment_amount
+
+    payment_exp = pm.select_amount_exponent(payment_amount, key.divisors)
+    print(f"Экспонента для платежа {payment_amount}: {payment_exp}")
+
+    payment_msg = pm.create_payment_message(note.signature, payment_exp, n, note.note_exp)
+
+    """print(f"Платеж абоненту B: {payment_msg}")"""
+    req = {
+        "payment": payment_msg,
+        "s1": note.serial,  # ТОЛЬКО ДЛЯ ПРОВЕРКИ
+        "payment_exp": payment_exp,
+        "payment_amount": payment_amount,
+        "amount": note.amount,
+        "note_exp": note.note_exp,
+        "nonce": note.nonce,
+        "kid": note.kid,
+    }
+    if payment_amount < note.amount:
+        change_amount = note.amount - payment_amount
+        change_nonce, t = pm.new_note_serial(n)
+        change_exp = pm.select_amount_exponent(change_amount, key.divisors)
+        # Пул готовит множители для модуля основного ключа; банкнота могла быть подписана прежним
+        if n == blinding_pool.n:
+            ra_factor = blinding_pool.take(change_exp)
+        else:
+            ra_factor = make_blinding_factor(change_exp, n)
+        print(f"\nСдача: {change_amount}, экспонента: {change_exp}")
+
+        blinded_change = pm.create_blinded_message_precomputed(t, ra_factor.r_exp, n)
+
+        transaction.t = t
+        transaction.change_nonce = change_nonce
+        transaction.ra = ra_factor.r
+        transaction.ra_inv = ra_factor.r_inv
+        req["t"] = t
+        req["ra"] = ra_factor.r
+        req["blinded_change"] = blinded_change
+        req["change_exp"] = change_exp
+
+    req["transaction_id"] = transaction.id
+
+    # Запрос сохраняется до отправки: если ответ не придёт, платёж повторяется с тем же
+    # ключом идемпотентности, и продавец получит от банка тот же ответ со сдачей
+    headers = idempotency_headers()
+    wallet.mark_pending(note, {"request": req, "headers": headers, "ra_inv": transaction.ra_inv,
+                               "change_nonce": transaction.change_nonce})
+    return send_payment(req, headers, transaction)
+
+
+def send_payment(req, headers, transaction):
+    """Отправка платежа продавцу.
+
+    Возвращает True, если банкнота потрачена (в том числе ранее), False, если платёж
+    отклонён, и None, если ответ не получен: банкнота остаётся ожидающей повтора
+    """
+    transactions.add(transaction)
+    try:
+        response = http_client.post(
+            f"{CLIENT_API_URL}/api/v1/payment",
+            json=req,
+            headers=headers,
+            idempotent=True
+        )
+    except Exception as e:
+        print(f"Ответ на платёж не получен, он будет повторён: {str(e)}")
+        return None
+    finally:
+        transactions.complete(transaction.id)
+
+    if response.status_code == 409:
+        print("Банкнота уже потрачена, она удалена из кошелька")
+        return True
+    if response.status_code >= 500:
+        # Продавец мог успеть погасить банкноту в банке: исход неизвестен
+        print(f"Ошибка оплаты: {response.status_code}, платёж будет повторён")
+        return None
+    if response.status_code != 200:
+        print(f"Произошла ошибка оплаты: {response.status_code}")
+        return False
+
+    post_payment_data = read_payload(response)
+    if post_payment_data.get("status") != "ok":
+        print("Оплата завершилась неудачно")
+        return False
+
+    if "blinded_change" in req:
+        receive_change(post_payment_data.get("signed_change_blinded"), req["change_exp"], transaction)
+    return True
+
+
+def settle(note, spent):
+    """Банкнота удаляется после платежа, возвращается в кошелёк после отказа, остаётся ожидающей без ответа"""
+    if spent:
+        wallet.remove(note)
+    elif spent is False:
+        wallet.release(note)
+
+
+def resume_payments():
+    """Повтор платежей, ответ на которые не был получен, с сохранёнными ключами идемпотентности"""
+    for note, payment in wallet.pending():
+        req = payment['request']
+        transaction = Transaction(0, req['transaction_id'])
+        transaction.kid = note.kid
+        transaction.n = note.n
+        transaction.amount = note.amount
+        transaction.s1 = note.serial
+        transaction.payment_amount = req['payment_amount']
+        transaction.t = req.get('t', 0)
+        transaction.ra = req.get('ra', 0)
+        transaction.ra_inv = payment.get('ra_inv') or 0
+        transaction.change_nonce = payment.get('change_nonce')
+        print(f"Повтор платежа {req['payment_amount']} у.е. банкнотой номиналом {note.amount}")
+        settle(note, send_payment(req, payment['headers'], transaction))
+
+
+def receive_change(signed_change_blinded, change_exp, transaction):
+    """Снятие затемнения со сдачи из ответа продавца, проверка и сохранение в кошельке"""
+    if signed_change_blinded is None:
+        logger.error(f"Продавец не вернул сдачу по транзакции {transaction.id}")
+        return None
+    change_bill, valid = payments.unblind_change(signed_change_blinded, change_exp, transaction)
+    if not valid:
+        logger.error(f"Сдача по транзакции {transaction.id} не прошла проверку")
+        return None
+    print(f"Полученная сдача: {pm.amount_from_exponent(change_exp)} у.е.")
+    return payments.keep_change(change_bill, change_exp, transaction)
+
+
 def check_server_connection():
     """Проверка соединения с сервером"""
     try:
-        response = requests.get(f"{CLIENT_API_URL}")
+        response = http_client.get(f"{CLIENT_API_URL}")
         if response.status_code == 200:
             logger.info("Клиентский сервер доступен")
             return True
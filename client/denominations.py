@@ -0,0 +1 @@
+../common/denominations.py
\ No newline at end of file
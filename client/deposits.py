@@ -0,0 +1,210 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+import metrics
+from httpClient import http_client, read_payload, idempotency_headers
+
+# Зачисление платежей продавцу пакетами: проверенные и погашенные платежи
+# накапливаются и отправляются в банк одним запросом, когда их набралось
+# DEPOSIT_BATCH_SIZE или самый старый ждёт DEPOSIT_MAX_AGE секунд. Банк проверяет
+# платежи сам и зачисляет их одной транзакцией; повторное зачисление банкноты
+# он отклоняет, поэтому пакет после сбоя можно отправить снова.
+# Счёт продавца создаётся при запуске потока отправки; если счёта нет (404),
+# он создаётся заново перед повтором. Другие ответы 4xx означают, что пакет
+# не будет принят и при повторе: платежи отбрасываются с записью в лог.
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+BANK_SERVER_URL = os.environ.get('BANK_SERVER_URL', 'http://localhost:8080')
+DEPOSIT_ENABLED = os.environ.get('DEPOSIT_ENABLED', '1') != '0'
+DEPOSIT_BATCH_SIZE = int(os.environ.get('DEPOSIT_BATCH_SIZE', 50))
+DEPOSIT_MAX_AGE = float(os.environ.get('DEPOSIT_MAX_AGE', 5))
+# Наибольшее число платежей в очереди (например, пока у продавца нет счёта в банке)
+DEPOSIT_MAX_PENDING = int(os.environ.get('DEPOSIT_MAX_PENDING', 100000))
+
+
+class DepositAccumulator:
+    """Накопление платежей продавца и их пакетное зачисление в банке"""
+    def __init__(self, merchant_id=None, bank_url=BANK_SERVER_URL, batch_size=DEPOSIT_BATCH_SIZE,
+                 max_age=DEPOSIT_MAX_AGE, max_pending=DEPOSIT_MAX_PENDING):
+        self.merchant_id = merchant_id
+        self.bank_url = bank_url
+        self.batch_size = max(1, batch_size)
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self._pending = deque()  # (платёж, время добавления)
+        self._cond = threading.Condition()
+        self._flusher = None
+        self._pid = None
+        self._account_ready = False
+        self.deposited = 0
+        self.rejected = 0
+        self.credited = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def add(self, entry):
+        """Платёж для зачисления: payment, payment_exp, nonce, note_exp, kid"""
+        if not DEPOSIT_ENABLED:
+            return
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                # Погашенная банкнота остаётся закреплённой за продавцом, её можно зачислить позже
+                self._pending.popleft()
+                self.dropped += 1
+                logger.error(f"Очередь зачисления переполнена, платёж отброшен (всего {self.dropped})")
+            self._pending.append((entry, time.monotonic()))
+            self._start_flusher()
+            # Поток пересчитывает срок отправки: первый платёж задаёт возраст пакета
+            self._cond.notify()
+
+    def start(self):
+        """Запуск потока отправки при старте сервера: он сразу создаёт счёт продавца"""
+        if not DEPOSIT_ENABLED:
+            return
+        with self._cond:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        # Поток отправки запускается в процессе, который принимает платежи (после fork - заново)
+        if self._flusher is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._flusher = threading.Thread(target=self._flush_loop, name='deposits', daemon=True)
+            self._flusher.start()
+
+    def _due(self):
+        if len(self._pending) >= self.batch_size:
+            return 0.0
+        if not self._pending:
+            return None
+        return max(0.0, self._pending[0][1] + self.max_age - time.monotonic())
+
+    def _ensure_account(self):
+        """Создание счёта продавца (повторное создание возвращает существующий счёт); False при сбое"""
+        if self._account_ready:
+            return True
+        try:
+            response = http_client.post(
+                f"{self.bank_url}/api/v1/create-client",
+                json={"client_id": self.merchant_id, "start_money": 0},
+                idempotent=True
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось создать счёт продавца: {str(e)}")
+            return False
+        if response.status_code != 200:
+            logger.warning(f"Не удалось создать счёт продавца: код ответа {response.status_code}")
+            return False
+        self._account_ready = True
+        logger.info(f"Счёт продавца {self.merchant_id} готов")
+        return True
+
+    def _flush_loop(self):
+        while not self._ensure_account():
+            time.sleep(self.max_age)
+        while True:
+            with self._cond:
+                delay = self._due()
+                while delay is None or delay > 0:
+                    self._cond.wait(delay)
+                    delay = self._due()
+                batch = self._take()
+            if not self._send(batch):
+                # Банк недоступен: платежи возвращаются в начало очереди до следующей попытки
+                with self._cond:
+                    now = time.monotonic()
+                    self._pending.extendleft((entry, now) for entry in reversed(batch))
+                time.sleep(self.max_age)
+                self._ensure_account()
+
+    def _take(self):
+        count = min(self.batch_size, len(self._pending))
+        return [self._pending.popleft()[0] for _ in range(count)]
+
+    def _send(self, batch):
+        """Отправка пакета; False, если его нужно повторить (сбой, 5xx или нет счёта продавца)"""
+        try:
+            response = http_client.post(
+                f"{self.bank_url}/api/v1/deposits",
+                json={"merchant_id": self.merchant_id, "payments": batch},
+                headers=idempotency_headers(),
+                idempotent=True
+            )
+            data = read_payload(response)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Ошибка при зачислении платежей: {str(e)}")
+            return False
+        if response.status_code == 404:
+            # Счёта продавца нет (например, база банка пересоздана): он создаётся перед повтором
+            self.failures += 1
+            self._account_ready = False
+            logger.error(f"Банк не зачислил платежи: нет счёта продавца {self.merchant_id}")
+            return False
+        if 400 <= response.status_code < 500:
+            # Запрос отклонён и при повторе будет отклонён снова
+            self.failures += 1
+            self.dropped += len(batch)
+            logger.error(f"Банк отклонил пакет: код ответа {response.status_code}, {data.get('message')}; "
+                         f"отброшено платежей: {len(batch)}")
+            return True
+        if response.status_code != 200:
+            self.failures += 1
+            logger.error(f"Банк не зачислил платежи: код ответа {response.status_code}, {data.get('message')}")
+            return False
+
+        rejected = [result for result in data['results'] if result.get('status') != 'ok']
+        for result in rejected:
+            logger.warning(f"Платёж не зачислен: {result.get('message')}")
+        self.batches += 1
+        self.deposited += len(batch) - len(rejected)
+        self.rejected += len(rejected)
+        self.credited += data.get('credited', 0)
+        logger.info(f"Зачислено платежей: {len(batch) - len(rejected)} из {len(batch)}, "
+                    f"сумма {data.get('credited')}, баланс {data.get('balance')}")
+        return True
+
+    def flush(self):
+        """Немедленная отправка накопленных платежей (при завершении процесса)"""
+        while True:
+            with self._cond:
+                if not self._pending or self._pid != os.getpid():
+                    return
+                batch = self._take()
+            if not self._send(batch):
+                logger.error(f"Не зачислено платежей при завершении: {len(batch) + len(self._pending)}")
+                return
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "deposited": self.deposited,
+            "rejected": self.rejected,
+            "credited": self.credited,
+            "batches": self.batches,
+            "failures": self.failures,
+            "dropped": self.dropped,
+        }
+
+
+# Общий накопитель зачислений (идентификатор продавца задаёт сервер)
+deposit_accumulator = DepositAccumulator()
+atexit.register(deposit_accumulator.flush)
+
+
+def _stats():
+    stats = deposit_accumulator.stats()
+    return [(('deposited',), stats['deposited']), (('rejected',), stats['rejected']), (('dropped',), stats['dropped'])]
+
+
+metrics.registry.collected('deposits_total', 'Платежи, отправленные на зачисление', 'counter', _stats, ('result',))
+metrics.registry.collected('deposits_pending', 'Платежи, ожидающие зачисления', 'gauge',
+                           lambda: [((), deposit_accumulator.stats()['pending'])])
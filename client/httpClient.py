@@ -0,0 +1,152 @@
+import os
+import time
+import random
+import logging
+import threading
+import uuid
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+import wire
+import profiling
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.1))
+# Наибольшая пауза по заголовку Retry-After, секунды
+HTTP_MAX_RETRY_AFTER = float(os.environ.get('HTTP_MAX_RETRY_AFTER', 5))
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+# Сколько секунд клиент ждёт ответ: сервер не начинает работу, результат которой уже некому получить
+DEADLINE_HEADER = 'X-Request-Timeout'
+RETRY_STATUSES = (502, 503, 504)
+
+
+class HttpClient:
+    """HTTP-клиент с пулом keep-alive соединений на каждый хост и повторами"""
+    def __init__(self, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _session(self, url):
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount(host, adapter)
+                self._sessions[host] = session
+            return session
+
+    def _sleep_before_retry(self, attempt, retry_after=None):
+        time.sleep(retry_delay(attempt, self.backoff, retry_after))
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        """Запрос с таймаутами; идемпотентные запросы повторяются при сбоях"""
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.timeout)
+        headers = dict(kwargs.pop('headers', None) or {})
+        timeout = kwargs['timeout']
+        if timeout:
+            headers.setdefault(DEADLINE_HEADER, str(timeout[1] if isinstance(timeout, tuple) else timeout))
+        if wire.msgpack_enabled():
+            # Тело и ответ в msgpack; сервер без поддержки msgpack ответит JSON
+            headers.setdefault('Accept', f"{wire.MSGPACK_CONTENT_TYPE}, {wire.JSON_CONTENT_TYPE};q=0.9")
+            if 'json' in kwargs:
+                kwargs['data'] = wire.encode(kwargs.pop('json'))
+                headers['Content-Type'] = wire.MSGPACK_CONTENT_TYPE
+        kwargs['headers'] = headers
+        session = self._session(url)
+
+        attempts = 1 + max(0, self.retries)
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            retry_after = None
+            try:
+                with profiling.span('http'):
+                    response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Соединение не установлено (отказ, таймаут) - запрос не отправлен, повтор безопасен для любого метода
+                if last_attempt or not (idempotent or not_sent(e)):
+                    raise
+            else:
+                # 429 - запрос не принят в обработку, повтор безопасен для любого метода
+                if last_attempt or not retryable_status(response.status_code, idempotent):
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            logger.warning(f"Повтор запроса {method} {url} (попытка {attempt + 2} из {attempts})")
+            self._sleep_before_retry(attempt, retry_after)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def not_sent(error):
+    """Ошибка возникла при установке соединения, до отправки запроса"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # requests оборачивает ошибку urllib3: MaxRetryError с причиной NewConnectionError (подкласс ConnectTimeoutError)
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def retry_delay(attempt, backoff=HTTP_BACKOFF, retry_after=None):
+    """Пауза перед повтором: экспоненциальная задержка со случайным разбросом (full jitter),
+    но не меньше паузы, которую попросил сервер (не более HTTP_MAX_RETRY_AFTER)"""
+    delay = random.uniform(0, backoff * (2 ** attempt))
+    if retry_after:
+        delay = max(delay, min(retry_after, HTTP_MAX_RETRY_AFTER))
+    return delay
+
+
+def retryable_status(status_code, idempotent):
+    """Ответ, после которого запрос можно повторить: 429 не принят в обработку, 502-504 - для идемпотентных"""
+    return status_code == 429 or (idempotent and status_code in RETRY_STATUSES)
+
+
+def parse_retry_after(value):
+    """Пауза из заголовка Retry-After в секундах (формат с датой не поддерживается)"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def idempotency_headers():
+    """Новый ключ идемпотентности: повторы запроса с ним банк не выполняет заново"""
+    return {IDEMPOTENCY_HEADER: uuid.uuid4().hex}
+
+
+def read_payload(response):
+    """Тело ответа (JSON или msgpack)"""
+    return wire.decode_body(response.content, response.headers.get('Content-Type'))
+
+
+# Общий HTTP-клиент для обращений к банку и другим клиентам
+http_client = HttpClient()
@@ -0,0 +1,126 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from math import prod
+import paymentMath as pm
+from httpClient import http_client, read_payload
+
+# Открытые параметры ключей банка по идентификаторам. Параметры ключа
+# не меняются, поэтому хранятся без срока; основной ключ банка
+# перезапрашивается раз в KEY_CACHE_TTL секунд
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+BANK_SERVER_URL = os.environ.get('BANK_SERVER_URL', 'http://localhost:8080')
+KEY_CACHE_TTL = float(os.environ.get('KEY_CACHE_TTL', 300))
+
+
+def key_id(n, e):
+    """Идентификатор ключа: отпечаток открытых параметров (так же считает банк)"""
+    return hashlib.sha256(f"{n}:{e}".encode()).hexdigest()[:16]
+
+
+class PublicKey:
+    """Открытые параметры ключа банка"""
+    __slots__ = ('kid', 'n', 'h', 'divisors')
+
+    def __init__(self, kid, n, h, divisors):
+        self.kid = kid
+        self.n = n
+        self.h = h
+        self.divisors = divisors
+
+    @classmethod
+    def from_params(cls, params):
+        """Ключ из ответа банка; ValueError, если параметры не соответствуют идентификатору"""
+        try:
+            kid, n = params['kid'], int(params['n'])
+            divisors = tuple(int(d) for d in params.get('divisors') or pm.divisors)
+            h = int(params.get('e') or prod(divisors))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Некорректные параметры ключа")
+        if prod(divisors) != h:
+            raise ValueError(f"Ключ {kid}: открытая экспонента не соответствует делителям")
+        if key_id(n, h) != kid:
+            raise ValueError(f"Ключ {kid}: параметры не соответствуют идентификатору")
+        return cls(kid, n, h, divisors)
+
+
+# Ключ запросов без идентификатора (до появления ключей в хранилище банка)
+DEFAULT_KEY = PublicKey(None, pm.n, pm.get_h(), tuple(pm.divisors))
+
+
+class KeyCache:
+    """Кэш открытых параметров ключей банка"""
+    def __init__(self, bank_url=BANK_SERVER_URL, ttl=KEY_CACHE_TTL):
+        self.bank_url = bank_url
+        self.ttl = ttl
+        self._keys = {None: DEFAULT_KEY}
+        self._primary = None
+        self._primary_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def url(self, kid):
+        return f"{self.bank_url}/api/v1/keys/{kid}"
+
+    def get(self, kid):
+        """Ключ из кэша или None"""
+        with self._lock:
+            key = self._keys.get(kid)
+            if key is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return key
+
+    def put(self, params, kid=None):
+        """Сохранение параметров ключа из ответа банка.
+
+        kid - запрошенный идентификатор: ValueError, если банк вернул другой ключ
+        """
+        key = PublicKey.from_params(params)
+        if kid is not None and key.kid != kid:
+            raise ValueError(f"Запрошен ключ {kid}, банк вернул ключ {key.kid}")
+        with self._lock:
+            return self._keys.setdefault(key.kid, key)
+
+    def resolve(self, kid):
+        """Ключ по идентификатору с запросом к банку при промахе; None для неизвестного ключа"""
+        key = self.get(kid)
+        if key is not None or not kid:
+            return key
+        response = http_client.get(self.url(kid))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return self.put(read_payload(response), kid)
+
+    def primary(self):
+        """Основной ключ банка (перезапрашивается раз в ttl секунд)"""
+        with self._lock:
+            if self._primary is not None and time.monotonic() - self._primary_at < self.ttl:
+                return self._primary
+        response = http_client.get(f"{self.bank_url}/api/v1/keys")
+        response.raise_for_status()
+        data = read_payload(response)
+        for params in data['keys']:
+            self.put(params)
+        with self._lock:
+            self._primary = self._keys[data['primary']]
+            self._primary_at = time.monotonic()
+            logger.info(f"Основной ключ банка: {self._primary.kid}")
+            return self._primary
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._keys) - 1}
+
+
+# Общий кэш ключей
+key_cache = KeyCache()
@@ -6,6 +6,8 @@ import threading
 import time
 import logging
 import clientSide
+import prefork
+import metrics
 import importlib
 from Crypto.PublicKey import RSA
 import signal
@@ -16,10 +18,43 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 
+SERVER_MODE = os.environ.get('CLIENT_SERVER_MODE', 'flask')
+# Число рабочих процессов сервера (режим server): 1 - один процесс, 0 - по числу ядер
+CLIENT_WORKERS = int(os.environ.get('CLIENT_WORKERS', 1))
+
+def run_server_workers(workers):
+    """Запуск серверной части в нескольких процессах на общем сокете"""
+    import server
+    logger.info("Запуск серверной части (несколько процессов)...")
+    sock = prefork.listen('0.0.0.0', server.CLIENT_PORT)
+
+    if SERVER_MODE == 'async':
+        import asyncServer
+
+        def worker():
+            metrics.registry.share(prefork.shared_dir)
+            server.deposit_accumulator.start()
+            asyncServer.run(sock=sock, handle_signals=True)
+    else:
+        def worker():
+            metrics.registry.share(prefork.shared_dir)
+            server.deposit_accumulator.start()
+            prefork.serve_wsgi(server.app, sock)
+
+    prefork.serve(worker, workers, name='client')
+
 def run_server():
     """Запуск серверной части (API)"""
     import server
     logger.info("Запуск серверной части...")
+    # Поток зачисления создаёт счёт продавца при запуске
+    server.deposit_accumulator.start()
+
+    if SERVER_MODE == 'async':
+        # Асинхронный режим (aiohttp), обработчики платежа - корутины
+        import asyncServer
+        asyncServer.run(host='0.0.0.0', port=server.CLIENT_PORT)
+        return
     
     # Динамически импортируем и запускаем сервер
     if hasattr(server, 'app') and hasattr(server, 'CLIENT_PORT'):
@@ -62,8 +97,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Запуск банковского клиента")
     parser.add_argument('--mode', '-m', type=str, choices=['server', 'client', 'both'], 
                         default='both', help='Режим запуска: server, client или both (по умолчанию)')
+    parser.add_argument('--server-mode', type=str, choices=['flask', 'async'], default=None,
+                        help='Режим сервера: flask (по умолчанию) или async')
+    parser.add_argument('--workers', '-w', type=int, default=CLIENT_WORKERS,
+                        help='Число рабочих процессов сервера в режиме server (0 - по числу ядер)')
     
     args = parser.parse_args()
+    if args.server_mode:
+        SERVER_MODE = args.server_mode
     
     # Обработка сигналов прерывания
     def signal_handler(sig, frame):
@@ -74,7 +115,10 @@ if __name__ == "__main__":
 
 
     try:
-        if args.mode == 'server':
+        workers = prefork.resolve_workers(args.workers)
+        if args.mode == 'server' and workers > 1:
+            run_server_workers(workers)
+        elif args.mode == 'server':
             run_server()
         elif args.mode == 'client':
             run_client()
@@ -1,6 +1,9 @@
 import random
+import hashlib
+import secrets
 from math import gcd
-from functools import reduce
+from functools import reduce, lru_cache
+from denominations import DenominationCodec
 # from server import bank_sign_blinded, bank_sign_change  # Импорт серверных функций
 
 # Массив делителей (доступен и клиенту, и серверу)
@@ -8,7 +11,16 @@ divisors = [3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67,
             71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131, 137,
             139, 149, 151, 157, 163, 167, 173]
 
-# Параметры системы (доступны клиенту)
+# Кодек номиналов для системных делителей
+codec = DenominationCodec(divisors)
+
+# Серийный номер банкноты - хэш случайной строки nonce по модулю ключа (FDH).
+# Лишние байты хэша делают распределение по модулю равномерным
+FDH_EXTRA_BYTES = 16
+NONCE_MAX_LENGTH = 128
+
+# Модуль исходного ключа банка: используется для запросов без идентификатора ключа,
+# параметры остальных ключей клиент получает из банка (keyCache)
 n = 7340319761155748661749371063757287359076613120562021623339822878007388760496894682101855614243031851692369942145494922651206179917235015123962197550362007
 
 
@@ -26,6 +38,30 @@ def mod_inverse(a, m):
     return (x % m + m) % m
 
 
+def full_domain_hash(nonce, n):
+    """Серийный номер банкноты: хэш nonce, растянутый на всю область модуля n (FDH).
+
+    Корень из серийного номера нельзя получить без банка ни для какого nonce,
+    поэтому по nonce проверяется, что платёж сделан из банкноты, подписанной банком
+    """
+    size = (n.bit_length() + 7) // 8 + FDH_EXTRA_BYTES
+    digest = hashlib.shake_256(f"{n}:{nonce}".encode()).digest(size)
+    return int.from_bytes(digest, 'big') % n
+
+
+def check_nonce(nonce):
+    """Сообщение об ошибке в nonce банкноты или None"""
+    if not isinstance(nonce, str) or not 0 < len(nonce) <= NONCE_MAX_LENGTH:
+        return f"nonce должен быть непустой строкой длиной до {NONCE_MAX_LENGTH} символов"
+    return None
+
+
+def new_note_serial(n):
+    """Случайный nonce и серийный номер банкноты FDH(nonce) для ключа с модулем n"""
+    nonce = secrets.token_hex(16)
+    return nonce, full_domain_hash(nonce, n)
+
+
 def generate_blinding_factor(n):
     while True:
         r = random.randint(2, n - 1)
@@ -33,25 +69,46 @@ def generate_blinding_factor(n):
             return r
 
 
+@lru_cache(maxsize=8)
+def _codec_for(divisors):
+    return DenominationCodec(divisors)
+
+
 def select_amount_exponent(amount, divisors):
     """Выбор экспоненты на основе двоичного представления суммы"""
-    if amount < 0 or amount >= 2 ** len(divisors):
-        raise ValueError(f"Сумма должна быть в диапазоне 0..{2 ** (len(divisors) - 1)}")
-    binary = bin(amount)[2:].zfill(len(divisors))
-    selected_divisors = [divisors[i] for i in range(len(divisors)) if binary[len(divisors) - 1 - i] == '1']
-    return reduce(lambda x, y: x * y, selected_divisors) if selected_divisors else 1
+    if divisors is globals()['divisors']:
+        return codec.encode(amount)
+    return _codec_for(tuple(divisors)).encode(amount)
+
+
+def amount_from_exponent(exp):
+    """Сумма, которую кодирует экспонента (ValueError для недопустимой экспоненты)"""
+    return codec.decode(exp)
 
 
 def create_blinded_message(s, r, exp, n):
     return (s * pow(r, exp, n)) % n
 
 
+def create_blinded_message_precomputed(s, r_exp, n):
+    """Затенение с готовым r^exp mod n"""
+    return (s * r_exp) % n
+
+
+def unblind_with_inverse(signed_msg, r_inv, n):
+    """Снятие затемнения с готовым r^-1 mod n"""
+    return (signed_msg * r_inv) % n
+
+
 def unblind_signed(signed_msg, r, n):
     r_inv = mod_inverse(r, n)
     return (signed_msg * r_inv) % n
 
 
-def create_payment_message(signed_bill, payment_exp, n):
+def create_payment_message(signed_bill, payment_exp, n, note_exp=None):
+    """Платёж из банкноты; на все биты банкноты (payment_exp == note_exp) - сама подпись банкноты"""
+    if payment_exp == note_exp:
+        return signed_bill
     return pow(signed_bill, payment_exp, n)
 
 
@@ -64,10 +121,76 @@ def unblind_change(signed_change, ra, n):
     return (signed_change * ra_inv) % n
 
 
-def verify_payment(payment_msg, h, payment_exp, n):
-    check_exp = h // payment_exp
+@lru_cache(maxsize=1024)
+def payment_check_exponent(note_exp, payment_exp):
+    """Экспонента проверки платежа note_exp // payment_exp (с кэшированием).
+
+    Платёж на все биты банкноты совпал бы с серийным номером, поэтому он передаётся
+    подписью банкноты и проверяется экспонентой note_exp
+    """
+    check_exp = note_exp // payment_exp
+    return check_exp if check_exp > 1 else note_exp
+
+
+def verify_payment(payment_msg, note_exp, payment_exp, n):
+    """Серийный номер банкноты из платежа; note_exp - экспонента подписи банкноты (h для купюры банка)"""
+    check_exp = payment_check_exponent(note_exp, payment_exp)
     return pow(payment_msg, check_exp, n)
 
+
+def verify_payment_group(payments, check_exp, n):
+    """Проверка группы платежей с одной экспонентой"""
+    return [pow(payment_msg, check_exp, n) for payment_msg in payments]
+
+
+def verify_payments_batch(items, h, n, executor=None, chunk_size=64):
+    """Пакетная проверка платежей [(payment, payment_exp), ...].
+
+    Элемент может содержать третьим значением модуль своего ключа (иначе n),
+    четвёртым - экспоненту подписи банкноты (иначе h, для сдачи - экспонента её суммы).
+    Платежи группируются по модулю и экспонентам; экспонента проверки группы
+    note_exp // payment_exp (для платежа на все биты банкноты - note_exp) берётся
+    из кэша payment_check_exponent. Группы делятся на части и выполняются
+    в executor (если передан). Для каждого платежа возвращается (True, s)
+    или (False, сообщение об ошибке).
+    """
+    results = [None] * len(items)
+    groups = {}
+    for i, item in enumerate(items):
+        try:
+            payment_msg, payment_exp = int(item[0]), int(item[1])
+            item_n = int(item[2]) if len(item) > 2 else n
+            note_exp = int(item[3]) if len(item) > 3 else h
+        except (TypeError, ValueError, IndexError):
+            results[i] = (False, "Некорректные данные платежа")
+            continue
+        if not 0 < payment_msg < item_n:
+            results[i] = (False, "Платёж вне диапазона 1..n-1")
+        elif note_exp <= 0 or h % note_exp != 0:
+            results[i] = (False, "Экспонента банкноты не является делителем h")
+        elif payment_exp <= 0 or note_exp % payment_exp != 0:
+            results[i] = (False, "Экспонента платежа не является делителем экспоненты банкноты")
+        else:
+            groups.setdefault((item_n, payment_exp, note_exp), []).append((i, payment_msg))
+
+    tasks = []
+    for (group_n, payment_exp, note_exp), group in groups.items():
+        check_exp = payment_check_exponent(note_exp, payment_exp)
+        for start in range(0, len(group), chunk_size):
+            chunk = group[start:start + chunk_size]
+            payments = [payment_msg for _, payment_msg in chunk]
+            if executor is None:
+                tasks.append((chunk, verify_payment_group(payments, check_exp, group_n)))
+            else:
+                tasks.append((chunk, executor.submit(verify_payment_group, payments, check_exp, group_n)))
+
+    for chunk, verified in tasks:
+        if executor is not None:
+            verified = verified.result()
+        for (i, _), value in zip(chunk, verified):
+            results[i] = (True, value)
+    return results
+
 def get_h():
     return reduce(lambda x, y: x * y, divisors)
 
@@ -0,0 +1,229 @@
+import paymentMath as pm
+import service
+from service import Transaction
+from verifier import payment_verifier
+from wallet import wallet
+from httpClient import IDEMPOTENCY_HEADER, idempotency_headers
+
+# Логика платежа, общая для Flask и асинхронного режима клиентского сервера
+
+PAYMENT_FIELDS = ['payment', 's1', 'payment_exp', 'payment_amount', 'nonce']
+CHANGE_FIELDS = ['blinded_change', 'change_exp']
+
+
+def _missing(data, fields):
+    return [field for field in fields if field not in data]
+
+
+def check_payment_request(data):
+    """Сообщение об ошибке в запросе платежа или None"""
+    if not data:
+        return "Не указаны данные транзакции"
+    missing_fields = _missing(data, PAYMENT_FIELDS)
+    if missing_fields:
+        return f"Отсутствуют обязательные поля: {', '.join(missing_fields)}"
+    if needs_change(data) and _missing(data, CHANGE_FIELDS):
+        return "не хватает обязательных полей для сдачи"
+    if not isinstance(data.get('kid', ''), str):
+        return "Идентификатор ключа должен быть строкой"
+    error = pm.check_nonce(data['nonce'])
+    if error:
+        return error
+    return check_exponents(data)
+
+
+def check_exponents(data):
+    """Экспоненты платежа и сдачи должны кодировать заявленные суммы"""
+    try:
+        if pm.amount_from_exponent(data['payment_exp']) != data['payment_amount']:
+            return "Экспонента платежа не соответствует сумме платежа"
+        if needs_change(data) and pm.amount_from_exponent(data['change_exp']) != data['amount'] - data['payment_amount']:
+            return "Экспонента сдачи не соответствует сумме сдачи"
+        if data.get('note_exp') is not None:
+            return check_note_exponent(data)
+    except (TypeError, ValueError):
+        return "Некорректная экспонента платежа или сдачи"
+    return None
+
+
+def check_note_exponent(data):
+    """Банкнота, подписанная экспонентой note_exp (сдача), оплачивает только делители этой экспоненты"""
+    note_exp = data['note_exp']
+    note_amount = pm.amount_from_exponent(note_exp)
+    if note_exp % data['payment_exp'] != 0:
+        return "Экспонента платежа не делит экспоненту банкноты"
+    if note_exp != pm.codec.h and data.get('amount', note_amount) != note_amount:
+        return "Номинал не соответствует экспоненте банкноты"
+    return None
+
+
+def needs_change(data):
+    return data['payment_amount'] < data.get('amount', data['payment_amount'])
+
+
+UNKNOWN_KEY = "Неизвестный ключ банка"
+INVALID_PAYMENT = "Платёж не прошёл проверку подписи банкноты"
+
+
+def verify_payment(payment, payment_exp, key, note_exp=None):
+    """Проверка платежа продавцом ключом банка key, возвращает серийный номер банкноты.
+
+    note_exp - экспонента подписи банкноты (по умолчанию открытая экспонента ключа)
+    """
+    return pm.verify_payment(payment, note_exp or key.h, payment_exp, key.n)
+
+
+def serial_matches(serial, nonce, key):
+    """Проверенный платёж сделан из банкноты с серийным номером FDH(nonce)"""
+    return serial == pm.full_domain_hash(nonce, key.n)
+
+
+def _entry_kid(entry):
+    kid = entry.get('kid')
+    return kid if kid is None or isinstance(kid, str) else ''
+
+
+def batch_kids(entries):
+    """Идентификаторы ключей элементов пакета проверки"""
+    return {_entry_kid(entry) for entry in entries if isinstance(entry, dict)}
+
+
+def verify_batch(entries, keys):
+    """Пакетная проверка платежей; keys - ключи по идентификаторам (None - неизвестный ключ)"""
+    items = []
+    unknown = set()
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            items.append(None)
+            continue
+        key = keys.get(_entry_kid(entry))
+        if key is None:
+            unknown.add(i)
+            items.append(None)
+            continue
+        items.append((entry.get('payment'), entry.get('payment_exp'), key.n, entry.get('note_exp') or key.h))
+    verified = payment_verifier.verify(items)
+    results = []
+    for i, (entry, result) in enumerate(zip(entries, verified)):
+        if i in unknown:
+            result = (False, UNKNOWN_KEY)
+        elif result[0] and entry.get('nonce') is not None:
+            # Элемент с nonce проверяется и по серийному номеру
+            key = keys[_entry_kid(entry)]
+            if pm.check_nonce(entry['nonce']) or not serial_matches(result[1], entry['nonce'], key):
+                result = (False, INVALID_PAYMENT)
+        results.append(result)
+    return results
+
+
+def payment_entry(data):
+    """Платёж для проверки банком: серийный номер банк получает из него сам и сверяет с FDH(nonce)"""
+    entry = {"payment": data['payment'], "payment_exp": data['payment_exp'], "nonce": data['nonce']}
+    for field in ('note_exp', 'kid'):
+        if data.get(field) is not None:
+            entry[field] = data[field]
+    return entry
+
+
+def redeem_request(data, merchant_id=None):
+    """Погашение банкноты из платежа data; зачислить её сможет только продавец merchant_id.
+
+    Сдача подписывается тем же ключом, что и банкнота, в том же запросе: банк
+    погашает банкноту только вместе с подписью сдачи
+    """
+    request = payment_entry(data)
+    if merchant_id is not None:
+        request["merchant_id"] = merchant_id
+    if needs_change(data):
+        request["blinded_change"] = data['blinded_change']
+        request["change_exp"] = data['change_exp']
+    return request
+
+
+def redeem_headers(headers):
+    """Ключ идемпотентности погашения - ключ запроса плательщика (headers - заголовки его запроса).
+
+    Повтор платежа с тем же ключом получает от банка сохранённый ответ со сдачей,
+    а не отказ как для потраченной банкноты
+    """
+    key = headers.get(IDEMPOTENCY_HEADER)
+    return {IDEMPOTENCY_HEADER: key} if key else idempotency_headers()
+
+
+def deposit_entry(data):
+    """Платёж для пакетного зачисления (банк проверяет его сам)"""
+    return payment_entry(data)
+
+
+def redeem_error(status_code):
+    """(ответ, код) при отказе банка в погашении банкноты или None"""
+    if status_code == 409:
+        return {"status": "error", "message": "Банкнота уже потрачена"}, 409
+    if 400 <= status_code < 500 and status_code != 429:
+        # Банк отклонил платёж и отклонит его повтор
+        return {"status": "error", "message": f"Банк отклонил платёж: код ответа {status_code}"}, 400
+    if status_code != 200:
+        return {"status": "error", "message": f"Код ответа банковского сервера: {status_code}"}, 502
+    return None
+
+
+def change_notification(signed_change_blinded, data):
+    """Запрос к плательщику с подписанной сдачей"""
+    notification = {
+        "transaction_id": data['transaction_id'],
+        "signed_change_blinded": signed_change_blinded,
+        "change_exp": data['change_exp'],
+    }
+    if data.get('kid') is not None:
+        notification["kid"] = data['kid']
+    return notification
+
+
+def notify_payer(data):
+    """Сдача отправляется плательщику, только если он указал свою транзакцию"""
+    return 'transaction_id' in data
+
+
+def payment_response(data, signed_change_blinded=None):
+    response = {"status": "ok"}
+    if 'transaction_id' in data:
+        response["transaction_id"] = data['transaction_id']
+    if signed_change_blinded is not None:
+        response["signed_change_blinded"] = signed_change_blinded
+    return response
+
+
+def check_change_request(data):
+    """Сообщение об ошибке в запросе со сдачей или None"""
+    if not data:
+        return "не указаны данные со сдачей"
+    for field in ['signed_change_blinded', 'change_exp', 'transaction_id']:
+        if field not in data:
+            return f"нет необходимого поля {field}"
+    return None
+
+
+def unblind_change(signed_change_blinded, change_exp, transaction: Transaction):
+    """Снятие затемнения и проверка сдачи, возвращает (сдача, результат проверки)"""
+    # Модуль ключа, которым плательщик затенял сдачу
+    n = transaction.n or pm.n
+    if transaction.ra_inv:
+        change_bill = pm.unblind_with_inverse(signed_change_blinded, transaction.ra_inv, n)
+    else:
+        change_bill = pm.unblind_change(signed_change_blinded, transaction.ra, n)
+    verified_change = pow(change_bill, change_exp, n)
+    return change_bill, verified_change == transaction.t
+
+
+def keep_change(change_bill, change_exp, transaction):
+    """Проверенная сдача сохраняется в кошельке плательщика"""
+    wallet.add_change(change_bill, change_exp, transaction)
+
+
+def find_change_transaction(data):
+    """Транзакция, к которой относится сдача"""
+    return service.transactions.get(data['transaction_id'])
+
+
+def complete_transaction(data):
+    service.transactions.complete(data['transaction_id'])
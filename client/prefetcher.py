@@ -0,0 +1,204 @@
+import os
+import time
+import logging
+import threading
+from collections import Counter, deque
+import paymentMath as pm
+import metrics
+from blindingPool import blinding_pool
+from keyCache import key_cache
+from httpClient import http_client, read_payload, idempotency_headers
+from wallet import wallet
+
+# Фоновый выпуск банкнот: по последним платежам определяются частые номиналы,
+# и в кошельке поддерживается запас банкнот этих номиналов. Банкноты
+# подписываются пакетом, когда клиент не платит, поэтому платёж обходится
+# обменом с продавцом. Банк списывает суммы банкнот со счёта клиента при выпуске,
+# поэтому стоимость запаса ограничена бюджетом и долей баланса счёта.
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+BANK_SERVER_URL = os.environ.get('BANK_SERVER_URL', 'http://localhost:8080')
+PREFETCH_ENABLED = os.environ.get('PREFETCH_ENABLED', '1') != '0'
+# Сколько последних платежей учитывается при выборе номиналов
+PREFETCH_WINDOW = int(os.environ.get('PREFETCH_WINDOW', 50))
+# Сколько самых частых номиналов держать в запасе
+PREFETCH_DENOMINATIONS = int(os.environ.get('PREFETCH_DENOMINATIONS', 4))
+# Всего банкнот в запасе; делится между номиналами по частоте платежей
+PREFETCH_STOCK = int(os.environ.get('PREFETCH_STOCK', 8))
+# Наибольшая сумма банкнот в кошельке, до которой запас пополняется
+PREFETCH_BUDGET = int(os.environ.get('PREFETCH_BUDGET', 1000))
+# Наибольшая доля баланса счёта в запасе
+PREFETCH_BALANCE_SHARE = float(os.environ.get('PREFETCH_BALANCE_SHARE', 0.5))
+# Запас пополняется, если клиент не платил столько секунд
+PREFETCH_IDLE = float(os.environ.get('PREFETCH_IDLE', 1))
+# Период проверки запаса, секунды
+PREFETCH_INTERVAL = float(os.environ.get('PREFETCH_INTERVAL', 5))
+# Наибольшее число банкнот в одном пакетном запросе к банку
+PREFETCH_BATCH = int(os.environ.get('PREFETCH_BATCH', 16))
+
+
+def account_balance(client_id, bank_url=BANK_SERVER_URL):
+    """Баланс счёта клиента по данным банка или None, если счёта нет"""
+    response = http_client.get(f"{bank_url}/api/v1/accounts/{client_id}")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return read_payload(response)['balance']
+
+
+class Prefetcher:
+    """Поддержание запаса подписанных банкнот частых номиналов"""
+    def __init__(self, wallet=wallet, bank_url=BANK_SERVER_URL, window=PREFETCH_WINDOW,
+                 denominations=PREFETCH_DENOMINATIONS, stock=PREFETCH_STOCK, budget=PREFETCH_BUDGET,
+                 balance_share=PREFETCH_BALANCE_SHARE, idle=PREFETCH_IDLE, interval=PREFETCH_INTERVAL,
+                 batch=PREFETCH_BATCH):
+        self.wallet = wallet
+        self.bank_url = bank_url
+        self.denominations = denominations
+        self.stock = stock
+        self.budget = budget
+        self.balance_share = balance_share
+        self.idle = idle
+        self.interval = interval
+        self.batch = max(1, batch)
+        self.client_id = None
+        self._recent = deque(maxlen=window)
+        self._last_activity = 0.0
+        self._cond = threading.Condition()
+        self._thread = None
+        self.prefetched = 0
+        self.batches = 0
+        self.errors = 0
+
+    def start(self, client_id=None):
+        """Запуск фонового потока; банкноты списываются со счёта client_id"""
+        self.client_id = client_id
+        if not PREFETCH_ENABLED:
+            return
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='prefetcher', daemon=True)
+                self._thread.start()
+
+    def record(self, amount):
+        """Учёт суммы платежа; пополнение откладывается до простоя"""
+        with self._cond:
+            self._recent.append(amount)
+            self._last_activity = time.monotonic()
+            self._cond.notify()
+
+    def targets(self):
+        """Целевой запас по номиналам: доли частых сумм последних платежей"""
+        with self._cond:
+            counts = Counter(self._recent).most_common(self.denominations)
+        total = sum(count for _, count in counts)
+        return {amount: max(1, round(self.stock * count / total)) for amount, count in counts if amount > 0}
+
+    def limit(self):
+        """Наибольшая сумма банкнот в кошельке: бюджет и доля баланса счёта по данным банка"""
+        if self.client_id is None:
+            # Банк выпускает банкноты только за счёт клиента
+            return 0
+        balance = account_balance(self.client_id, self.bank_url)
+        if balance is None:
+            # Счёта ещё нет: списывать банкноты не с чего
+            return 0
+        return min(self.budget, int(balance * self.balance_share))
+
+    def plan(self):
+        """Номиналы банкнот для выпуска в пределах бюджета (сначала самые недостающие)"""
+        targets = self.targets()
+        if not targets:
+            return []
+        stock = self.wallet.stock()
+        available = self.limit() - self.wallet.balance()[0]
+        deficits = {amount: target - stock.get(amount, 0) for amount, target in targets.items()}
+        amounts = []
+        while len(amounts) < self.batch:
+            amount = max(deficits, key=lambda a: deficits[a] / targets[a])
+            if deficits[amount] <= 0:
+                break
+            deficits[amount] -= 1
+            if amount > available:
+                continue
+            available -= amount
+            amounts.append(amount)
+        return amounts
+
+    def _idle(self):
+        return time.monotonic() - self._last_activity >= self.idle
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.interval)
+                while not self._idle():
+                    self._cond.wait(max(0.0, self._last_activity + self.idle - time.monotonic()))
+            try:
+                amounts = self.plan()
+                if amounts:
+                    self.issue(amounts)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Не удалось пополнить запас банкнот: {str(e)}")
+
+    def issue(self, amounts):
+        """Выпуск банкнот пакетным запросом к банку и сохранение в кошелёк"""
+        key = key_cache.primary()
+        if blinding_pool.n != key.n:
+            blinding_pool.set_modulus(key.n)
+        notes = []
+        for amount in amounts:
+            nonce, s1 = pm.new_note_serial(key.n)
+            factor = blinding_pool.take(key.h)
+            notes.append((amount, nonce, s1, factor,
+                          pm.create_blinded_message_precomputed(s1, factor.r_exp, key.n)))
+
+        response = http_client.post(
+            f"{self.bank_url}/api/v1/banknotes/batch",
+            json={"client_id": self.client_id,
+                  "items": [{"banknote": blinded, "amount": amount, "kid": key.kid}
+                            for amount, _, _, _, blinded in notes]},
+            headers=idempotency_headers(),
+            idempotent=True
+        )
+        response.raise_for_status()
+        self.batches += 1
+        issued = 0
+        for (amount, nonce, s1, factor, _), result in zip(notes, read_payload(response)['results']):
+            if result.get('status') != 'ok':
+                self.errors += 1
+                continue
+            signed_bill = pm.unblind_with_inverse(result['signed_banknote'], factor.r_inv, key.n)
+            # Подпись проверяется до сохранения: испорченная банкнота не должна попасть в запас
+            if pow(signed_bill, key.h, key.n) != s1:
+                self.errors += 1
+                continue
+            self.wallet.add_banknote(s1, nonce, signed_bill, amount, key)
+            issued += 1
+        self.prefetched += issued
+        logger.info(f"Запас банкнот пополнен: {issued} из {len(amounts)}")
+        return issued
+
+    def stats(self):
+        return {
+            "prefetched": self.prefetched,
+            "batches": self.batches,
+            "errors": self.errors,
+            "targets": self.targets(),
+        }
+
+
+# Общий выпуск банкнот про запас
+prefetcher = Prefetcher()
+
+
+def _stats():
+    stats = prefetcher.stats()
+    return [(('issued',), stats['prefetched']), (('error',), stats['errors'])]
+
+
+metrics.registry.collected('prefetch_notes_total', 'Банкноты, выпущенные про запас', 'counter', _stats, ('result',))
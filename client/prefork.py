@@ -0,0 +1 @@
+../common/prefork.py
\ No newline at end of file
@@ -1,6 +1,6 @@
 import random
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import requests
 import logging
 import os
@@ -8,8 +8,16 @@ import uuid
 from functools import wraps
 import paymentMath as pm
 import service
+import payments
 from clientSide import CLIENT_API_URL
 from service import Transaction
+from httpClient import http_client, read_payload
+from blindingPool import blinding_pool
+from keyCache import key_cache
+from deposits import deposit_accumulator
+import wire
+import metrics
+import profiling
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, 
@@ -18,11 +26,42 @@ logger = logging.getLogger(__name__)
 
 # Создание экземпляра Flask
 app = Flask(__name__)
+wire.install(app)
+metrics.install(app)
+profiling.install(app)
 
 # Конфигурация
 BANK_SERVER_URL = os.environ.get('BANK_SERVER_URL', 'http://localhost:8080')
 CLIENT_PORT = int(os.environ.get('CLIENT_PORT', 5001))
 CLIENT_ID = os.environ.get('CLIENT_ID', str(uuid.uuid4())[:8])  # Генерация ID клиента
+# Платежи зачисляются на счёт клиента-продавца
+deposit_accumulator.merchant_id = CLIENT_ID
+VERIFY_BATCH_MAX_ITEMS = int(os.environ.get('VERIFY_BATCH_MAX_ITEMS', 10000))
+
+
+def _blinding_pool_stats():
+    stats = blinding_pool.stats()
+    return [(('hit',), stats['hits']), (('miss',), stats['misses'])]
+
+
+def _check_exponent_cache_stats():
+    info = pm.payment_check_exponent.cache_info()
+    return [(('hit',), info.hits), (('miss',), info.misses)]
+
+
+def _key_cache_stats():
+    stats = key_cache.stats()
+    return [(('hit',), stats['hits']), (('miss',), stats['misses'])]
+
+
+metrics.registry.collected('blinding_pool_requests_total', 'Выдача затеняющих множителей из пула',
+                           'counter', _blinding_pool_stats, ('result',))
+metrics.registry.collected('check_exponent_cache_total', 'Обращения к кэшу экспонент проверки платежа',
+                           'counter', _check_exponent_cache_stats, ('result',))
+metrics.registry.collected('key_cache_requests_total', 'Обращения к кэшу ключей банка',
+                           'counter', _key_cache_stats, ('result',))
+metrics.registry.collected('transactions_pending', 'Транзакции плательщика в хранилище',
+                           'gauge', lambda: [((), len(service.transactions))])
 
 # Вспомогательная функция для обработки ошибок при запросах к банку
 def handle_bank_request(func):
@@ -52,11 +91,11 @@ def home():
 @app.route('/api/v1/check-bank', methods=['GET'])
 @handle_bank_request
 def check_bank_connection():
-    response = requests.get(f"{BANK_SERVER_URL}/api/v1/status")
+    response = http_client.get(f"{BANK_SERVER_URL}/api/v1/status")
     if response.status_code == 200:
         return jsonify({
             "status": "ok",
-            "bank_status": response.json()
+            "bank_status": read_payload(response)
         })
     else:
         return jsonify({
@@ -64,82 +103,113 @@ def check_bank_connection():
             "message": f"Код ответа банковского сервера: {response.status_code}"
         }), 400
 
-# Пример маршрута для создания транзакции
+# Приём платежа продавцом
 @app.route('/api/v1/payment', methods=['POST'])
 @handle_bank_request
 def get_payment():
     data = request.json
-    if not data:
-        return jsonify({"status": "error", "message": "Не указаны данные транзакции"}), 400
-    
-    # Проверка минимально необходимых полей
-    required_fields = ['payment', 's1', 'payment_exp', 'payment', 'payment_amount']
-    missing_fields = [field for field in required_fields if field not in data]
-    if missing_fields:
-        return jsonify({
-            "status": "error", 
-            "message": f"Отсутствуют обязательные поля: {', '.join(missing_fields)}"
-        }), 400
+    error = payments.check_payment_request(data)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+
+    key = key_cache.resolve(data.get('kid'))
+    if key is None:
+        return jsonify({"status": "error", "message": payments.UNKNOWN_KEY}), 400
 
     # Проверка платежа клиентом
-    verified_payment = pm.verify_payment(data['payment'], pm.get_h(), data['payment_exp'], pm.n)
+    with metrics.timed('verify'):
+        verified_payment = payments.verify_payment(data['payment'], data['payment_exp'], key,
+                                                   data.get('note_exp'))
     print(f"Проверка клиентом (должно быть равно s1): {verified_payment}")
     print(f"Исходный s1: {data['s1']}")
+    if not payments.serial_matches(verified_payment, data['nonce'], key):
+        return jsonify({"status": "error", "message": payments.INVALID_PAYMENT}), 400
+
+    # Погашение банкноты в банке (защита от двойной траты) вместе с подписью сдачи:
+    # отказ банка (в том числе 429/503 при перегрузке) оставляет банкноту непотраченной.
+    # Запрос повторяется при сбоях с ключом идемпотентности плательщика: банк не выполняет его дважды,
+    # а повтор платежа получает тот же ответ со сдачей
+    response = http_client.post(f"{BANK_SERVER_URL}/api/v1/banknotes/redeem",
+                                json=payments.redeem_request(data, CLIENT_ID),
+                                headers=payments.redeem_headers(request.headers), idempotent=True)
+    error = payments.redeem_error(response.status_code)
+    if error:
+        body, status_code = error
+        return jsonify(body), status_code
+
+    # Платёж зачисляется на счёт продавца пакетом вместе с другими
+    deposit_accumulator.add(payments.deposit_entry(data))
+
+    if not payments.needs_change(data):
+        return jsonify(payments.payment_response(data))
+
+    signed_change_blinded = read_payload(response)['signed_change_blinded']
+    print(f"Банк вернул подписанную сдачу: {signed_change_blinded}")
+
+    # Отправка сдачи плательщику
+    if payments.notify_payer(data):
+        response = http_client.post(f"{CLIENT_API_URL}/api/v1/verify-change",
+                                    json=payments.change_notification(signed_change_blinded, data))
+        if response.status_code != 200:
+            logger.warning(f"Плательщик не принял сдачу: код ответа {response.status_code}")
+
+    return jsonify(payments.payment_response(data, signed_change_blinded))
+
+
+# Пакетная проверка платежей продавцом
+@app.route('/api/v1/payments/verify-batch', methods=['POST'])
+@handle_bank_request
+def verify_payments_batch():
+    data = request.json
+    if not data or not isinstance(data.get('payments'), list):
+        return jsonify({"status": "error", "message": "Поле payments должно быть списком"}), 400
 
-    if data['payment_amount'] < data['amount']:
-        if 'blinded_change' not in data or 'change_exp' not in data:
-            return jsonify({
-                "status": "error",
-                "message": "не хватает обязательных полей для сдачи"
-            })
-
-        response = requests.post(f"{BANK_SERVER_URL}/api/v1/sign-change", json={
-            "blinded_change": data['blinded_change'],
-            "change_exp": data['change_exp'],
-        })
-
-        data = response.json()
-        print(f"Банк вернул подписанную сдачу: {data['signed_change_blinded']}")
-
-        response = requests.post(f"{CLIENT_API_URL}/api/v1/payment", json={
-            "signed_change_blinded": data['signed_change_blinded'],
-            "change_exp": data['change_exp'],
-        })
-        data = response.json()
-        #TODO: Дописать зачисление денег на счёт продавца
-
+    entries = data['payments']
+    if len(entries) > VERIFY_BATCH_MAX_ITEMS:
+        return jsonify({
+            "status": "error",
+            "message": f"Слишком большой пакет: максимум {VERIFY_BATCH_MAX_ITEMS} платежей"
+        }), 413
+
+    # Ключи элементов пакета (неизвестные запрашиваются у банка один раз)
+    keys = {kid: key_cache.resolve(kid) for kid in payments.batch_kids(entries)}
+    with metrics.timed('verify-batch'):
+        verified = payments.verify_batch(entries, keys)
+    results = []
+    for ok, value in verified:
+        if ok:
+            results.append({"status": "ok", "serial": value})
+        else:
+            results.append({"status": "error", "message": value})
+    return jsonify({"status": "ok", "results": results})
 
 @app.route('/api/v1/verify-change', methods=['POST'])
 def verify_change():
     data = request.json
-    if not data:
-        return jsonify({
-            "status": "error",
-            "message": "не указаны данные со сдачей"
-        }), 400
+    error = payments.check_change_request(data)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
 
-    if 'signed_change_blinded' not in data:
-        return jsonify({
-            "status": "error",
-            "message": "нет необходимого поля signed_change_blinded"
-        })
-
-    if 'change_exp' not in data:
-        return jsonify({
-            "status": "error",
-            "message": "нет необходимого поля change_exp"
-        })
+    transaction = payments.find_change_transaction(data)
+    if transaction is None:
+        return jsonify({"status": "error", "message": "Транзакция для сдачи не найдена"}), 404
 
-    last_transaction: Transaction = service.List_transaction[-1]
-    # Снятие затемнения сдачи
-    change_bill = pm.unblind_change(data['signed_change_blinded'], last_transaction.ra, pm.n)
+    # Снятие затемнения и проверка сдачи
+    with metrics.timed('unblind'):
+        change_bill, valid = payments.unblind_change(data['signed_change_blinded'], data['change_exp'], transaction)
     print(f"Полученная сдача: {change_bill}")
+    print(f"Проверка сдачи: {'успешно' if valid else 'не совпадает с t'}")
+    # Сдачу сохраняет плательщик из ответа на платёж; уведомление только подтверждает её
+    if valid:
+        payments.complete_transaction(data)
+
+    return jsonify({"status": "ok" if valid else "error", "change_bill": change_bill})
 
-    # Проверка сдачи
-    verified_change = pow(change_bill, data['change_exp'], pm.n)
-    print(f"Проверка сдачи (должно быть равно t): {verified_change}")
-    print(f"Исходное t: {last_transaction.t}")
 
+# Метрики в формате Prometheus
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
 
 # Обработчик ошибок для 404
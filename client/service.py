@@ -1,19 +1,93 @@
+import os
+import time
 import random
 import uuid
+import threading
+from collections import OrderedDict
 from math import gcd
 
-List_transaction = []
-# Last_Transaction_numb = 0
+# Конфигурация: транзакция хранится TRANSACTION_TTL секунд после создания (незавершённая)
+# или после завершения, всего не более TRANSACTION_MAX
+TRANSACTION_TTL = float(os.environ.get('TRANSACTION_TTL', 600))
+TRANSACTION_MAX = int(os.environ.get('TRANSACTION_MAX', 10000))
 
 class Transaction:
-    # купюра
-    amount = 0
-    s1 = 0
-    r1 = 0 # затеняющий множитель купюры
-    # Платёж
-    payment_amount = 0
-    # сдача
-    t = 0
-    ra = 0 # затеняющий множитель сдачи
-    def __init__(self, number):
-        self.number = number
\ No newline at end of file
+    __slots__ = ('id', 'number',
+                 'kid', 'n',                      # ключ банка, которым подписана купюра
+                 'amount', 's1', 'r1', 'r1_inv',  # купюра и её затеняющий множитель
+                 'payment_amount',                # платёж
+                 't', 'change_nonce',             # сдача: серийный номер FDH(change_nonce)
+                 'ra', 'ra_inv')                  # и затеняющий множитель сдачи
+
+    def __init__(self, number, id=None):
+        self.id = id or uuid.uuid4().hex
+        self.number = number
+        self.kid = None
+        self.n = 0
+        self.amount = 0
+        self.s1 = 0
+        self.r1 = 0
+        self.r1_inv = 0
+        self.payment_amount = 0
+        self.t = 0
+        self.change_nonce = None
+        self.ra = 0
+        self.ra_inv = 0
+
+
+class TransactionStore:
+    """Потокобезопасное хранилище транзакций по id с вытеснением по TTL и размеру"""
+    def __init__(self, ttl=TRANSACTION_TTL, max_size=TRANSACTION_MAX):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = {}
+        self._pending = OrderedDict()    # id -> время создания, в порядке создания
+        self._completed = OrderedDict()  # id -> время завершения, в порядке завершения
+        self._lock = threading.Lock()
+
+    def add(self, transaction):
+        with self._lock:
+            now = time.monotonic()
+            self._completed.pop(transaction.id, None)
+            self._items[transaction.id] = transaction
+            self._pending[transaction.id] = now
+            self._pending.move_to_end(transaction.id)
+            self._evict(now)
+
+    def get(self, transaction_id):
+        with self._lock:
+            return self._items.get(transaction_id)
+
+    def complete(self, transaction_id):
+        """Отметка о завершении: транзакция будет удалена по истечении TTL"""
+        with self._lock:
+            if transaction_id in self._items:
+                self._pending.pop(transaction_id, None)
+                self._completed[transaction_id] = time.monotonic()
+                self._completed.move_to_end(transaction_id)
+            self._evict(time.monotonic())
+
+    def _evict(self, now):
+        # Незавершённая транзакция, на которую сдача так и не пришла, тоже удаляется по TTL
+        for queue in (self._completed, self._pending):
+            while queue:
+                transaction_id, since = next(iter(queue.items()))
+                if now - since < self.ttl:
+                    break
+                self._remove(transaction_id)
+        # При переполнении сначала удаляются завершённые, затем самые старые
+        while len(self._items) > self.max_size:
+            self._remove(next(iter(self._completed or self._pending)))
+
+    def _remove(self, transaction_id):
+        self._completed.pop(transaction_id, None)
+        self._pending.pop(transaction_id, None)
+        self._items.pop(transaction_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+
+# Транзакции плательщика, ожидающие сдачу
+transactions = TransactionStore()
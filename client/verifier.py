@@ -0,0 +1,56 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import paymentMath as pm
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация: число процессов для пакетной проверки (0 - проверка в потоке запроса)
+VERIFY_WORKERS = int(os.environ.get('VERIFY_WORKERS', os.cpu_count() or 1))
+VERIFY_CHUNK_SIZE = int(os.environ.get('VERIFY_CHUNK_SIZE', 64))
+
+
+class PaymentVerifier:
+    """Пакетная проверка платежей в пуле процессов"""
+    def __init__(self, workers=VERIFY_WORKERS, chunk_size=VERIFY_CHUNK_SIZE):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # fork небезопасен в многопоточном сервере, поэтому spawn
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+                logger.info(f"Пул проверки платежей: {self.workers} процессов")
+            return self._executor
+
+    def executor(self):
+        """Пул процессов для отдельных вычислений (None, если пул отключён)"""
+        return self._get_executor()
+
+    def verify(self, items, h=None, n=None):
+        """Проверка [(payment, payment_exp), ...], результаты в том же порядке"""
+        h = pm.get_h() if h is None else h
+        n = pm.n if n is None else n
+        try:
+            return pm.verify_payments_batch(items, h, n, self._get_executor(), self.chunk_size)
+        except BrokenProcessPool:
+            logger.error("Пул проверки платежей повреждён, пересоздание")
+            with self._lock:
+                self._executor = None
+            return pm.verify_payments_batch(items, h, n, self._get_executor(), self.chunk_size)
+
+
+# Общий проверяющий платежей
+payment_verifier = PaymentVerifier()
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import paymentMath as pm
+
+# Кошелёк плательщика: подписанные банкноты без затемнения и полученная сдача.
+# Серийный номер банкноты - хэш FDH её случайного nonce, по которому банк
+# проверяет платёж. Банкнота задаётся экспонентой подписи note_exp. Купюра, выпущенная банком,
+# подписана экспонентой h и оплачивает любую сумму до своего номинала; сдача
+# подписана экспонентой своей суммы и оплачивает суммы, биты которых входят
+# в биты её суммы (экспонента платежа делит note_exp). Платёж тратит банкноту
+# целиком, остаток возвращается новой сдачей, поэтому банк нужен плательщику,
+# только когда в кошельке нет подходящей банкноты.
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+WALLET_PATH = os.environ.get('WALLET_PATH', 'wallet.db')
+
+# Состояния банкноты: доступна для оплаты или занята платежом, который ещё выполняется
+AVAILABLE = 'available'
+RESERVED = 'reserved'
+# Банкнота, сохранённая без nonce: остаётся в кошельке, но для оплаты не выбирается
+LEGACY = 'legacy'
+# Ответ на платёж не получен: запрос платежа сохранён и повторяется с тем же ключом идемпотентности
+PENDING = 'pending'
+
+
+class Note:
+    """Банкнота кошелька: серийный номер, nonce, подпись, экспонента подписи, номинал и ключ банка"""
+    __slots__ = ('serial', 'nonce', 'signature', 'note_exp', 'amount', 'kid', 'n')
+
+    def __init__(self, serial, nonce, signature, note_exp, amount, kid, n):
+        self.serial = serial
+        self.nonce = nonce
+        self.signature = signature
+        self.note_exp = note_exp
+        self.amount = amount
+        self.kid = kid
+        self.n = n
+
+    @property
+    def bits(self):
+        """Суммы, которые можно оплатить банкнотой: маска битов (для купюры банка - все биты)"""
+        if self.note_exp == pm.codec.h:
+            return pm.codec.max_amount
+        return pm.codec.decode(self.note_exp)
+
+
+class Wallet:
+    """Банкноты плательщика в SQLite с выбором банкноты для платежа"""
+    def __init__(self, path=WALLET_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def connection(self):
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS notes (
+                    serial TEXT PRIMARY KEY,
+                    nonce TEXT,
+                    signature TEXT NOT NULL,
+                    note_exp TEXT NOT NULL,
+                    amount INTEGER NOT NULL,
+                    bits INTEGER NOT NULL,
+                    kid TEXT,
+                    n TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    payment TEXT
+                ) WITHOUT ROWID
+            ''')
+            self._migrate(conn)
+            # Поиск по номиналу: доступные банкноты в порядке возрастания суммы
+            conn.execute('CREATE INDEX IF NOT EXISTS notes_by_amount ON notes (status, amount)')
+            # Платёж прервался вместе с процессом: банкнота возвращается в кошелёк.
+            # Если банк успел её погасить, следующий платёж получит отказ и удалит её.
+            # Отправленный платёж (PENDING) остаётся ожидающим: его повторяет клиент
+            conn.execute('UPDATE notes SET status = ? WHERE status = ?', (AVAILABLE, RESERVED))
+            self._conn = conn
+            logger.info(f"Открыт кошелёк: {self.path}")
+        return self._conn
+
+    def _migrate(self, conn):
+        """Добавление недостающих столбцов; банкноты прежнего формата не удаляются"""
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(notes)')}
+        if 'nonce' not in columns:
+            conn.execute('ALTER TABLE notes ADD COLUMN nonce TEXT')
+        if 'payment' not in columns:
+            conn.execute('ALTER TABLE notes ADD COLUMN payment TEXT')
+        if 'bits' not in columns:
+            # Маска оплачиваемых сумм вычисляется по экспоненте подписи
+            conn.execute('ALTER TABLE notes ADD COLUMN bits INTEGER NOT NULL DEFAULT 0')
+            rows = conn.execute('SELECT serial, note_exp FROM notes').fetchall()
+            for serial, note_exp in rows:
+                note = Note(serial, None, 0, int(note_exp), 0, None, 0)
+                try:
+                    bits = note.bits
+                except ValueError:
+                    bits = 0
+                conn.execute('UPDATE notes SET bits = ? WHERE serial = ?', (bits, serial))
+        legacy = conn.execute('UPDATE notes SET status = ? WHERE nonce IS NULL AND status != ?',
+                              (LEGACY, LEGACY)).rowcount
+        if legacy:
+            logger.warning(f"В кошельке {self.path} банкнот без nonce: {legacy}; "
+                           f"они сохранены, но не используются для оплаты")
+
+    def add(self, note, reserved=False):
+        """Сохранение банкноты; reserved - банкнота сразу занята платежом"""
+        with self._lock:
+            self.connection().execute(
+                'INSERT OR REPLACE INTO notes (serial, nonce, signature, note_exp, amount, bits, kid, n, status, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(note.serial), note.nonce, str(note.signature), str(note.note_exp), note.amount, note.bits,
+                 note.kid, str(note.n), RESERVED if reserved else AVAILABLE, time.time()))
+        return note
+
+    def add_banknote(self, serial, nonce, signature, amount, key, reserved=False):
+        """Купюра, выпущенная банком (подписана открытой экспонентой ключа)"""
+        return self.add(Note(serial, nonce, signature, key.h, amount, key.kid, key.n), reserved)
+
+    def add_change(self, change_bill, change_exp, transaction):
+        """Проверенная сдача по транзакции плательщика"""
+        note = Note(transaction.t, transaction.change_nonce, change_bill, change_exp,
+                    pm.amount_from_exponent(change_exp),
+                    transaction.kid, transaction.n or pm.n)
+        return self.add(note)
+
+    def reserve(self, payment_amount):
+        """Банкнота для платежа, занятая до его завершения, или None.
+
+        Выбирается банкнота наименьшего номинала, которой можно оплатить сумму:
+        при точном совпадении платёж обходится без сдачи.
+        """
+        with self._lock:
+            conn = self.connection()
+            row = conn.execute(
+                'SELECT serial, nonce, signature, note_exp, amount, kid, n FROM notes '
+                'WHERE status = ? AND amount >= ? AND (bits & ?) = ? ORDER BY amount, created LIMIT 1',
+                (AVAILABLE, payment_amount, payment_amount, payment_amount)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE notes SET status = ? WHERE serial = ?', (RESERVED, row[0]))
+        serial, nonce, signature, note_exp, amount, kid, n = row
+        return Note(int(serial), nonce, int(signature), int(note_exp), amount, kid, int(n))
+
+    def release(self, note):
+        """Платёж не состоялся: банкнота снова доступна"""
+        with self._lock:
+            self.connection().execute('UPDATE notes SET status = ?, payment = NULL WHERE serial = ?',
+                                      (AVAILABLE, str(note.serial)))
+
+    def mark_pending(self, note, payment):
+        """Запрос платежа банкнотой сохраняется до ответа продавца (payment - словарь для JSON)"""
+        with self._lock:
+            self.connection().execute('UPDATE notes SET status = ?, payment = ? WHERE serial = ?',
+                                      (PENDING, json.dumps(payment), str(note.serial)))
+
+    def pending(self):
+        """Платежи без ответа: [(банкнота, сохранённый запрос платежа), ...]"""
+        with self._lock:
+            rows = self.connection().execute(
+                'SELECT serial, nonce, signature, note_exp, amount, kid, n, payment FROM notes '
+                'WHERE status = ? ORDER BY created', (PENDING,)).fetchall()
+        return [(Note(int(serial), nonce, int(signature), int(note_exp), amount, kid, int(n)), json.loads(payment))
+                for serial, nonce, signature, note_exp, amount, kid, n, payment in rows]
+
+    def remove(self, note):
+        """Банкнота потрачена"""
+        with self._lock:
+            self.connection().execute('DELETE FROM notes WHERE serial = ?', (str(note.serial),))
+
+    def balance(self):
+        """(сумма, число банкнот) доступных банкнот"""
+        with self._lock:
+            total, count = self.connection().execute(
+                'SELECT COALESCE(SUM(amount), 0), COUNT(*) FROM notes WHERE status = ?', (AVAILABLE,)).fetchone()
+        return total, count
+
+    def stock(self):
+        """Число доступных банкнот по номиналам"""
+        with self._lock:
+            rows = self.connection().execute(
+                'SELECT amount, COUNT(*) FROM notes WHERE status = ? GROUP BY amount', (AVAILABLE,)).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# Кошелёк клиента (открывается при первом обращении)
+wallet = Wallet()
@@ -0,0 +1,84 @@
+from functools import lru_cache, reduce
+
+# Кодирование номиналов: сумма -> экспонента (произведение делителей,
+# соответствующих единичным битам суммы) и обратно
+
+# Число бит суммы, покрываемых одной таблицей произведений
+TABLE_BITS = 8
+CACHE_SIZE = 4096
+
+
+class DenominationCodec:
+    """Преобразование суммы в экспоненту и экспоненты в сумму для набора делителей.
+
+    Кодирование собирает экспоненту из таблиц готовых произведений по байтам
+    суммы, декодирование - пробное деление остатков по группам делителей.
+    Результаты кэшируются.
+    """
+    def __init__(self, divisors):
+        self.divisors = tuple(divisors)
+        self.max_amount = 2 ** len(self.divisors) - 1
+        self.h = reduce(lambda x, y: x * y, self.divisors, 1)
+        self.tables = []
+        self.chunks = []
+        for start in range(0, len(self.divisors), TABLE_BITS):
+            chunk = self.divisors[start:start + TABLE_BITS]
+            table = [1] * (1 << len(chunk))
+            for mask in range(1, len(table)):
+                low = mask & -mask
+                table[mask] = table[mask ^ low] * chunk[low.bit_length() - 1]
+            self.tables.append(table)
+            # (произведение делителей группы, [(бит, делитель), ...])
+            self.chunks.append((table[-1], [(1 << (start + i), d) for i, d in enumerate(chunk)]))
+        self._encode_cached = lru_cache(maxsize=CACHE_SIZE)(self._encode)
+        self._decode_cached = lru_cache(maxsize=CACHE_SIZE)(self._decode)
+
+    # Тип проверяется до обращения к кэшу: True и 3.0 равны в нём 1 и 3, а список не хэшируется
+    def encode(self, amount):
+        if type(amount) is not int:
+            raise ValueError("Сумма должна быть целым числом")
+        return self._encode_cached(amount)
+
+    def decode(self, exp):
+        if type(exp) is not int:
+            raise ValueError("Экспонента должна быть целым числом")
+        return self._decode_cached(exp)
+
+    def _encode(self, amount):
+        if amount < 0 or amount > self.max_amount:
+            raise ValueError(f"Сумма должна быть в диапазоне 0..{self.max_amount}")
+        exp = 1
+        for table in self.tables:
+            if not amount:
+                break
+            exp *= table[amount & ((1 << TABLE_BITS) - 1)]
+            amount >>= TABLE_BITS
+        return exp
+
+    def _decode(self, exp):
+        if exp <= 0 or self.h % exp:
+            raise ValueError("Экспонента не является произведением различных делителей")
+        # exp делит h, поэтому бит суммы установлен, если экспонента делится на делитель.
+        # Остаток по произведению группы - небольшое целое, дальше деление дешёвое
+        amount = 0
+        for product, bits in self.chunks:
+            remainder = exp % product
+            for bit, divisor in bits:
+                if remainder % divisor == 0:
+                    amount |= bit
+        return amount
+
+    def encode_many(self, amounts):
+        """Экспоненты для списка сумм"""
+        return [self.encode(amount) for amount in amounts]
+
+    def decode_many(self, exponents):
+        """Суммы для списка экспонент"""
+        return [self.decode(exp) for exp in exponents]
+
+    def is_valid(self, exp):
+        try:
+            self.decode(exp)
+        except ValueError:
+            return False
+        return True
@@ -0,0 +1,366 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+import profiling
+
+# Метрики сервера: счётчики, показатели и гистограммы задержек
+# в текстовом формате Prometheus. В многопроцессном режиме каждый рабочий процесс
+# сохраняет снимок своих метрик в общий каталог, и любой процесс отдаёт сумму
+# снимков всех живых процессов
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Период сохранения снимка метрик рабочего процесса, секунды
+METRICS_SHARE_INTERVAL = float(os.environ.get('METRICS_SHARE_INTERVAL', 1))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Семейство метрик с метками; значения хранятся по кортежу значений меток"""
+    kind = 'untyped'
+    # Объединение значений рабочих процессов: sum или max
+    aggregate = 'sum'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _labels(self, values):
+        return tuple(zip(self.labelnames, values))
+
+    def samples(self):
+        """Список (имя, метки, значение) для вывода"""
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in sorted(self._values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # [счётчики по корзинам (последняя - +Inf), сумма, количество]
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in sorted(self._values.items())]
+        result = []
+        for key, counts, total, count in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                result.append((f"{self.name}_bucket", labels + (('le', _format_value(float(bound))),), cumulative))
+            result.append((f"{self.name}_sum", labels, total))
+            result.append((f"{self.name}_count", labels, count))
+        return result
+
+
+class CollectedMetric(Metric):
+    """Метрика, значения которой вычисляются при выводе (статистика кэшей и т.п.)"""
+    def __init__(self, name, help, kind, collect, labelnames=(), aggregate='sum'):
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self.collect = collect
+        self.aggregate = aggregate
+
+    def samples(self):
+        return [(self.name, self._labels(labels), value) for labels, value in self.collect()]
+
+
+def _merge_status(total, part):
+    """Сложение показателей статуса процессов: целые складываются, дробные (времена) - наибольшие"""
+    for name, value in part.items():
+        current = total.get(name)
+        if name not in total:
+            total[name] = value
+        elif isinstance(value, dict) and isinstance(current, dict):
+            _merge_status(current, value)
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        elif isinstance(value, int) and isinstance(current, int):
+            total[name] = current + value
+        elif isinstance(current, (int, float)) and not isinstance(current, bool):
+            total[name] = max(current, value)
+    return total
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._status = []  # (раздел, функция) показателей /api/v1/status
+        self._lock = threading.Lock()
+        self.shared_dir = None
+        self._writer = None
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def collected(self, name, help, kind, collect, labelnames=(), aggregate='sum'):
+        """collect() возвращает список (кортеж значений меток, значение)"""
+        return self.register(CollectedMetric(name, help, kind, collect, labelnames, aggregate))
+
+    def status_section(self, name, collect):
+        """Раздел /api/v1/status: collect() возвращает словарь показателей процесса"""
+        with self._lock:
+            self._status.append((name, collect))
+
+    def snapshot(self):
+        """Метрики и показатели статуса процесса"""
+        with self._lock:
+            metrics = list(self._metrics)
+            sections = list(self._status)
+        return {
+            "metrics": [{"name": metric.name, "help": metric.help, "kind": metric.kind,
+                         "aggregate": metric.aggregate, "samples": metric.samples()} for metric in metrics],
+            "status": {name: collect() for name, collect in sections},
+        }
+
+    # Многопроцессный режим
+
+    def share(self, directory, interval=METRICS_SHARE_INTERVAL):
+        """Сохранение снимков метрик рабочего процесса в общий каталог directory"""
+        self.shared_dir = directory
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, args=(interval,),
+                                            name='metrics-share', daemon=True)
+            self._writer.start()
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.shared_dir, f"{pid}.json")
+
+    def _write_loop(self, interval):
+        while True:
+            try:
+                self._write(self.snapshot())
+            except Exception:
+                pass
+            time.sleep(interval)
+
+    def _write(self, snapshot):
+        # Запись через временный файл: другие процессы читают только целый снимок
+        path = self._snapshot_path(os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+
+    def _snapshots(self):
+        """Снимки всех живых рабочих процессов (свой - текущий)"""
+        own = self.snapshot()
+        if self.shared_dir is None:
+            return [own]
+        snapshots = [own]
+        try:
+            names = os.listdir(self.shared_dir)
+        except OSError:
+            return snapshots
+        for name in names:
+            pid, ext = os.path.splitext(name)
+            if ext != '.json' or not pid.isdigit() or int(pid) == os.getpid() or not _alive(int(pid)):
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def merged(self):
+        """Метрики всех процессов: значения с одинаковыми метками складываются (или берётся наибольшее)"""
+        families = {}
+        for snapshot in self._snapshots():
+            for metric in snapshot["metrics"]:
+                family = families.setdefault(metric["name"], (metric, {}))
+                values = family[1]
+                for name, labels, value in metric["samples"]:
+                    key = (name, tuple(tuple(label) for label in labels))
+                    if key not in values:
+                        values[key] = value
+                    elif metric["aggregate"] == 'max':
+                        values[key] = max(values[key], value)
+                    else:
+                        values[key] += value
+        return list(families.values())
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric, values in self.merged():
+            lines.append(f"# HELP {metric['name']} {metric['help']}")
+            lines.append(f"# TYPE {metric['name']} {metric['kind']}")
+            for (name, labels), value in values.items():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def status(self):
+        """Показатели статуса, сложенные по рабочим процессам, и число процессов"""
+        snapshots = self._snapshots()
+        total = {}
+        for snapshot in snapshots:
+            _merge_status(total, snapshot["status"])
+        total["workers"] = len(snapshots)
+        return total
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Общий реестр метрик процесса
+registry = Registry()
+
+started_at = time.time()
+registry.collected('process_uptime_seconds', 'Время работы процесса', 'gauge',
+                   lambda: [((), round(time.time() - started_at, 3))], aggregate='max')
+
+http_requests = registry.counter('http_requests_total', 'Число обработанных запросов',
+                                 ('route', 'method', 'status'))
+http_duration = registry.histogram('http_request_duration_seconds', 'Время обработки запроса',
+                                   ('route', 'method'))
+http_in_flight = registry.gauge('http_requests_in_flight', 'Число запросов в обработке')
+crypto_duration = registry.histogram('crypto_operation_duration_seconds', 'Время криптографических операций',
+                                     ('operation',))
+cache_requests = registry.counter('cache_requests_total', 'Обращения к кэшам', ('cache', 'result'))
+
+
+@contextmanager
+def timed(operation):
+    """Замер времени криптографической операции"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        crypto_duration.observe(elapsed, operation)
+        profiling.record('crypto', elapsed)
+
+
+def cache_hit(cache, hit):
+    cache_requests.inc(cache, 'hit' if hit else 'miss')
+
+
+def request_started():
+    http_in_flight.inc()
+    return time.perf_counter()
+
+
+def request_finished(start, route, method, status):
+    http_in_flight.dec()
+    http_duration.observe(time.perf_counter() - start, route, method)
+    http_requests.inc(route, method, str(status))
+
+
+registry.status_section('server', lambda: {
+    "connections": http_in_flight.value(),
+    "requests": http_requests.total(),
+    "uptime": round(time.time() - started_at, 3),
+})
+
+
+def status():
+    """Текущие значения для /api/v1/status (по всем рабочим процессам)"""
+    sections = registry.status()
+    return {**sections.pop('server'), **sections}
+
+
+def install(app):
+    """Учёт запросов приложения Flask по маршрутам"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_request():
+        g.metrics_start = request_started()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            request_finished(start, route, request.method, response.status_code)
+        return response
+
+    @app.teardown_request
+    def _abort_request(exc):
+        # Ответ не сформирован (after_request не вызывался)
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            request_finished(start, request.url_rule.rule if request.url_rule else 'unmatched',
+                             request.method, 500)
@@ -0,0 +1,246 @@
+import os
+import time
+import shutil
+import signal
+import socket
+import logging
+import tempfile
+import threading
+
+# Многопроцессный режим: родительский процесс открывает слушающий сокет,
+# загружает общие данные и запускает рабочие процессы через fork.
+# Рабочие процессы принимают соединения с общего сокета, упавшие перезапускаются.
+# Главный процесс создаёт общий каталог shared_dir, через который рабочие процессы
+# обмениваются снимками метрик
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+PREFORK_BACKLOG = int(os.environ.get('PREFORK_BACKLOG', 1024))
+# Время на завершение запросов при остановке рабочего процесса, секунды
+PREFORK_GRACEFUL_TIMEOUT = float(os.environ.get('PREFORK_GRACEFUL_TIMEOUT', 10))
+# Процесс, проработавший меньше, считается упавшим при запуске: перезапуск с задержкой
+PREFORK_MIN_UPTIME = float(os.environ.get('PREFORK_MIN_UPTIME', 2))
+PREFORK_MAX_RESTART_DELAY = float(os.environ.get('PREFORK_MAX_RESTART_DELAY', 30))
+# Общий каталог рабочих процессов (по умолчанию временный, удаляется при остановке)
+PREFORK_SHARED_DIR = os.environ.get('PREFORK_SHARED_DIR')
+
+# Общий каталог текущего многопроцессного запуска (задаёт главный процесс до fork)
+shared_dir = None
+
+
+def cpu_count():
+    """Число доступных процессу ядер (с учётом ограничений контейнера по cpuset)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def resolve_workers(workers):
+    """0 - по числу доступных ядер"""
+    return workers if workers > 0 else cpu_count()
+
+
+def listen(host, port, backlog=PREFORK_BACKLOG):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class _ActiveRequests:
+    """Счётчик запросов в обработке для плавной остановки WSGI-сервера"""
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._cond:
+            self.count += 1
+        try:
+            return self.app(environ, start_response)
+        finally:
+            with self._cond:
+                self.count -= 1
+                self._cond.notify_all()
+
+    def wait(self, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.count == 0, timeout)
+
+
+def serve_wsgi(app, sock):
+    """WSGI-сервер рабочего процесса на общем сокете; SIGTERM - плавная остановка"""
+    from werkzeug.serving import make_server
+
+    host, port = sock.getsockname()[:2]
+    active = _ActiveRequests(app)
+    server = make_server(host, port, active, threaded=True, fd=sock.fileno())
+
+    def stop(signum, frame):
+        # shutdown() ждёт выхода из serve_forever, поэтому вызывается из другого потока
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+    if not active.wait(PREFORK_GRACEFUL_TIMEOUT):
+        logger.warning(f"Рабочий процесс {os.getpid()} остановлен с незавершёнными запросами: {active.count}")
+
+
+class Arbiter:
+    """Запуск и перезапуск рабочих процессов.
+
+    SIGTERM/SIGINT - остановка, SIGHUP - поочерёдный перезапуск рабочих процессов.
+    """
+    def __init__(self, worker, workers, name='worker', directory=PREFORK_SHARED_DIR):
+        global shared_dir
+        self.worker = worker
+        self.workers = workers
+        self.name = name
+        self._temporary = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix=f"{name}-workers-")
+        else:
+            os.makedirs(directory, exist_ok=True)
+        self.shared_dir = shared_dir = directory
+        self.children = {}  # pid -> время запуска
+        self._stopping = False
+        self._reload = False
+        self._failures = 0
+        self._next_spawn = 0.0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        logger.info(f"Запуск {self.workers} рабочих процессов ({self.name}), главный процесс {os.getpid()}")
+        try:
+            while not self._stopping:
+                self._reap()
+                if self._reload:
+                    self._reload = False
+                    self._restart_all()
+                self._spawn_missing()
+                time.sleep(0.1)
+        finally:
+            self._stop_all()
+            if self._temporary:
+                shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return pid
+
+        # Рабочий процесс: остановку по Ctrl+C выполняет главный процесс
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.worker()
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception(f"Рабочий процесс {os.getpid()} завершился с ошибкой")
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _spawn_missing(self):
+        while len(self.children) < self.workers and not self._stopping:
+            if time.monotonic() < self._next_spawn:
+                return
+            self._spawn()
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            self._forget(pid)
+            if started is None or self._stopping:
+                continue
+            uptime = time.monotonic() - started
+            logger.error(f"Рабочий процесс {pid} завершился (код {os.waitstatus_to_exitcode(status)}, "
+                         f"работал {uptime:.1f} с), перезапуск")
+            # Процессы, падающие сразу после запуска, перезапускаются с нарастающей задержкой
+            if uptime < PREFORK_MIN_UPTIME:
+                self._failures += 1
+                delay = min(PREFORK_MAX_RESTART_DELAY, 0.5 * 2 ** self._failures)
+                self._next_spawn = time.monotonic() + delay
+            else:
+                self._failures = 0
+
+    def _forget(self, pid):
+        """Удаление файлов завершившегося рабочего процесса из общего каталога"""
+        for name in os.listdir(self.shared_dir):
+            if name.split('.', 1)[0] == str(pid):
+                try:
+                    os.remove(os.path.join(self.shared_dir, name))
+                except OSError:
+                    pass
+
+    def _terminate(self, pids, timeout=PREFORK_GRACEFUL_TIMEOUT + 1):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + timeout
+        pending = set(pids)
+        while pending and time.monotonic() < deadline:
+            for pid in list(pending):
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = pid
+                if done:
+                    pending.discard(pid)
+                    self.children.pop(pid, None)
+                    self._forget(pid)
+            time.sleep(0.05)
+        for pid in pending:
+            logger.warning(f"Рабочий процесс {pid} не завершился вовремя, принудительная остановка")
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self.children.pop(pid, None)
+            self._forget(pid)
+
+    def _restart_all(self):
+        """Поочерёдная замена рабочих процессов: сначала запуск нового, затем остановка старого"""
+        logger.info("Перезапуск рабочих процессов")
+        for pid in list(self.children):
+            if self._stopping:
+                return
+            self._spawn()
+            self._terminate([pid])
+
+    def _stop_all(self):
+        logger.info("Остановка рабочих процессов")
+        self._terminate(list(self.children))
+
+
+def serve(worker, workers, name='worker'):
+    """Запуск worker() в workers процессах; возвращается после остановки"""
+    Arbiter(worker, workers, name).run()
@@ -0,0 +1,358 @@
+import os
+import sys
+import time
+import random
+import marshal
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+
+# Профилирование работающего сервера: этапы обработки запросов (spans),
+# выборочный cProfile, снимки стеков и tracemalloc за окно времени.
+# При PROFILING_ENABLED=0 обработчики не подключаются, а span() - пустой контекст
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '0') == '1'
+# Токен для /admin/profile (заголовок X-Profiling-Token); пустой - без проверки
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN', '')
+# Окно профилирования, которое запускается сразу при старте сервера (0 - не запускать)
+PROFILING_CAPTURE_SECONDS = float(os.environ.get('PROFILING_CAPTURE_SECONDS', 0))
+# Доля запросов, профилируемых cProfile во время окна
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0.1))
+# Интервал снятия стеков, секунды
+PROFILING_STACK_INTERVAL = float(os.environ.get('PROFILING_STACK_INTERVAL', 0.005))
+PROFILING_SPANS_MAX = int(os.environ.get('PROFILING_SPANS_MAX', 1000))
+PROFILING_MAX_SECONDS = 600
+MEMORY_TOP = 50
+
+PHASES = ('parse', 'crypto', 'http', 'serialize')
+
+# Этапы текущего запроса: {этап: секунды} или None вне профилируемого запроса
+_spans = contextvars.ContextVar('profiling_spans', default=None)
+_null_span = nullcontext()
+
+
+def record(phase, seconds):
+    """Добавление времени этапа к текущему запросу"""
+    spans = _spans.get()
+    if spans is not None:
+        spans[phase] = spans.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def _timed_span(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+
+def span(phase):
+    """Замер этапа обработки запроса (parse, crypto, http, serialize)"""
+    if _spans.get() is None:
+        return _null_span
+    return _timed_span(phase)
+
+
+class SpanStore:
+    """Последние запросы с разбивкой по этапам и средние значения по маршрутам"""
+    def __init__(self, max_size=PROFILING_SPANS_MAX):
+        self._recent = deque(maxlen=max_size)
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def add(self, route, method, status, total, phases):
+        other = max(0.0, total - sum(phases.values()))
+        entry = {
+            "route": route,
+            "method": method,
+            "status": status,
+            "total_ms": round(total * 1000, 3),
+            **{f"{phase}_ms": round(phases.get(phase, 0.0) * 1000, 3) for phase in PHASES},
+            "other_ms": round(other * 1000, 3),
+        }
+        with self._lock:
+            self._recent.append(entry)
+            totals = self._totals.setdefault((method, route), Counter())
+            totals['count'] += 1
+            totals['total'] += total
+            totals['other'] += other
+            for phase, seconds in phases.items():
+                totals[phase] += seconds
+
+    def summary(self):
+        with self._lock:
+            routes = []
+            for (method, route), totals in sorted(self._totals.items()):
+                count = totals['count']
+                routes.append({
+                    "route": route,
+                    "method": method,
+                    "count": count,
+                    **{f"avg_{phase}_ms": round(totals[phase] / count * 1000, 3)
+                       for phase in ('total',) + PHASES + ('other',)},
+                })
+            return {"routes": routes, "recent": list(self._recent)}
+
+
+class Profiler:
+    """Профилирование за окно времени: cProfile выборки запросов, стеки потоков, tracemalloc"""
+    def __init__(self, stack_interval=PROFILING_STACK_INTERVAL):
+        self.stack_interval = stack_interval
+        self._lock = threading.Lock()
+        self.active = False
+        self.until = 0
+        self.rate = 0
+        self.started_at = None
+        self._stats = None
+        self._stacks = Counter()
+        self._samples = 0
+        self._memory = None
+        self._trace_memory = False
+        self._thread_profile = None
+
+    def start(self, seconds, rate=PROFILING_SAMPLE_RATE, memory=False):
+        """Запуск окна профилирования; ValueError при неверных параметрах или активном окне"""
+        if not 0 < seconds <= PROFILING_MAX_SECONDS:
+            raise ValueError(f"Длительность окна должна быть в диапазоне 0..{PROFILING_MAX_SECONDS} с")
+        if not 0 <= rate <= 1:
+            raise ValueError("Доля профилируемых запросов должна быть в диапазоне 0..1")
+        with self._lock:
+            if self.active:
+                raise ValueError("Профилирование уже запущено")
+            self.active = True
+            self.rate = rate
+            self.started_at = time.time()
+            self.until = time.monotonic() + seconds
+            self._stats = None
+            self._stacks = Counter()
+            self._samples = 0
+            self._memory = None
+            self._trace_memory = memory and not tracemalloc.is_tracing()
+        if self._trace_memory:
+            tracemalloc.start()
+        threading.Thread(target=self._sample_stacks, name='profiler', daemon=True).start()
+        logger.info(f"Профилирование запущено на {seconds} с, доля запросов {rate}")
+        return self.status()
+
+    def _sample_stacks(self):
+        own_id = threading.get_ident()
+        names = {}
+        while time.monotonic() < self.until:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)).replace(' ', '_'))
+                with self._lock:
+                    self._stacks[';'.join(reversed(stack))] += 1
+            self._samples += 1
+            time.sleep(self.stack_interval)
+        self._finish()
+
+    def _finish(self):
+        if self._trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self._memory = [{
+                "file": stat.traceback[0].filename,
+                "line": stat.traceback[0].lineno,
+                "size_kb": round(stat.size / 1024, 1),
+                "count": stat.count,
+            } for stat in snapshot.statistics('lineno')[:MEMORY_TOP]]
+        with self._lock:
+            self.active = False
+        logger.info(f"Профилирование завершено, снимков стеков: {self._samples}")
+
+    def profile_request(self):
+        """cProfile для выборки запросов во время окна (или None)"""
+        if not self.active or self._thread_profile is not None or random.random() >= self.rate:
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def add_profile(self, profile):
+        profile.disable()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def start_thread_profile(self):
+        """cProfile всего текущего потока (цикл событий asyncio) до stop_thread_profile"""
+        profile = cProfile.Profile()
+        profile.enable()
+        self._thread_profile = profile
+
+    def stop_thread_profile(self):
+        profile, self._thread_profile = self._thread_profile, None
+        if profile is not None:
+            self.add_profile(profile)
+
+    def status(self):
+        with self._lock:
+            return {
+                "active": self.active,
+                "started_at": self.started_at,
+                "remaining": round(max(0.0, self.until - time.monotonic()), 3) if self.active else 0,
+                "rate": self.rate,
+                "stack_samples": self._samples,
+                "profiled_calls": self._stats.total_calls if self._stats else 0,
+                "memory": self._memory is not None,
+            }
+
+    def pstats_bytes(self):
+        """Результат cProfile в формате pstats (как pstats.Stats.dump_stats) или None"""
+        with self._lock:
+            return marshal.dumps(self._stats.stats) if self._stats else None
+
+    def collapsed(self):
+        """Стеки в свёрнутом формате (flamegraph.pl, speedscope)"""
+        with self._lock:
+            stacks = Counter(self._stacks)
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def memory(self):
+        return self._memory
+
+
+# Общие профилировщик и журнал этапов процесса
+profiler = Profiler()
+span_store = SpanStore()
+
+
+def begin_request(profile=True):
+    """Начало учёта этапов запроса; состояние передаётся в end_request.
+
+    profile=False - без cProfile запроса (в asyncio запросы делят один поток)
+    """
+    return _spans.set({}), time.perf_counter(), profiler.profile_request() if profile else None
+
+
+def end_request(state, route, method, status):
+    token, start, profile = state
+    total = time.perf_counter() - start
+    phases = _spans.get() or {}
+    _spans.reset(token)
+    if profile is not None:
+        profiler.add_profile(profile)
+    span_store.add(route, method, status, total, phases)
+
+
+def authorized(headers):
+    return not PROFILING_TOKEN or headers.get('X-Profiling-Token') == PROFILING_TOKEN
+
+
+def parse_start(data):
+    """Параметры окна из тела запроса: (секунды, доля, tracemalloc)"""
+    data = data or {}
+    try:
+        return (float(data.get('seconds', 30)), float(data.get('rate', PROFILING_SAMPLE_RATE)),
+                bool(data.get('memory', False)))
+    except (TypeError, ValueError):
+        raise ValueError("seconds и rate должны быть числами")
+
+
+def start_on_boot():
+    if PROFILING_ENABLED and PROFILING_CAPTURE_SECONDS > 0:
+        profiler.start(PROFILING_CAPTURE_SECONDS)
+
+
+def install(app):
+    """Этапы запросов и /admin/profile для приложения Flask (только при PROFILING_ENABLED=1)"""
+    if not PROFILING_ENABLED:
+        return
+    from functools import wraps
+    from flask import Response, g, jsonify, request
+
+    base_request = app.request_class
+
+    class ProfiledRequest(base_request):
+        def get_json(self, *args, **kwargs):
+            with span('parse'):
+                return super().get_json(*args, **kwargs)
+
+    app.request_class = ProfiledRequest
+    json_response = app.json.response
+
+    def response(*args, **kwargs):
+        with span('serialize'):
+            return json_response(*args, **kwargs)
+
+    app.json.response = response
+
+    @app.before_request
+    def _begin_spans():
+        g.profiling_state = begin_request()
+
+    @app.after_request
+    def _end_spans(resp):
+        state = g.pop('profiling_state', None)
+        if state is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            end_request(state, route, request.method, resp.status_code)
+        return resp
+
+    def admin(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not authorized(request.headers):
+                return jsonify({"status": "error", "message": "Нет доступа"}), 403
+            return func(*args, **kwargs)
+        return wrapper
+
+    @app.route('/admin/profile', methods=['GET'])
+    @admin
+    def profile_status():
+        return jsonify({"status": "ok", "profiler": profiler.status(), "spans": span_store.summary()})
+
+    @app.route('/admin/profile/start', methods=['POST'])
+    @admin
+    def profile_start():
+        try:
+            seconds, rate, memory = parse_start(request.get_json(silent=True))
+            return jsonify({"status": "ok", "profiler": profiler.start(seconds, rate, memory)})
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+    @app.route('/admin/profile/pstats', methods=['GET'])
+    @admin
+    def profile_pstats():
+        data = profiler.pstats_bytes()
+        if data is None:
+            return jsonify({"status": "error", "message": "Нет данных cProfile"}), 404
+        return Response(data, mimetype='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename=profile.pstats'})
+
+    @app.route('/admin/profile/collapsed', methods=['GET'])
+    @admin
+    def profile_collapsed():
+        return Response(profiler.collapsed(), mimetype='text/plain',
+                        headers={'Content-Disposition': 'attachment; filename=profile.collapsed'})
+
+    @app.route('/admin/profile/memory', methods=['GET'])
+    @admin
+    def profile_memory():
+        memory = profiler.memory()
+        if memory is None:
+            return jsonify({"status": "error", "message": "Нет данных tracemalloc"}), 404
+        return jsonify({"status": "ok", "top": memory})
+
+    start_on_boot()
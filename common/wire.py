@@ -0,0 +1,116 @@
+import os
+import json
+from flask import Request, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import msgpack
+except ImportError:  # без msgpack остаётся только JSON
+    msgpack = None
+
+# Формат обмена: большие целые передаются в msgpack как целые фиксированной
+# длины (big-endian, дополнительный код), JSON остаётся запасным вариантом
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
+# Формат исходящих запросов: msgpack (если установлен) или json
+WIRE_FORMAT = os.environ.get('WIRE_FORMAT', 'msgpack' if msgpack else 'json')
+
+BIGINT_EXT = 1
+# Ширина целого: 512-битный модуль n занимает 64 байта
+INT_WIDTH = 64
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def msgpack_enabled():
+    return msgpack is not None and WIRE_FORMAT == 'msgpack'
+
+
+def request_content_type():
+    """Тип содержимого исходящих запросов"""
+    return MSGPACK_CONTENT_TYPE if msgpack_enabled() else JSON_CONTENT_TYPE
+
+
+def _pack_ints(obj):
+    """Замена целых, не помещающихся в int64, на расширение msgpack"""
+    if isinstance(obj, bool):
+        return obj
+    if isinstance(obj, int):
+        if INT64_MIN <= obj <= INT64_MAX:
+            return obj
+        # Старший бит отводится под знак
+        width = max(INT_WIDTH, (obj.bit_length() + 8) // 8)
+        return msgpack.ExtType(BIGINT_EXT, obj.to_bytes(width, 'big', signed=True))
+    if isinstance(obj, dict):
+        return {key: _pack_ints(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_pack_ints(value) for value in obj]
+    return obj
+
+
+def _ext_hook(code, data):
+    if code == BIGINT_EXT:
+        return int.from_bytes(data, 'big', signed=True)
+    return msgpack.ExtType(code, data)
+
+
+def encode(payload, content_type=MSGPACK_CONTENT_TYPE):
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return msgpack.packb(_pack_ints(payload), use_bin_type=True)
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def decode(body, content_type=MSGPACK_CONTENT_TYPE):
+    """Разбор тела сообщения; ValueError при некорректных данных"""
+    if content_type == MSGPACK_CONTENT_TYPE:
+        if msgpack is None:
+            raise ValueError("msgpack не установлен")
+        try:
+            return msgpack.unpackb(body, ext_hook=_ext_hook, raw=False)
+        except Exception as e:
+            raise ValueError(f"Некорректные данные msgpack: {str(e)}")
+    return json.loads(body)
+
+
+def decode_body(body, content_type_header):
+    """Разбор тела по заголовку Content-Type"""
+    mimetype = (content_type_header or '').split(';')[0].strip()
+    return decode(body, MSGPACK_CONTENT_TYPE if mimetype == MSGPACK_CONTENT_TYPE else JSON_CONTENT_TYPE)
+
+
+def wants_msgpack(accept):
+    """Клиент явно принимает msgpack"""
+    return msgpack is not None and MSGPACK_CONTENT_TYPE in (accept or '')
+
+
+class WireRequest(Request):
+    """Запрос Flask: request.json разбирает и JSON, и msgpack"""
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype != MSGPACK_CONTENT_TYPE:
+            return super().get_json(force=force, silent=silent, cache=cache)
+        try:
+            return decode(self.get_data(cache=cache))
+        except ValueError as e:
+            if silent:
+                return None
+            return self.on_json_loading_failed(e)
+
+
+class WireJSONProvider(DefaultJSONProvider):
+    """jsonify отвечает в msgpack, если клиент указал его в Accept"""
+    def response(self, *args, **kwargs):
+        if request and wants_msgpack(request.headers.get('Accept')):
+            if args and kwargs:
+                raise TypeError("jsonify() принимает либо args, либо kwargs")
+            obj = args[0] if len(args) == 1 else (args or kwargs or None)
+            return self._app.response_class(encode(obj), mimetype=MSGPACK_CONTENT_TYPE)
+        return super().response(*args, **kwargs)
+
+
+def install(app):
+    """Подключение msgpack к приложению Flask"""
+    app.request_class = WireRequest
+    app.json_provider_class = WireJSONProvider
+    app.json = WireJSONProvider(app)